@@ -19,15 +19,19 @@ import os
 
 from phabtalk.phabtalk import PhabTalk
 
-if __name__ == '__main__':
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Runs premerge checks8')
     parser.add_argument('--url', type=str)
     parser.add_argument('--name', type=str)
     parser.add_argument('--phid', type=str)
     parser.add_argument('--log-level', type=str, default='WARNING')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
     dry = os.getenv('ph_dry_run_report') is not None
     PhabTalk(os.getenv('CONDUIT_TOKEN'), dry_run_updates=dry).maybe_add_url_artifact(args.phid, args.url, args.name)
 
+
+if __name__ == '__main__':
+    main()
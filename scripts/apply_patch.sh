@@ -24,14 +24,15 @@ scripts/patch_diff.py $ph_buildable_diff \
   --url $PHABRICATOR_HOST \
   --log-level $LOG_LEVEL \
   --commit $BASE_COMMIT \
+  --base-strategy "${ph_base_strategy:-newest}" \
   --phid ${ph_target_phid} \
   --push-branch
 
 EXIT_STATUS=$?
 
 if [ $EXIT_STATUS -ne 0 ]; then
-  scripts/add_phabricator_artifact.py --phid="$ph_target_phid" --url="$BUILDKITE_BUILD_URL" --name="patch application failed"
-  scripts/set_build_status.py
+  scripts/premerge.py add-artifact --phid="$ph_target_phid" --url="$BUILDKITE_BUILD_URL" --name="patch application failed"
+  scripts/premerge.py set-build-status
   echo failed
 fi
 
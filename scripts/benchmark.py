@@ -15,136 +15,425 @@
 
 """Run benchmark of the various steps in the pre-merge tests.
 
-This can be used to tune the build times.
+This can be used to tune the build times and to size the agents.
+
+The scenarios are defined in benchmark_scenarios.yaml. Every run of a command
+is appended as one row to the result file, so results of different machines or
+configurations can be collected in one file and compared:
+
+  benchmark.py run --name n2-standard-32 --scenario warm-ccache
+  benchmark.py run --name c2-standard-30 --scenario warm-ccache
+  benchmark.py compare pmt-benchmark.csv --baseline n2-standard-32
 """
 
 import argparse
 import csv
 import datetime
+import json
+import math
 import multiprocessing
 import os
 import platform
 import psutil
+import statistics
 import subprocess
 import sys
-from typing import Optional, Dict, List
+import tempfile
+import time
+from typing import Optional, Dict, List, Tuple
+
+import yaml
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LLVM_REPO = 'https://github.com/llvm/llvm-project'
+# interval for sampling the memory usage of a command in seconds
+SAMPLE_INTERVAL = 0.5
+
+RESULT_FIELDS = ['name', 'scenario', 'command', 'run', 'wall_time', 'cpu_time', 'peak_rss', 'cache_hits',
+                 'cache_misses', 'cores', 'CPU', 'RAM', 'OS', 'timestamp']
 
 
 class Cmd:
     """Command to be executed as part of the benchmark.
 
-    If name is not set, the results will not be logged to the result file.
+    If title is not set, the command is not measured.
     """
 
     def __init__(self, cmd: str, title: str = None):
         self.cmd = cmd  # type: str
         self.title = title  # type: Optional[str]
-        self.execution_time = None  # type: Optional[datetime.timedelta]
 
     @property
     def has_title(self) -> bool:
         return self.title is not None
 
-    @property
-    def was_executed(self) -> bool:
-        return self.execution_time is not None
-
 
 class Remove(Cmd):
     """Remove command, sensitive to OS."""
 
     def __init__(self, path: str):
         if platform.system() == 'Windows':
-            cmd = 'cmd /c rd /s/q {}'.format(path)
+            cmd = 'cmd /c if exist {0} rd /s/q {0}'.format(path)
         else:
             cmd = 'rm -rf {}'.format(path)
-        super().__init__(cmd, "rm -rf {}".format(path))
-
-
-# commands for the benchmark
-COMMANDS = [
-    Cmd('git clone https://github.com/llvm/llvm-project .', 'git clone'),
-    Cmd('git checkout release/10.x', 'git checkout release'),
-    Cmd('git pull', 'git pull'),
-    Cmd('git checkout {commit}'),
-    # clean build, make sure ccache (or similar) is empty
-    Cmd('{pmt_root_path}/scripts/run_cmake.py', 'cmake 1st'),
-    Cmd('{pmt_root_path}/scripts/run_ninja.py all', 'ninja all 1st'),
-    Cmd('{pmt_root_path}/scripts/run_ninja.py check-all', 'ninja check-all 1st'),
-    Remove('build'),
-    # now rebuild from ccache (or similar)
-    Cmd('{pmt_root_path}/scripts/run_cmake.py', 'cmake 2nd'),
-    Cmd('{pmt_root_path}/scripts/run_ninja.py all', 'ninja all 2nd'),
-    Cmd('{pmt_root_path}/scripts/run_ninja.py check-all', 'ninja check-all 2nd'),
-]
-
-
-def run_benchmark(commit: str, name: str, result_file_path: str, workdir: str, pmt_root_path: str):
-    """Tun the benchmark, write the results to a file."""
-    print('Usingn workdir {}'.format(workdir))
+        super().__init__(cmd)
+
+
+class ClearCache(Cmd):
+    """Empty the compiler cache: ccache on Linux, sccache on Windows."""
+
+    def __init__(self):
+        if platform.system() == 'Windows':
+            cmd = ('powershell -command "sccache --stop-server; '
+                   'Remove-Item -Recurse -Force -ErrorAction Ignore $env:SCCACHE_DIR; sccache --start-server"')
+        else:
+            cmd = 'ccache --clear'
+        super().__init__(cmd)
+
+
+class Configure(Cmd):
+    """run_cmake.py for the projects of the scenario, skipped if build/ is already configured for them.
+
+    run_cmake.py starts with an empty build directory, so it can't run before incremental builds."""
+
+    MARKER = os.path.join('build', '.benchmark-projects')
+
+    def __init__(self):
+        super().__init__('{pmt_root_path}/scripts/run_cmake.py --config "{cmake_config}" "{projects}"')
+
+    def needed(self, workdir: str, projects: str) -> bool:
+        try:
+            with open(os.path.join(workdir, self.MARKER)) as f:
+                return f.read() != projects or not os.path.exists(os.path.join(workdir, 'build', 'build.ninja'))
+        except OSError:
+            return True
+
+    def done(self, workdir: str, projects: str):
+        with open(os.path.join(workdir, self.MARKER), 'w') as f:
+            f.write(projects)
+
+
+def setup_cmd(config) -> Cmd:
+    """Command of `setup` or `teardown`: a string, {remove: path}, {clear_cache: true} or {configure: true}."""
+    if isinstance(config, str):
+        return Cmd(config)
+    if config.get('configure'):
+        return Configure()
+    if 'remove' in config:
+        return Remove(config['remove'])
+    if config.get('clear_cache'):
+        return ClearCache()
+    raise ValueError(f'unknown setup command {config}')
+
+
+class Measurement:
+    """Resources used by one run of a command."""
+
+    def __init__(self, wall_time: float, cpu_time: Optional[float], peak_rss: int,
+                 cache_stats: Optional[Tuple[int, int]]):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
+        self.cache_hits = cache_stats[0] if cache_stats is not None else None
+        self.cache_misses = cache_stats[1] if cache_stats is not None else None
+
+
+class Scenario:
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.description = config.get('description', '')
+        self.setup = [setup_cmd(c) for c in config.get('setup', [])]
+        self.teardown = [setup_cmd(c) for c in config.get('teardown', [])]
+        self.commands = [Cmd(c['cmd'], c['title']) for c in config['commands']]
+        self.repetitions = int(config.get('repetitions', 1))
+        self.warmup = int(config.get('warmup', 0))
+        self.projects = config.get('projects', 'detect')
+
+
+def load_scenarios(path: str) -> Dict[str, Scenario]:
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    defaults = config.get('defaults', {})
+    scenarios = {}
+    for name, scenario in config['scenarios'].items():
+        scenarios[name] = Scenario(name, {**defaults, **scenario})
+    return scenarios
+
+
+def _ccache_stats() -> Optional[Tuple[int, int]]:
+    try:
+        out = subprocess.run(['ccache', '--print-stats'], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    stats = {}
+    for line in out.splitlines():
+        key, _, value = line.partition('\t')
+        if value.strip().isdigit():
+            stats[key] = int(value)
+    hits = stats.get('direct_cache_hit', 0) + stats.get('preprocessed_cache_hit', 0)
+    return hits, stats.get('cache_miss', 0)
+
+
+def _sccache_stats() -> Optional[Tuple[int, int]]:
+    try:
+        out = subprocess.run(['sccache', '--show-stats', '--stats-format=json'], capture_output=True, text=True,
+                             check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    stats = json.loads(out)['stats']
+    return sum(stats['cache_hits']['counts'].values()), sum(stats['cache_misses']['counts'].values())
+
+
+def cache_stats() -> Optional[Tuple[int, int]]:
+    """Total number of (hits, misses) of the compiler cache, None if there is none."""
+    if platform.system() == 'Windows':
+        return _sccache_stats()
+    return _ccache_stats()
+
+
+def _cpu_times() -> Optional[float]:
+    """CPU time of all terminated child processes, including their children."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _tree_rss(proc: psutil.Process) -> Tuple[int, float]:
+    """RSS of a process and its children, and CPU time of the ones still running."""
+    rss = 0
+    cpu = 0.0
+    for p in [proc] + proc.children(recursive=True):
+        try:
+            rss += p.memory_info().rss
+            t = p.cpu_times()
+            cpu += t.user + t.system
+        except psutil.Error:
+            pass  # terminated in the meantime
+    return rss, cpu
+
+
+def run_cmd(command: Cmd, cmd_parameters: Dict[str, str], workdir: str) -> Measurement:
+    """Run a single command and measure it, exits if the command fails."""
+    cmdline = command.cmd.format(**cmd_parameters)
+    print('Running: {}'.format(cmdline), flush=True)
+    cache_before = cache_stats() if command.has_title else None
+    cpu_before = _cpu_times()
+    start_time = time.monotonic()
+    # the output goes to a file, a pipe that is not read would block the command
+    with tempfile.TemporaryFile() as output:
+        proc = subprocess.Popen(cmdline, shell=True, cwd=workdir, stdout=output, stderr=subprocess.STDOUT)
+        peak_rss = 0
+        polled_cpu = 0.0
+        ps_proc = psutil.Process(proc.pid)
+        while True:
+            rss, cpu = _tree_rss(ps_proc)
+            peak_rss = max(peak_rss, rss)
+            polled_cpu = max(polled_cpu, cpu)
+            try:
+                proc.wait(timeout=SAMPLE_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+        wall_time = time.monotonic() - start_time
+        if proc.returncode != 0:
+            output.seek(0)
+            sys.stdout.buffer.write(output.read())
+    if proc.returncode != 0:
+        print('Benchmark failed.')
+        sys.exit(1)
+    cpu_after = _cpu_times()
+    cpu_time = cpu_after - cpu_before if cpu_before is not None else polled_cpu
+    cache = None
+    if cache_before is not None:
+        cache_after = cache_stats()
+        cache = (cache_after[0] - cache_before[0], cache_after[1] - cache_before[1])
+    print('  Execution time was: {}'.format(datetime.timedelta(seconds=wall_time)))
+    return Measurement(wall_time, cpu_time, peak_rss, cache)
+
+
+def prepare_checkout(workdir: str, commit: str):
+    """Clone LLVM once, later runs only fetch and check out the commit."""
+    if not os.path.exists(os.path.join(workdir, '.git')):
+        os.makedirs(workdir, exist_ok=True)
+        run_cmd(Cmd(f'git clone {LLVM_REPO} .'), {}, workdir)
+    run_cmd(Cmd(f'git fetch -q origin {commit}'), {}, workdir)
+    run_cmd(Cmd('git checkout -q -f --detach FETCH_HEAD'), {}, workdir)
+
+
+def machine_info() -> Dict:
+    return {
+        'cores': multiprocessing.cpu_count(),
+        'CPU': platform.processor(),
+        'RAM': psutil.virtual_memory().total,
+        'OS': platform.platform(),
+    }
+
+
+def run_scenario(scenario: Scenario, name: str, cmd_parameters: Dict[str, str], workdir: str,
+                 result_file_path: str):
+    print(f'--- {scenario.name}: {scenario.description}', flush=True)
+    total = scenario.warmup + scenario.repetitions
+    for i in range(total):
+        warmup = i < scenario.warmup
+        params = {**cmd_parameters, 'projects': scenario.projects, 'run': i}
+        # undo changes of the setup commands of the previous run, the build dir is kept
+        run_cmd(Cmd('git reset -q --hard HEAD'), params, workdir)
+        for command in scenario.setup:
+            if isinstance(command, Configure):
+                if not command.needed(workdir, scenario.projects):
+                    continue
+                run_cmd(command, params, workdir)
+                command.done(workdir, scenario.projects)
+                continue
+            run_cmd(command, params, workdir)
+        rows = []
+        for command in scenario.commands:
+            m = run_cmd(command, params, workdir)
+            rows.append({
+                'name': name,
+                'scenario': scenario.name,
+                'command': command.title,
+                'run': i - scenario.warmup,
+                'wall_time': round(m.wall_time, 3),
+                'cpu_time': round(m.cpu_time, 3),
+                'peak_rss': m.peak_rss,
+                'cache_hits': m.cache_hits,
+                'cache_misses': m.cache_misses,
+                'timestamp': datetime.datetime.now().timestamp(),
+                **machine_info(),
+            })
+        for command in scenario.teardown:
+            run_cmd(command, params, workdir)
+        if warmup:
+            print(f'  warmup run {i + 1} of {scenario.warmup} done')
+            continue
+        write_results(rows, result_file_path)
+
+
+def run_benchmark(commit: str, name: str, result_file_path: str, workdir: str, pmt_root_path: str,
+                  scenarios: List[Scenario], cmake_config: str):
+    """Run the benchmark, write the results to a file."""
+    print('Using workdir {}'.format(workdir))
     print('Using scripts from {}'.format(pmt_root_path))
     cmd_parameters = {
         'pmt_root_path': pmt_root_path,
         'commit': commit,
+        'cmake_config': cmake_config,
     }
-    if os.path.exists(workdir):
-        run_cmd(Remove(workdir), cmd_parameters, '.')
-    os.makedirs(workdir)
-    try:
-        for command in COMMANDS:
-            run_cmd(command, cmd_parameters, workdir)
-    finally:
-        write_results(COMMANDS, result_file_path, name)
+    prepare_checkout(workdir, commit)
+    for scenario in scenarios:
+        run_scenario(scenario, name, cmd_parameters, workdir, result_file_path)
+    print('Benchmark completed.')
+    compare([result_file_path], None, [name])
 
 
-def write_results(commands: List[Cmd], result_file_path: str, name: str):
-    fieldnames = ['name', 'cores', 'CPU', 'RAM', 'timestamp', 'OS']
-    fieldnames.extend(cmd.title for cmd in COMMANDS if cmd.has_title)
+def write_results(rows: List[Dict], result_file_path: str):
     exists = os.path.exists(result_file_path)
     with open(result_file_path, 'a') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames, dialect=csv.excel)
+        writer = csv.DictWriter(csv_file, fieldnames=RESULT_FIELDS, dialect=csv.excel)
         if not exists:
             writer.writeheader()
-        row = {
-            'name': name,
-            'cores': multiprocessing.cpu_count(),
-            'CPU': platform.processor(),
-            'RAM': psutil.virtual_memory().total,
-            'timestamp': datetime.datetime.now().timestamp(),
-            'OS': platform.platform()
-        }
-        for command in (cmd for cmd in commands if (cmd.has_title and cmd.was_executed)):
-            row[command.title] = command.execution_time.total_seconds()
-        writer.writerow(row)
-    print('Benchmark completed.')
+        writer.writerows(rows)
 
 
-def run_cmd(command: Cmd, cmd_parameters: Dict[str, str], workdir: str):
-    """Run a single command."""
-    cmdline = command.cmd.format(**cmd_parameters)
-    print('Running: {}'.format(cmdline))
-    start_time = datetime.datetime.now()
-    proc = subprocess.Popen(cmdline, shell=True, cwd=workdir, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    if proc.poll() != 0:
-        print(stdout)
-        print(stderr)
-        print('Benchmark failed.')
-        sys.exit(1)
-    end_time = datetime.datetime.now()
-    command.execution_time = end_time - start_time
-    print('  Execution time was: {}'.format(command.execution_time))
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def _summarize(rows: List[Dict]) -> Dict[str, float]:
+    def floats(key: str) -> List[float]:
+        return [float(r[key]) for r in rows if r.get(key) not in (None, '')]
+    wall = floats('wall_time')
+    cpu = floats('cpu_time')
+    rss = floats('peak_rss')
+    hits = sum(floats('cache_hits'))
+    misses = sum(floats('cache_misses'))
+    return {
+        'runs': len(wall),
+        'median': statistics.median(wall),
+        'p90': percentile(wall, 90),
+        'cpu': statistics.median(cpu) if cpu else float('nan'),
+        'rss': max(rss) / 2**30 if rss else float('nan'),
+        'hit_rate': 100 * hits / (hits + misses) if hits + misses > 0 else float('nan'),
+    }
+
+
+def compare(result_files: List[str], baseline: Optional[str], names: Optional[List[str]] = None):
+    """Print median / p90 per scenario and command, side by side for all names."""
+    groups = {}  # type: Dict[Tuple[str, str], Dict[str, List[Dict]]]
+    all_names = []
+    for path in result_files:
+        with open(path) as csv_file:
+            for row in csv.DictReader(csv_file):
+                if names and row['name'] not in names:
+                    continue
+                if 'scenario' not in row:
+                    continue  # result file of the old benchmark
+                if row['name'] not in all_names:
+                    all_names.append(row['name'])
+                groups.setdefault((row['scenario'], row['command']), {}).setdefault(row['name'], []).append(row)
+    if baseline is None and all_names:
+        baseline = all_names[0]
+    print(f'{"scenario":20} {"command":20} {"name":24} {"runs":>4} {"median s":>10} {"p90 s":>10} '
+          f'{"cpu s":>10} {"RSS GiB":>8} {"hits %":>7} {"vs " + str(baseline):>16}')
+    for (scenario, command), by_name in sorted(groups.items()):
+        base = _summarize(by_name[baseline]) if baseline in by_name else None
+        for name in all_names:
+            if name not in by_name:
+                continue
+            s = _summarize(by_name[name])
+            diff = ''
+            if base is not None and name != baseline:
+                diff = f'{100 * (s["median"] - base["median"]) / base["median"]:+.1f}%'
+            print(f'{scenario:20} {command:20} {name:24} {s["runs"]:>4} {s["median"]:>10.1f} {s["p90"]:>10.1f} '
+                  f'{s["cpu"]:>10.1f} {s["rss"]:>8.2f} {s["hit_rate"]:>7.1f} {diff:>16}')
 
 
 if __name__ == '__main__':
     pmt_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     parser = argparse.ArgumentParser(
         description='Benchmark for LLVM pre-merge tests.')
-    parser.add_argument('--commit', type=str, default='main', help="LLVM commit to run this benchmark on.")
-    parser.add_argument('--result-file', type=str, default='pmt-benchmark.csv',
-                        help="path to CSV file where to store the benchmark results")
-    parser.add_argument('--workdir', type=str, default=os.path.join(os.getcwd(), 'benchmark'),
-                        help='Folder to store the LLVM checkout.')
-    parser.add_argument('--name', type=str, default=None, help="name for the benchmark")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('--commit', type=str, default='main', help="LLVM commit to run this benchmark on.")
+    run_parser.add_argument('--result-file', type=str, default='pmt-benchmark.csv',
+                            help="path to CSV file where to store the benchmark results")
+    run_parser.add_argument('--workdir', type=str, default=os.path.join(os.getcwd(), 'benchmark'),
+                            help='Folder to store the LLVM checkout, it is reused by later runs.')
+    run_parser.add_argument('--name', type=str, default=platform.node(),
+                            help="name for the benchmark, e.g. the machine type or configuration")
+    run_parser.add_argument('--scenarios', type=str, default=os.path.join(SCRIPTS_DIR, 'benchmark_scenarios.yaml'),
+                            help='YAML file with the scenarios')
+    run_parser.add_argument('--scenario', type=str, action='append', default=None,
+                            help='scenario to run, can be repeated. Default: all scenarios')
+    run_parser.add_argument('--repetitions', type=int, default=None, help='override repetitions of the scenarios')
+    run_parser.add_argument('--cmake-config', type=str, default=os.path.join(SCRIPTS_DIR, 'run_cmake_config.yaml'),
+                            help='run_cmake.py configuration to benchmark')
+    compare_parser = subparsers.add_parser('compare', help='compare results of different names')
+    compare_parser.add_argument('result_files', nargs='+', help='CSV files written by "run"')
+    compare_parser.add_argument('--baseline', type=str, default=None,
+                                help='name to compare the others to. Default: the first one')
     args = parser.parse_args()
-    run_benchmark(args.commit, args.name, args.result_file, args.workdir, pmt_root)
+    if args.action == 'compare':
+        compare(args.result_files, args.baseline)
+        sys.exit(0)
+    all_scenarios = load_scenarios(args.scenarios)
+    selected = args.scenario or list(all_scenarios.keys())
+    unknown = [s for s in selected if s not in all_scenarios]
+    if unknown:
+        print(f'unknown scenarios {unknown}, available: {list(all_scenarios.keys())}')
+        sys.exit(1)
+    for s in selected:
+        if args.repetitions is not None:
+            all_scenarios[s].repetitions = args.repetitions
+    run_benchmark(args.commit, args.name, args.result_file, os.path.abspath(args.workdir), pmt_root,
+                  [all_scenarios[s] for s in selected], os.path.abspath(args.cmake_config))
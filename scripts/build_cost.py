@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estimate the cost of a build and pick an agent queue and timeout for it.
+
+Small builds (e.g. only libclc) go to agents with few cores, big ones to the
+large agents, so they don't wait behind each other. The numbers are in
+build_cost.yaml. cpu_minutes there are derived from Buildkite job durations
+by build_cost_fit.py; as long as they are not, timeouts stay at the fixed
+minimum of each OS.
+
+Only the steps of steps.generic_linux / generic_windows are placed this way,
+i.e. the scheduled builds of pipeline_main.py. Premerge steps come from
+.ci/generate-buildkite-pipeline-premerge in llvm-project.
+"""
+
+import argparse
+import functools
+import logging
+import math
+import os
+from typing import Dict, Optional, Set
+
+import yaml
+
+from choose_projects import ChooseProjects
+
+
+class Placement:
+    """Where and how long a build step may run."""
+
+    def __init__(self, agents: Dict, timeout_in_minutes: int, cpu_minutes: float):
+        self.agents = agents
+        self.timeout_in_minutes = timeout_in_minutes
+        self.cpu_minutes = cpu_minutes
+
+
+class BuildCost:
+    CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'build_cost.yaml')
+
+    def __init__(self, config_file: Optional[str] = None, choose_projects: Optional[ChooseProjects] = None):
+        with open(config_file or self.CONFIG_FILE) as f:
+            self.config = yaml.load(f, Loader=yaml.SafeLoader)
+        self.cp = choose_projects or ChooseProjects(None)
+
+    def resolve(self, projects: str, os_name: str) -> Set[str]:
+        """Projects as passed to premerge_checks.py, with their dependencies."""
+        names = set(p for p in projects.split(';') if p)
+        if len(names) == 0 or names & {'all', 'default', 'detect'}:
+            # unknown before the build, assume the worst
+            names = set(self.cp.get_all_enabled_projects(os_name))
+        return self.cp.get_dependencies(names)
+
+    def estimate(self, projects: str, os_name: str) -> float:
+        """CPU-minutes to build and test the projects."""
+        costs = self.config['cpu_minutes']
+        default = max(costs.values())
+        total = 0.0
+        for p in self.resolve(projects, os_name):
+            if p not in costs:
+                logging.warning(f'no cost for project {p}, assuming {default} CPU-minutes')
+            total += costs.get(p, default)
+        return total * self.config['os_factor'].get(os_name, 1.0)
+
+    def timeout(self, cpu_minutes: float, cores: int, os_name: str) -> int:
+        t = self.config['timeout']
+        if not self.config.get('measured', False):
+            return t['min_minutes'][os_name]
+        minutes = t['overhead_minutes'] + t['safety_factor'] * cpu_minutes / cores
+        return int(min(t['max_minutes'], max(t['min_minutes'][os_name], math.ceil(minutes))))
+
+    def place(self, projects: str, os_name: str, sized_queues: bool = False) -> Placement:
+        """Queue and timeout for a build of the projects.
+
+        Queues marked as sized in the config are only used if sized_queues is set."""
+        cpu_minutes = self.estimate(projects, os_name)
+        queues = [q for q in self.config['queues'][os_name] if sized_queues or not q.get('sized', False)]
+        queue = queues[-1]
+        for q in queues:
+            if cpu_minutes <= q.get('max_cpu_minutes', math.inf):
+                queue = q
+                break
+        timeout = self.timeout(cpu_minutes, queue['cores'], os_name)
+        logging.info(f'{os_name} build of "{projects}": {cpu_minutes:.0f} CPU-minutes, '
+                     f'queue {queue["queue"]}, timeout {timeout} minutes')
+        return Placement({'queue': queue['queue']}, timeout, cpu_minutes)
+
+
+@functools.lru_cache(maxsize=None)
+def default() -> BuildCost:
+    """BuildCost for build_cost.yaml, loaded once per process."""
+    return BuildCost()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the cost of a build and the queue to run it on.')
+    parser.add_argument('projects', type=str, help='projects separated by ";", e.g. "clang;lld"')
+    parser.add_argument('--os', type=str, default='linux', choices=['linux', 'windows'])
+    parser.add_argument('--sized-queues', action='store_true', help='also use the queues marked as sized')
+    parser.add_argument('--log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
+    p = default().place(args.projects, args.os, args.sized_queues)
+    print(f'{p.cpu_minutes:.0f} CPU-minutes, agents {p.agents}, timeout {p.timeout_in_minutes} minutes')
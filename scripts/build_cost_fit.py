@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Derive the cpu_minutes of build_cost.yaml from recorded Buildkite jobs.
+
+Reads the JSON lines written by metrics/buildkite_master_stats.py. Every
+passed premerge_checks.py job gives the CPU-minutes of one set of projects:
+(duration - overhead_minutes) * cores of its queue / os_factor. The cost per
+project is the non-negative least squares fit of these sums, starting from the
+current values, so projects that are always built together keep their ratio
+and projects without jobs keep their value.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from build_cost import BuildCost
+
+PROJECTS_REGEX = re.compile(r'premerge_checks\.py .*--projects=["\']([^"\']*)["\']')
+# multiplicative updates of the fit
+ITERATIONS = 500
+
+
+def _time(value: str) -> datetime.datetime:
+    # example: 2022-03-01T10:00:00.123Z
+    return datetime.datetime.fromisoformat(value.rstrip('Z'))
+
+
+def read_builds(paths: Iterable[str]) -> List[Dict]:
+    """Builds of the JSON lines files, the last record of a build number wins."""
+    builds = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                b = json.loads(line)
+                builds[(b.get('pipeline', {}).get('slug'), b['number'])] = b
+    return list(builds.values())
+
+
+def job_samples(builds: Iterable[Dict], bc: BuildCost) -> List[Tuple[Set[str], float]]:
+    """(projects with dependencies, Linux CPU-minutes) of every passed build job."""
+    queues = {}  # type: Dict[str, Tuple[str, int]]
+    for os_name, qs in bc.config['queues'].items():
+        for q in qs:
+            queues[q['queue']] = (os_name, q['cores'])
+    overhead = bc.config['timeout']['overhead_minutes']
+    samples = []
+    for b in builds:
+        for job in b.get('jobs', []):
+            if job.get('type') != 'script' or job.get('state') != 'passed':
+                continue
+            if job.get('started_at') is None or job.get('finished_at') is None:
+                continue
+            m = PROJECTS_REGEX.search(job.get('command') or '')
+            queue = _queue(job.get('agent_query_rules', []))
+            if m is None or queue not in queues:
+                continue
+            os_name, cores = queues[queue]
+            minutes = (_time(job['finished_at']) - _time(job['started_at'])).total_seconds() / 60
+            cpu_minutes = max(0.0, minutes - overhead) * cores / bc.config['os_factor'].get(os_name, 1.0)
+            samples.append((bc.resolve(m.group(1), os_name), cpu_minutes))
+    return samples
+
+
+def _queue(rules: List[str]) -> Optional[str]:
+    for rule in rules:
+        key, _, value = rule.partition('=')
+        if key == 'queue':
+            return value
+    return None
+
+
+def fit(samples: List[Tuple[Set[str], float]], start: Dict[str, float]) -> Dict[str, float]:
+    """Non-negative per project costs whose sums match the samples best."""
+    costs = dict(start)
+    default = max(start.values())
+    for projects, _ in samples:
+        for p in projects:
+            costs.setdefault(p, default)
+    for _ in range(ITERATIONS):
+        measured = {p: 0.0 for p in costs}
+        predicted = {p: 0.0 for p in costs}
+        for projects, cpu_minutes in samples:
+            total = sum(costs[p] for p in projects)
+            for p in projects:
+                measured[p] += cpu_minutes
+                predicted[p] += total
+        for p in costs:
+            if predicted[p] > 0:
+                costs[p] *= measured[p] / predicted[p]
+    return costs
+
+
+def write_config(path: str, costs: Dict[str, float]):
+    """Replace the values in the cpu_minutes block and set `measured`, keeping the comments."""
+    with open(path) as f:
+        lines = f.read().split('\n')
+    in_block = False
+    for i, line in enumerate(lines):
+        if line.startswith('measured:'):
+            lines[i] = 'measured: true'
+        elif line.startswith('cpu_minutes:'):
+            in_block = True
+        elif in_block and line.startswith('  '):
+            name = line.split(':', 1)[0].strip()
+            if name in costs:
+                lines[i] = f'  {name}: {round(costs[name])}'
+        elif in_block:
+            in_block = False
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Derive cpu_minutes of build_cost.yaml from Buildkite builds.')
+    parser.add_argument('builds', nargs='+', help='JSON lines files of metrics/buildkite_master_stats.py')
+    parser.add_argument('--config', type=str, default=BuildCost.CONFIG_FILE)
+    parser.add_argument('--write', action='store_true', help='update the config file instead of only printing')
+    parser.add_argument('--log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
+    bc = BuildCost(args.config)
+    samples = job_samples(read_builds(args.builds), bc)
+    if len(samples) == 0:
+        raise SystemExit('no passed premerge_checks.py jobs found')
+    old = bc.config['cpu_minutes']
+    costs = fit(samples, old)
+    print(f'{len(samples)} jobs')
+    for p in sorted(costs):
+        jobs = sum(1 for projects, _ in samples if p in projects)
+        print(f'{p:24} {old.get(p, "-"):>6} -> {costs[p]:6.0f} CPU-minutes, {jobs} jobs')
+    if args.write:
+        write_config(args.config, {p: c for p, c in costs.items() if p in old})
@@ -0,0 +1,82 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import build_cost  # noqa: E402
+import build_cost_fit  # noqa: E402
+
+
+def _job(projects: str, minutes: int, queue: str = 'linux', state: str = 'passed'):
+    return {
+        'type': 'script',
+        'state': state,
+        'command': f'$${{SRC}}/scripts/premerge_checks.py --projects="{projects}" --log-level=WARNING',
+        'agent_query_rules': [f'queue={queue}'],
+        'started_at': '2022-03-01T10:00:00.000Z',
+        'finished_at': f'2022-03-01T{10 + minutes // 60:02d}:{minutes % 60:02d}:00.000Z',
+    }
+
+
+def test_samples_from_jobs():
+    bc = build_cost.BuildCost()
+    builds = [{'number': 1, 'jobs': [_job('lld', 30), _job('lld', 30, state='failed'),
+                                     _job('lld', 30, queue='unknown'), {'type': 'waiter'}]}]
+    samples = build_cost_fit.job_samples(builds, bc)
+    overhead = bc.config['timeout']['overhead_minutes']
+    assert samples == [({'lld', 'llvm'}, (30 - overhead) * 64)]
+
+
+def test_fit_separates_projects():
+    start = {'a': 100.0, 'b': 100.0, 'c': 5.0}
+    samples = [({'a'}, 30.0), ({'a', 'b'}, 90.0), ({'a'}, 30.0)]
+    costs = build_cost_fit.fit(samples, start)
+    assert round(costs['a']) == 30
+    assert round(costs['b']) == 60
+    # no jobs, keeps its value
+    assert costs['c'] == 5.0
+
+
+def test_write_config_keeps_comments(tmp_path):
+    path = str(tmp_path / 'build_cost.yaml')
+    shutil.copy(build_cost.BuildCost.CONFIG_FILE, path)
+    build_cost_fit.write_config(path, {'lld': 12.4})
+    bc = build_cost.BuildCost(path)
+    assert bc.config['measured'] is True
+    assert bc.config['cpu_minutes']['lld'] == 12
+    assert bc.config['cpu_minutes']['llvm'] == build_cost.default().config['cpu_minutes']['llvm']
+    with open(path) as f:
+        assert '# cpu_minutes:' in f.read()
+
+
+def test_timeout_needs_measured_costs(tmp_path):
+    bc = build_cost.BuildCost()
+    assert bc.place('all', 'windows').timeout_in_minutes == 150
+    path = str(tmp_path / 'build_cost.yaml')
+    shutil.copy(build_cost.BuildCost.CONFIG_FILE, path)
+    build_cost_fit.write_config(path, {})
+    assert build_cost.BuildCost(path).place('all', 'windows').timeout_in_minutes > 150
+
+
+def test_read_builds_last_record_wins(tmp_path):
+    path = str(tmp_path / 'bklogs.jsonl')
+    with open(path, 'w') as f:
+        f.write(json.dumps({'number': 1, 'state': 'running', 'jobs': []}) + '\n')
+        f.write(json.dumps({'number': 1, 'state': 'passed', 'jobs': []}) + '\n')
+    assert [b['state'] for b in build_cost_fit.read_builds([path])] == ['passed']
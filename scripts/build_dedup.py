@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find an earlier build of the same change to reuse its results.
+
+Re-uploading an unchanged patch, or only editing the summary of a revision,
+starts a new build of exactly the same code. A build is identified by a key
+from its base commit, the patch, the projects and the configuration of the
+pipeline. pipeline_premerge.py stores the key as "ph_build_key" metadata of
+the build, and a later build with the same key reports the results of the
+earlier one instead of building again (see summary.py --build).
+"""
+
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import re
+from typing import Dict, Iterable, Optional
+
+from buildkite_utils import BuildkiteApi
+
+METADATA_KEY = 'ph_build_key'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ph_ variables that identify the build, not what is built.
+IGNORED_ENV = {
+    'ph_buildable_diff',
+    'ph_buildable_revision',
+    'ph_build_id',
+    'ph_target_phid',
+    'ph_user_project_slugs',
+    'ph_scripts_refspec',  # contents of the scripts are hashed instead
+    'ph_dry_run_report',
+    'ph_log_level',
+    'ph_skip_dedup',
+}
+
+# Builds in these states can be reused, newest first.
+FINISHED_STATES = ['passed', 'failed']
+RUNNING_STATES = ['scheduled', 'running']
+
+# Lines of `git diff` that do not change what is built.
+_VOLATILE_LINE = re.compile(r'^index [0-9a-f]+\.\.[0-9a-f]+')
+_HUNK_CONTEXT = re.compile(r'^(@@ [^@]+ @@).*')
+
+
+def normalize_patch(patch: str) -> str:
+    """Patch without blob hashes and hunk function context."""
+    lines = []
+    for line in patch.splitlines():
+        if _VOLATILE_LINE.match(line):
+            continue
+        lines.append(_HUNK_CONTEXT.sub(r'\1', line))
+    return '\n'.join(lines)
+
+
+def config_hash(env: Dict[str, str], script_dir: str = SCRIPT_DIR) -> str:
+    """Hash of the pipeline scripts and of the ph_ variables that change the build."""
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(script_dir, '*'))):
+        if not path.endswith(('.py', '.yaml', '.sh', '.ps1', '.ignore')):
+            continue
+        h.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as f:
+            h.update(f.read() + b'\0')
+    for k in sorted(env):
+        if k.startswith('ph_') and k not in IGNORED_ENV:
+            h.update(f'{k}={env[k]}\0'.encode())
+    return h.hexdigest()
+
+
+def build_key(base_commit: str, patch: str, projects: Iterable[str], env: Dict[str, str]) -> str:
+    h = hashlib.sha256()
+    h.update(f'base {base_commit}\n'.encode())
+    h.update(f'patch {hashlib.sha256(normalize_patch(patch).encode()).hexdigest()}\n'.encode())
+    h.update(f'projects {";".join(sorted(set(projects)))}\n'.encode())
+    h.update(f'config {config_hash(env)}\n'.encode())
+    return h.hexdigest()
+
+
+def find_build(bk: BuildkiteApi, pipeline: str, key: str, diff_id: str, build_number: str) -> Optional[Dict]:
+    """Finished or running build with the key, finished ones are preferred.
+
+    Builds of the same diff are skipped: restarting a build in Harbormaster must
+    build again, e.g. to retry a flaky test."""
+    for states in (FINISHED_STATES, RUNNING_STATES):
+        for b in bk.list_builds_with_metadata(pipeline, METADATA_KEY, key, states):
+            if str(b.get('number')) == str(build_number):
+                continue
+            if (b.get('meta_data') or {}).get('ph_buildable_diff') == diff_id:
+                continue
+            return b
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the dedup key of the last commit in the current repository.')
+    parser.add_argument('projects', type=str, help='projects separated by ";"')
+    parser.add_argument('--log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
+    import git
+    repo = git.Repo('.')
+    print(build_key(repo.head.commit.parents[0].hexsha, repo.git.diff('HEAD~1'), args.projects.split(';'),
+                    dict(os.environ)))
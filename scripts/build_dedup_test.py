@@ -0,0 +1,67 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import build_dedup  # noqa: E402
+
+PATCH = """diff --git a/llvm/lib/a.cpp b/llvm/lib/a.cpp
+index 1111111..2222222 100644
+--- a/llvm/lib/a.cpp
++++ b/llvm/lib/a.cpp
+@@ -10,3 +10,3 @@ int main() {
+-  int x = 1;
++  int x = 2;
+"""
+
+
+def test_key_ignores_build_identity():
+    env = {'ph_buildable_diff': '1', 'ph_build_id': '10', 'ph_projects': 'detect'}
+    key = build_dedup.build_key('abc', PATCH, ['llvm', 'clang'], env)
+    other = {'ph_buildable_diff': '2', 'ph_build_id': '20', 'ph_projects': 'detect'}
+    assert build_dedup.build_key('abc', PATCH, ['clang', 'llvm'], other) == key
+    reformatted = PATCH.replace('index 1111111..2222222', 'index 3333333..4444444').replace(' int main() {', '')
+    assert build_dedup.build_key('abc', reformatted, ['llvm', 'clang'], env) == key
+
+
+def test_key_changes_with_build():
+    env = {'ph_projects': 'detect'}
+    key = build_dedup.build_key('abc', PATCH, ['llvm'], env)
+    assert build_dedup.build_key('abd', PATCH, ['llvm'], env) != key
+    assert build_dedup.build_key('abc', PATCH.replace('x = 2', 'x = 3'), ['llvm'], env) != key
+    assert build_dedup.build_key('abc', PATCH, ['llvm', 'clang'], env) != key
+    assert build_dedup.build_key('abc', PATCH, ['llvm'], {'ph_projects': 'llvm'}) != key
+
+
+class FakeBuildkite:
+    def __init__(self, builds):
+        self.builds = builds
+
+    def list_builds_with_metadata(self, pipeline, key, value, states):
+        return [b for b in self.builds if b['state'] in states and b['meta_data'].get(key) == value]
+
+
+def test_find_build():
+    def build(number, state, diff):
+        return {'number': number, 'state': state, 'meta_data': {'ph_build_key': 'k', 'ph_buildable_diff': diff}}
+
+    bk = FakeBuildkite([build(5, 'running', '2'), build(4, 'failed', '1'), build(3, 'canceled', '2'),
+                        build(6, 'running', '3')])
+    # finished builds first, builds of the same diff are restarts and not reused
+    assert build_dedup.find_build(bk, 'p', 'k', '3', '6')['number'] == 4
+    assert build_dedup.find_build(bk, 'p', 'k', '1', '6')['number'] == 5
+    assert build_dedup.find_build(bk, 'p', 'other', '3', '6') is None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Copyright 2021 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compressed build logs with an index of the errors in them.
+#
+# BuildLog is passed as log_file to exec_utils.OutputSink: the output is
+# compressed as it streams by and lines that look like errors are recorded
+# with their offset in the uncompressed log and a few lines of context. The
+# index is written next to the log as <log>.errors.json, so reports can show
+# what failed without downloading the full log.
+
+import argparse
+import gzip
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+# ninja "FAILED: <target>", lit "FAIL: <suite> :: <test>" and compiler diagnostics.
+ERROR_RE = re.compile(rb'^(?:FAILED: .*|FAIL: .*|.*?\b(?:fatal )?error: .*)$', re.MULTILINE)
+# Number of lines after an error line that are kept in the index.
+SNIPPET_LINES = 20
+# Only the first errors get a snippet, the others are counted.
+MAX_ENTRIES = 100
+# Maximum length of a line in a snippet.
+MAX_LINE_LENGTH = 500
+
+
+def _kind(line: bytes) -> str:
+    if line.startswith(b'FAILED: '):
+        return 'ninja'
+    if line.startswith(b'FAIL: '):
+        return 'lit'
+    return 'compiler'
+
+
+def _decode(line: bytes) -> str:
+    return line[:MAX_LINE_LENGTH].decode('utf-8', errors='replace').rstrip('\r\n')
+
+
+def _open_compressed(path: str):
+    if path.endswith('.zst'):
+        # optional, gzip is used unless zstd is explicitly asked for
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return gzip.open(path, 'wb', compresslevel=6)
+
+
+class BuildLog:
+    """Write-only compressed log file that indexes errors on the fly.
+
+    Chunks that contain neither "FAIL" nor "error:" are only compressed, so
+    the index costs next to nothing for the bulk of a build log."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + '.errors.json'
+        self._file = _open_compressed(path)
+        # offset of the first byte of _partial in the uncompressed log
+        self._offset = 0
+        self._partial = b''
+        self.counts = {'ninja': 0, 'lit': 0, 'compiler': 0}  # type: Dict[str, int]
+        self.entries = []  # type: List[Dict]
+        # entries that still collect lines for their snippet
+        self._pending = []  # type: List[Dict]
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        data = self._partial + chunk
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        if end > 0:
+            self._index(data[:end])
+            self._offset += end
+
+    def _index(self, data: bytes):
+        if self._pending:
+            self._add_context(data)
+        if b'FAIL' not in data and b'error:' not in data:
+            return
+        for match in ERROR_RE.finditer(data):
+            line = match.group(0)
+            kind = _kind(line)
+            self.counts[kind] += 1
+            if len(self.entries) >= MAX_ENTRIES:
+                continue
+            entry = {
+                'kind': kind,
+                'offset': self._offset + match.start(),
+                'line': _decode(line),
+                'context': [],
+            }
+            self.entries.append(entry)
+            self._pending.append(entry)
+            self._add_context(data[match.end() + 1:], [entry])
+
+    def _add_context(self, data: bytes, entries: Optional[List[Dict]] = None):
+        """Append the lines of data to the snippets of entries (default: all pending)."""
+        if entries is None:
+            entries = list(self._pending)
+        lines = data.split(b'\n', SNIPPET_LINES)[:SNIPPET_LINES]
+        if lines and lines[-1] == b'':
+            lines.pop()
+        for entry in entries:
+            for line in lines:
+                # the next ninja progress line or failure ends the snippet
+                if len(entry['context']) >= SNIPPET_LINES or line.startswith((b'[', b'FAILED: ', b'FAIL: ')):
+                    self._pending.remove(entry)
+                    break
+                entry['context'].append(_decode(line))
+
+    def close(self):
+        if self._partial:
+            self._index(self._partial + b'\n')
+            self._offset += len(self._partial)
+            self._partial = b''
+        self._file.close()
+        with open(self.index_path, 'w') as index_file:
+            json.dump({
+                'log': os.path.basename(self.path),
+                'size': self._offset,
+                'counts': self.counts,
+                'entries': self.entries,
+            }, index_file, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_index(content: bytes) -> Dict:
+    return json.loads(content)
+
+
+def format_errors(index: Dict, limit: int = 10) -> str:
+    """Format the first errors of an index as plain text, most useful first.
+
+    ninja failures include the compiler output, so compiler errors are only
+    shown if there are no ninja failures; lit failures are reported on their own."""
+    entries = index.get('entries', [])
+    ninja = [e for e in entries if e['kind'] == 'ninja']
+    lit = [e for e in entries if e['kind'] == 'lit']
+    selected = (ninja or [e for e in entries if e['kind'] == 'compiler']) + lit
+    parts = []
+    for e in selected[:limit]:
+        parts.append('\n'.join([e['line']] + e['context']))
+    counts = index.get('counts', {})
+    if len(selected) > limit or len(entries) < sum(counts.values()):
+        parts.append(f'... in total {counts.get("ninja", 0)} failed build steps, '
+                     f'{counts.get("lit", 0)} failed tests, {counts.get("compiler", 0)} compiler errors')
+    return '\n\n'.join(parts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the errors from the index of a build log')
+    parser.add_argument('index', help='<log>.errors.json file')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    with open(args.index, 'rb') as f:
+        print(format_errors(load_index(f.read()), args.limit))
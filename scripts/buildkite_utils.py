@@ -3,11 +3,9 @@ import os
 import re
 import subprocess
 import urllib.parse
-from typing import Optional
-from benedict import benedict
+from typing import List, Optional
 
-import backoff
-import requests
+from phabtalk.phabtalk import retry
 
 context_style = {}
 previous_context = 'default'
@@ -76,13 +74,26 @@ class BuildkiteApi:
 
     def get_build(self, pipeline: str, build_number: str):
         # https://buildkite.com/docs/apis/rest-api/builds#get-a-build
+        # benedict and requests are imported where they are used, they are slow to
+        # import and most scripts only use the buildkite-agent helpers above.
+        from benedict import benedict
         return benedict(self.get(f'https://api.buildkite.com/v2/organizations/{self.organization}/pipelines/{pipeline}/builds/{build_number}').json())
 
     def list_running_revision_builds(self, pipeline: str, rev: str):
         return self.get(f'https://api.buildkite.com/v2/organizations/{self.organization}/pipelines/{pipeline}/builds?state[]=scheduled&state[]=running&meta_data[ph_buildable_revision]={rev}').json()
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3, logger='', factor=3)
+    def list_builds_with_metadata(self, pipeline: str, key: str, value: str, states: List[str]):
+        # https://buildkite.com/docs/apis/rest-api/builds#list-builds-for-a-pipeline
+        state = ''.join(f'&state[]={s}' for s in states)
+        return self.get(f'https://api.buildkite.com/v2/organizations/{self.organization}/pipelines/{pipeline}/builds?meta_data[{key}]={urllib.parse.quote(value)}{state}').json()
+
+    def list_passed_builds(self, pipeline: str, branch: str, count: int):
+        """Newest passed builds of the branch."""
+        return self.get(f'https://api.buildkite.com/v2/organizations/{self.organization}/pipelines/{pipeline}/builds?state=passed&branch={urllib.parse.quote(branch)}&per_page={count}').json()
+
+    @retry(max_tries=3)
     def get(self, url: str):
+        import requests
         authorization = f'Bearer {self.token}'
         response = requests.get(url, allow_redirects=True, headers={'Authorization': authorization})
         if response.status_code != 200:
@@ -91,6 +102,8 @@ class BuildkiteApi:
 
     # cancel a build. 'build' is a json object returned by API.
     def cancel_build(self, build):
+        from benedict import benedict
+        import requests
         build = benedict(build)
         url = f'https://api.buildkite.com/v2/organizations/{self.organization}/pipelines/{build.get("pipeline.slug")}/builds/{build.get("number")}/cancel'
         authorization = f'Bearer {self.token}'
@@ -18,7 +18,7 @@ import logging
 import os
 import re
 import subprocess
-from typing import Optional
+from typing import Optional, Tuple
 import pathspec
 
 import ignore_diff
@@ -26,33 +26,13 @@ from buildkite_utils import annotate
 from phabtalk.phabtalk import Report, Step
 
 
-def run(base_commit, ignore_config, step: Optional[Step], report: Optional[Report]):
-    """Apply clang-tidy and return if no issues were found."""
-    if report is None:
-        report = Report()  # For debugging.
-    if step is None:
-        step = Step()  # For debugging.
-    r = subprocess.run(f'git diff -U0 --no-prefix {base_commit}', shell=True, capture_output=True)
-    logging.debug(f'git diff {r}')
-    diff = r.stdout.decode("utf-8", "replace")
-    if ignore_config is not None and os.path.exists(ignore_config):
-        ignore = pathspec.PathSpec.from_lines(pathspec.patterns.GitWildMatchPattern,
-                                              open(ignore_config, 'r').readlines())
-        diff = ignore_diff.remove_ignored(diff.splitlines(keepends=True), open(ignore_config, 'r'))
-        logging.debug(f'filtered diff: {diff}')
-    else:
-        ignore = pathspec.PathSpec.from_lines(pathspec.patterns.GitWildMatchPattern, [])
-    p = subprocess.Popen(['clang-tidy-diff', '-p0', '-quiet'], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    step.reproduce_commands.append(f'git diff -U0 --no-prefix {base_commit} | clang-tidy-diff -p0')
-    a = ''.join(diff)
-    logging.info(f'clang-tidy input: {a}')
-    out = p.communicate(input=a.encode())[0].decode()
-    logging.debug(f'clang-tidy-diff {p}: {out}')
+def parse_output(out: str, ignore: pathspec.PathSpec, report: Report) -> Tuple[int, int, int]:
+    """Add the findings of clang-tidy to the report as lint messages.
+
+    Returns number of errors, warnings and lint messages added."""
     # Typical finding looks like:
     # [cwd/]clang/include/clang/AST/DeclCXX.h:3058:20: error: ... [clang-diagnostic-error]
     pattern = '^([^:]*):(\\d+):(\\d+): (.*): (.*)'
-    add_artifact = False
     logging.debug("cwd", os.getcwd())
     errors_count = 0
     warn_count = 0
@@ -63,7 +43,6 @@ def run(base_commit, ignore_config, step: Optional[Step], report: Optional[Repor
         logging.debug(line)
         if len(line) == 0 or line == 'No relevant changes found.':
             continue
-        add_artifact = True
         match = re.search(pattern, line)
         if match:
             file_name = match.group(1)
@@ -93,6 +72,34 @@ def run(base_commit, ignore_config, step: Optional[Step], report: Optional[Repor
                     })
         else:
             logging.debug('does not match pattern')
+    return errors_count, warn_count, inline_comments
+
+
+def run(base_commit, ignore_config, step: Optional[Step], report: Optional[Report]):
+    """Apply clang-tidy and return if no issues were found."""
+    if report is None:
+        report = Report()  # For debugging.
+    if step is None:
+        step = Step()  # For debugging.
+    r = subprocess.run(f'git diff -U0 --no-prefix {base_commit}', shell=True, capture_output=True)
+    logging.debug(f'git diff {r}')
+    diff = r.stdout.decode("utf-8", "replace")
+    if ignore_config is not None and os.path.exists(ignore_config):
+        ignore = pathspec.PathSpec.from_lines(pathspec.patterns.GitWildMatchPattern,
+                                              open(ignore_config, 'r').readlines())
+        diff = ignore_diff.remove_ignored(diff.splitlines(keepends=True), open(ignore_config, 'r'))
+        logging.debug(f'filtered diff: {diff}')
+    else:
+        ignore = pathspec.PathSpec.from_lines(pathspec.patterns.GitWildMatchPattern, [])
+    p = subprocess.Popen(['clang-tidy-diff', '-p0', '-quiet'], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    step.reproduce_commands.append(f'git diff -U0 --no-prefix {base_commit} | clang-tidy-diff -p0')
+    a = ''.join(diff)
+    logging.info(f'clang-tidy input: {a}')
+    out = p.communicate(input=a.encode())[0].decode()
+    logging.debug(f'clang-tidy-diff {p}: {out}')
+    errors_count, warn_count, inline_comments = parse_output(out, ignore, report)
+    add_artifact = len(out.strip()) > 0 and out.strip() != 'No relevant changes found.'
     if add_artifact:
         p = 'clang-tidy.txt'
         with open(p, 'w') as f:
@@ -16,56 +16,89 @@
 """The script will delete old git branches."""
 
 import argparse
+import concurrent.futures
 import datetime
-import functools
 import git
-import operator
 import os
 import re
 import sys
-from typing import List
+from typing import List, Optional, Tuple
+
+
+# Number of branches deleted by one `git push` and number of pushes running at the same time.
+BATCH_SIZE = 300
+JOBS = 4
 
 
 def delete_old_branches(repo_path: str, max_age: datetime.datetime, branch_patterns: List[re.Pattern],
-                        *, dry_run: bool = True, remote_name: str = 'origin') -> bool:
+                        *, dry_run: bool = True, remote_name: str = 'origin', batch_size: int = BATCH_SIZE,
+                        jobs: int = JOBS) -> bool:
     """Deletes 'old' branches from a git repo.
 
     This script assumes that $repo_path contains a current checkout of the repository ot be cleaned up.
     :retrun True IFF branches could be deleted successfully.
     """
     repo = git.Repo(repo_path)
-    remote = repo.remote(name=remote_name)
-    repo.git.fetch('--prune')
-    refs = remote.refs
-    print('Found {} branches at {} in total.'.format(len(refs), remote_name))
-    del_count = 0
-    fail_count = 0
+    repo.git.fetch('--prune', remote_name)
+    branches = _list_branches(repo, remote_name)
+    print('Found {} branches at {} in total.'.format(len(branches), remote_name))
+    pattern = _combine_patterns(branch_patterns)
+    max_timestamp = max_age.timestamp()
+    old = [b for b, committed in branches
+           if committed < max_timestamp and pattern is not None and pattern.search(f'{remote_name}/{b}')]
     if dry_run:
         print('DRY RUN. NO BRANCHES WILL BE DELETED', flush=True)
-    print('Deleting: \n', flush=True)
-    for reference in refs:
-        committed_date = datetime.datetime.fromtimestamp(reference.commit.committed_date)
-        if committed_date < max_age and _has_pattern_match(reference.name, branch_patterns):
-            print(reference.name, flush=True)
-            if not dry_run:
-                try:
-                    remote.push(refspec=':{}'.format(reference.remote_head))
-                    del_count += 1
-                except git.GitCommandError as err:
-                    print('ERROR: Failed to delete "{}": {}'.format(reference.name, err), flush=True)
-                    fail_count += 1
+    print('Deleting: \n')
+    print('\n'.join(f'{remote_name}/{b}' for b in old), flush=True)
+    if dry_run:
+        return True
+    del_count = 0
+    fail_count = 0
+    batches = [old[i:i + batch_size] for i in range(0, len(old), batch_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for deleted, failed in executor.map(lambda batch: _push_deletes(repo, remote_name, batch), batches):
+            del_count += deleted
+            fail_count += failed
     print('Deleted {} branches.'.format(del_count))
     if fail_count > 0:
         print('Failed to delete {} branches.'.format(fail_count))
     return fail_count == 0
 
 
-def _has_pattern_match(name: str, patterns) -> bool:
-    """Check if name matches any of the patterns"""
-    return functools.reduce(
-        operator.or_,
-        map(lambda r: r.search(name) is not None, patterns),
-        False)
+def _list_branches(repo: git.Repo, remote_name: str) -> List[Tuple[str, int]]:
+    """(branch, commit timestamp) of all branches of the remote, with a single git call."""
+    prefix = f'refs/remotes/{remote_name}/'
+    out = repo.git.for_each_ref('--format=%(refname)%00%(committerdate:unix)', prefix)
+    branches = []
+    for line in out.splitlines():
+        ref, _, committed = line.partition('\0')
+        branch = ref[len(prefix):]
+        if branch == 'HEAD' or not committed:
+            continue
+        branches.append((branch, int(committed)))
+    return branches
+
+
+def _combine_patterns(patterns: List[re.Pattern]) -> Optional[re.Pattern]:
+    """One regex that matches if any of the patterns does, None if there are no patterns."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{p.pattern})' for p in patterns))
+
+
+def _push_deletes(repo: git.Repo, remote_name: str, branches: List[str]) -> Tuple[int, int]:
+    """Delete the branches on the remote with one push, returns the number of deleted and failed ones."""
+    status, out, err = repo.git.push('--porcelain', remote_name, *[f':refs/heads/{b}' for b in branches],
+                                     with_extended_output=True, with_exceptions=False)
+    # porcelain output has a line per ref, "-" is a deleted ref and "!" a rejected one
+    deleted = sum(1 for line in out.splitlines() if line.startswith('-\t'))
+    rejected = [line for line in out.splitlines() if line.startswith('!\t')]
+    for line in rejected:
+        print('ERROR: Failed to delete: {}'.format(line[2:]), flush=True)
+    failed = len(branches) - deleted
+    if status != 0 and len(rejected) == 0:
+        print('ERROR: Failed to delete {} branches: {}'.format(failed, err), flush=True)
+    return deleted, failed
 
 
 if __name__ == '__main__':
@@ -74,12 +107,15 @@ if __name__ == '__main__':
     parser.add_argument('--days', type=int, default=30)
     parser.add_argument('--pattern', action='append', type=str)
     parser.add_argument('--dryrun', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='branches deleted by one push')
+    parser.add_argument('--jobs', type=int, default=JOBS, help='pushes running at the same time')
     args = parser.parse_args()
 
     max_age = datetime.datetime.now() - datetime.timedelta(days=args.days)
     branch_pattern = [re.compile(r) for r in args.pattern]
 
-    success = delete_old_branches(args.repo_path, max_age, branch_pattern, dry_run=args.dryrun)
+    success = delete_old_branches(args.repo_path, max_age, branch_pattern, dry_run=args.dryrun,
+                                  batch_size=args.batch_size, jobs=args.jobs)
 
     if not success:
         sys.exit(1)
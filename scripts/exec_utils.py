@@ -15,11 +15,69 @@
 import asyncio
 import logging
 import os
+import signal
+import sys
 from asyncio.subprocess import PIPE
-from typing import Callable, AnyStr
+from typing import BinaryIO, Callable, AnyStr, List, Optional, Tuple
+
+# Size of the reads from the process output.
+CHUNK_SIZE = 256 * 1024
+
+_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+
+class OutputSink:
+    """Fast destination for the output of a process.
+
+    Chunks of output are written straight to a file descriptor and, in the same
+    pass, to an optional log file. Lines are only split if `on_line` is set,
+    and only for chunks that contain `line_filter` (if given), so the common
+    case never runs Python code per line.
+    """
+
+    def __init__(self, fd: int, log_file: Optional[BinaryIO] = None,
+                 on_line: Optional[Callable[[bytes], None]] = None, line_filter: Optional[bytes] = None):
+        self.fd = fd
+        self.log_file = log_file
+        self.on_line = on_line
+        self.line_filter = line_filter
+        self._partial = b''
+
+    def write(self, chunk: bytes):
+        view = memoryview(chunk)
+        while len(view) > 0:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        if self.log_file is not None:
+            self.log_file.write(chunk)
+        if self.on_line is None:
+            return
+        data = self._partial + chunk
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        if self.line_filter is not None and self.line_filter not in data[:end]:
+            return
+        for line in data[:end].splitlines(keepends=True):
+            if self.line_filter is None or self.line_filter in line:
+                self.on_line(line)
+
+    def close(self):
+        """Pass the last line to `on_line` if it had no line break."""
+        if self.on_line is not None and self._partial:
+            if self.line_filter is None or self.line_filter in self._partial:
+                self.on_line(self._partial)
+        self._partial = b''
 
 
 async def read_stream_and_display(stream, display):
+    if isinstance(display, OutputSink):
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            display.write(chunk)
+        display.close()
+        return
     while True:
         line = await stream.readline()
         if not line:
@@ -27,15 +85,34 @@ async def read_stream_and_display(stream, display):
         display(line)  # assume it doesn't block
 
 
-async def read_and_display(write_stdout, write_stderr, *cmd, **kwargs):
+def _kill(process, group: bool):
+    """Kill the shell and, if it has its own process group, the commands started by it."""
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def read_and_display(write_stdout, write_stderr, *cmd, timeout: Optional[float] = None, **kwargs):
+    """Run the shell command, the command is killed if it takes longer than timeout seconds."""
     logging.debug(f'subprocess called with {cmd}; {kwargs}')
-    process = await asyncio.create_subprocess_shell(*cmd, stdout=PIPE, stderr=PIPE, **kwargs)
+    if timeout is not None and os.name != 'nt':
+        # Own process group, to kill the whole command on timeout. Only then, as
+        # otherwise signals to our group (e.g. cancelled job) must reach the command.
+        kwargs.setdefault('start_new_session', True)
+    process = await asyncio.create_subprocess_shell(*cmd, stdout=PIPE, stderr=PIPE, limit=CHUNK_SIZE, **kwargs)
     try:
-        await asyncio.gather(
+        await asyncio.wait_for(asyncio.gather(
             read_stream_and_display(process.stdout, write_stdout),
-            read_stream_and_display(process.stderr, write_stderr))
+            read_stream_and_display(process.stderr, write_stderr)), timeout)
+    except asyncio.TimeoutError:
+        logging.error(f'{cmd} did not finish in {timeout} seconds, killing it')
+        _kill(process, kwargs.get('start_new_session', False))
     except Exception:
-        process.kill()
+        _kill(process, kwargs.get('start_new_session', False))
         raise
     finally:
         return await process.wait()
@@ -54,11 +131,38 @@ def if_not_matches(s: AnyStr, regexp, write: Callable[[AnyStr], None]):
         write(s)
 
 
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Event loop shared by all calls to watch_shell."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        if os.name == 'nt':
+            _loop = asyncio.ProactorEventLoop()  # Windows
+        else:
+            _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
 def watch_shell(write_stdout, write_stderr, *cmd, **kwargs):
-    if os.name == 'nt':
-        loop = asyncio.ProactorEventLoop()  # Windows
-        asyncio.set_event_loop(loop)
-    else:
-        loop = asyncio.get_event_loop()
-    rc = loop.run_until_complete(read_and_display(write_stdout, write_stderr, *cmd, **kwargs))
+    """Run a shell command and pass its output to write_stdout / write_stderr.
+
+    Callables are called once per line. OutputSink objects get the output in
+    large chunks, use them for commands with a lot of output."""
+    if isinstance(write_stdout, OutputSink) or isinstance(write_stderr, OutputSink):
+        # OutputSink writes to the file descriptors directly.
+        sys.stdout.flush()
+        sys.stderr.flush()
+    rc = _get_loop().run_until_complete(read_and_display(write_stdout, write_stderr, *cmd, **kwargs))
     return rc
+
+
+def watch_shells(commands: List[Tuple[Callable, Callable, str]], timeout: Optional[float] = None,
+                 **kwargs) -> List[int]:
+    """Run (write_stdout, write_stderr, command) shell commands concurrently, see watch_shell.
+
+    Returns the exit codes in the order of the commands, a command that took
+    longer than timeout seconds is killed."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return _get_loop().run_until_complete(asyncio.gather(
+        *[read_and_display(out, err, cmd, timeout=timeout, **kwargs) for out, err, cmd in commands]))
@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import git
+import json
 import os
 import logging
+from typing import Dict
 
 """URL of upstream LLVM repository."""
 LLVM_GITHUB_URL = 'ssh://git@github.com/llvm/llvm-project'
@@ -52,7 +54,41 @@ def syncLlvmFork(repo: git.Repo):
   syncRemotes(repo, 'upstream', 'origin')
   pass
 
+def lsRemoteHeads(repo: git.Repo, remote: str) -> Dict[str, str]:
+  """branch -> commit of all branches of the remote, with a single round trip"""
+  heads = {}
+  for line in repo.git.ls_remote('--heads', remote).splitlines():
+    sha, _, ref = line.partition('\t')
+    heads[ref[len('refs/heads/'):]] = sha
+  return heads
+
+def _syncStatePath(repo: git.Repo, fromRemote, toRemote) -> str:
+  return os.path.join(repo.git_dir, f'sync-{fromRemote}-{toRemote}.json')
+
 def syncRemotes(repo: git.Repo, fromRemote, toRemote):
-  """sync one remote from another"""
-  repo.remotes[fromRemote].fetch()
-  repo.git.push(toRemote, '-f', f'refs/remotes/{fromRemote}/*:refs/heads/*')
+  """sync one remote from another
+
+  Only branches that differ are fetched and pushed, in one batch. Branch heads
+  of fromRemote after the last sync are kept in a file in the .git directory,
+  if they didn't change nothing else is done. Branches that were only changed
+  in toRemote are therefore reset on the next change in fromRemote.
+  """
+  statePath = _syncStatePath(repo, fromRemote, toRemote)
+  fromHeads = lsRemoteHeads(repo, fromRemote)
+  try:
+    with open(statePath) as f:
+      if json.load(f) == fromHeads:
+        logging.info(f'{fromRemote} did not change since the last sync')
+        return
+  except (OSError, ValueError):
+    pass
+  toHeads = lsRemoteHeads(repo, toRemote)
+  changed = sorted(b for b, sha in fromHeads.items() if toHeads.get(b) != sha)
+  logging.info(f'{len(changed)} of {len(fromHeads)} branches changed: {", ".join(changed[:20])}')
+  if changed:
+    repo.git.fetch(fromRemote, *[f'+refs/heads/{b}:refs/remotes/{fromRemote}/{b}' for b in changed])
+    repo.git.push(toRemote, '-f', *[f'refs/remotes/{fromRemote}/{b}:refs/heads/{b}' for b in changed])
+  tmpPath = f'{statePath}.{os.getpid()}'
+  with open(tmpPath, 'w') as f:
+    json.dump(fromHeads, f)
+  os.replace(tmpPath, statePath)
@@ -103,7 +103,38 @@ def test_sync_branches(tmp_path):
     assert os.path.isfile(os.path.join(fork.working_tree_dir, '5'))
     git_utils.syncRemotes(fork, 'upstream', 'origin')
     assertForkIsSynced(upstreamRemote, forkRemote)
-    fork.git.pull('origin', 'main')
     fork.heads.main.checkout()
+    fork.remotes.origin.fetch()
+    fork.git.reset('--hard', 'origin/main')
     assert not os.path.isfile(os.path.join(fork.working_tree_dir, '5'))
     assert os.path.isfile(os.path.join(fork.working_tree_dir, '6'))
+
+def test_sync_skips_unchanged_upstream(tmp_path):
+    upstreamRemote = os.path.join(tmp_path, 'upstreamBare')
+    forkRemote = os.path.join(tmp_path, 'forkBare')
+    git.Repo.init(path=upstreamRemote, bare=True)
+    git.Repo.init(path=forkRemote, bare=True)
+    upstream = git.Repo.clone_from(url=upstreamRemote, to_path=os.path.join(tmp_path, 'upstream'))
+    add_simple_commit(upstream, '1')
+    upstream.git.push('origin', 'HEAD:main', 'HEAD:branch1')
+    fork = git.Repo.clone_from(url=forkRemote, to_path=os.path.join(tmp_path, 'fork'))
+    fork.create_remote('upstream', url=upstreamRemote)
+    git_utils.syncRemotes(fork, 'upstream', 'origin')
+    assertForkIsSynced(upstreamRemote, forkRemote)
+    assert git_utils.lsRemoteHeads(fork, 'origin') == git_utils.lsRemoteHeads(fork, 'upstream')
+
+    # A change only in the fork is kept while upstream doesn't change.
+    fork.remotes.origin.fetch()
+    fork.create_head('main', fork.remotes.origin.refs.main)
+    fork.heads.main.checkout()
+    add_simple_commit(fork, '2')
+    fork.remotes.origin.push('main')
+    git_utils.syncRemotes(fork, 'upstream', 'origin')
+    assert not forkIsSynced(upstreamRemote, forkRemote)
+
+    # Any change upstream syncs all branches that differ.
+    upstream.heads.main.checkout()
+    add_simple_commit(upstream, '3')
+    upstream.git.push('origin', 'HEAD:branch1')
+    git_utils.syncRemotes(fork, 'upstream', 'origin')
+    assertForkIsSynced(upstreamRemote, forkRemote)
@@ -1,21 +1,44 @@
 #!/usr/bin/env python3
+import argparse
+import collections
 import logging
 import psycopg2
 import os
 import datetime
 import requests
-from typing import Optional, Dict, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib3.util.retry import Retry
 import json
 
 PHABRICATOR_URL = "https://reviews.llvm.org/api/"
 BUILDBOT_URL = "https://lab.llvm.org/buildbot/api/v2/"
 
+# number of ID windows requested in parallel
+REQUEST_WORKERS = 4
+# the window size is adapted so that a request takes about this long [s]
+TARGET_LATENCY = 2.0
+MIN_STEP = 100
+MAX_STEP = 20000
+# number of builds for which steps are requested in parallel
+STEP_WORKERS = 8
+
+
+def _create_session() -> requests.Session:
+    """Pooled session with retries, shared by all requests to buildbot."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_maxsize=2 * REQUEST_WORKERS,
+        max_retries=Retry(total=5, backoff_factor=3, status_forcelist=[500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-# TODO(kuhnel): retry on connection issues, maybe resuse
-# https://github.com/google/llvm-premerge-checks/blob/main/scripts/phabtalk/phabtalk.py#L44
 
-# TODO(kuhnel): Import the step data so we can figure out in which step a build fails
-# (e.g. compile vs. test)
+session = _create_session()
 
 
 def connect_to_db() -> psycopg2.extensions.connection:
@@ -44,7 +67,13 @@ def create_tables(conn: psycopg2.extensions.connection):
         ON buildbot_workers 
         (timestamp);"""
     )
-    # Note: step_data is not yet populated with data!
+    # supports the DISTINCT ON lookup of the latest row per worker
+    cur.execute(
+        """CREATE INDEX IF NOT EXISTS buildbot_worker_latest
+        ON buildbot_workers
+        (worker_id, timestamp DESC);"""
+    )
+    # Note: step_data is not used, steps are stored in buildbot_steps.
     cur.execute(
         """CREATE TABLE IF NOT EXISTS buildbot_builds (
             build_id integer PRIMARY KEY,
@@ -54,6 +83,40 @@ def create_tables(conn: psycopg2.extensions.connection):
             step_data jsonb
             );"""
     )
+    # used to join builds and buildrequests in buildbot_overview
+    cur.execute(
+        """CREATE INDEX IF NOT EXISTS buildbot_builds_buildrequest
+        ON buildbot_builds
+        ((CAST(build_data ->> 'buildrequestid' AS int)));"""
+    )
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS buildbot_step_names (
+            step_name_id serial PRIMARY KEY,
+            name text UNIQUE NOT NULL
+            );"""
+    )
+    # result is the buildbot result code: 0 success, 1 warnings, 2 failure,
+    # 3 skipped, 4 exception, 5 retry, 6 cancelled
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS buildbot_steps (
+            build_id integer NOT NULL,
+            step_number smallint NOT NULL,
+            builder_id integer NOT NULL,
+            step_name_id integer NOT NULL REFERENCES buildbot_step_names,
+            result smallint,
+            started_at timestamp,
+            complete_at timestamp,
+            duration real,
+            PRIMARY KEY (build_id, step_number)
+            );"""
+    )
+    # failing (failure or exception) steps per builder and day
+    cur.execute(
+        """CREATE INDEX IF NOT EXISTS buildbot_steps_failing
+        ON buildbot_steps
+        (builder_id, complete_at)
+        WHERE result IN (2, 4);"""
+    )
     cur.execute(
         """CREATE TABLE IF NOT EXISTS buildbot_buildsets (
             buildset_id integer PRIMARY KEY, 
@@ -67,6 +130,13 @@ def create_tables(conn: psycopg2.extensions.connection):
             data jsonb NOT NULL
             );"""
     )
+    # last id that was completely imported, per table
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS buildbot_checkpoints (
+            table_name text PRIMARY KEY,
+            last_id integer NOT NULL
+            );"""
+    )
     cur.execute(
         """CREATE TABLE IF NOT EXISTS buildbot_builders (
             builder_id integer PRIMARY KEY, 
@@ -78,123 +148,178 @@ def create_tables(conn: psycopg2.extensions.connection):
     conn.commit()
 
 
-def get_worker_status(
-        worker_id: int, conn: psycopg2.extensions.connection
-) -> Optional[Dict]:
-    """Note: postgres returns a dict for a stored json object."""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT data FROM buildbot_workers WHERE worker_id = %s ORDER BY timestamp DESC;",
-        [worker_id],
-    )
-    row = cur.fetchone()
-    if row is None:
-        return None
-    return row[0]
+def get_latest_workers(conn: psycopg2.extensions.connection) -> Dict[int, Dict]:
+    """Get the latest stored data of all workers in one query.
 
-
-def get_builder_status(
-        builder_id: int, conn: psycopg2.extensions.connection
-) -> Optional[Dict]:
-    """Note: postgres returns a dict for a stored json object."""
+    Note: postgres returns a dict for a stored json object."""
     cur = conn.cursor()
     cur.execute(
-        """SELECT data FROM buildbot_builders WHERE builder_id = %s 
-        ORDER BY timestamp DESC;""",
-        [builder_id],
+        """SELECT DISTINCT ON (worker_id) worker_id, data FROM buildbot_workers
+        ORDER BY worker_id, timestamp DESC;"""
     )
-    row = cur.fetchone()
-    if row is None:
-        return None
-    return row[0]
+    return {row[0]: row[1] for row in cur.fetchall()}
 
 
-def set_worker_status(
-        timestamp: datetime.datetime,
-        worker_id: int,
-        data: str,
-        conn: psycopg2.extensions.connection,
-):
+def get_builders(conn: psycopg2.extensions.connection) -> Dict[int, Dict]:
+    """Get the stored data of all builders.
+
+    Note: postgres returns a dict for a stored json object."""
     cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO buildbot_workers (timestamp, worker_id, data) 
-        values (%s,%s,%s);""",
-        (timestamp, worker_id, data),
-    )
+    cur.execute("SELECT builder_id, data FROM buildbot_builders;")
+    return {row[0]: row[1] for row in cur.fetchall()}
 
 
 def update_workers(conn: psycopg2.extensions.connection):
     logging.info("Updating worker status...")
-    response = requests.get(BUILDBOT_URL + "workers")
+    response = session.get(BUILDBOT_URL + "workers", timeout=60)
     timestamp = datetime.datetime.now()
-    for worker in response.json()["workers"]:
-        worker_id = worker["workerid"]
-        data = json.dumps(worker)
-        # TODO: It would be faster if request all worker info and cache it
-        # locally
-        old_data = get_worker_status(worker_id, conn)
-        # only update worker information if it has changed as this data is quite
-        # static
-        if old_data is None or worker != old_data:
-            set_worker_status(timestamp, worker_id, data, conn)
+    old_workers = get_latest_workers(conn)
+    # only store worker information if it has changed as this data is quite
+    # static
+    changed = [
+        worker
+        for worker in response.json()["workers"]
+        if old_workers.get(worker["workerid"]) != worker
+    ]
+    if len(changed) > 0:
+        cur = conn.cursor()
+        args_str = b",".join(
+            cur.mogrify(
+                b" (%s,%s,%s) ",
+                (timestamp, worker["workerid"], json.dumps(worker)),
+            )
+            for worker in changed
+        )
+        cur.execute(
+            b"INSERT INTO buildbot_workers (timestamp, worker_id, data) values "
+            + args_str
+        )
     conn.commit()
+    logging.info("{} workers changed".format(len(changed)))
 
 
 def update_builders(conn: psycopg2.extensions.connection):
     """get list of all builder ids."""
     logging.info("Updating builder status...")
-    response = requests.get(BUILDBOT_URL + "builders")
+    response = session.get(BUILDBOT_URL + "builders", timeout=60)
     timestamp = datetime.datetime.now()
-    for builder in response.json()["builders"]:
-        builder_id = builder["builderid"]
-        data = json.dumps(builder)
-        # TODO: It would be faster if request all builder info and cache it
-        # locally
-        old_data = get_builder_status(builder_id, conn)
-        # only update worker information if it has changed as this data is quite
-        # static
-        if old_data is None or builder != old_data:
-            set_worker_status(timestamp, builder_id, data, conn)
+    old_builders = get_builders(conn)
+    changed = [
+        builder
+        for builder in response.json()["builders"]
+        if old_builders.get(builder["builderid"]) != builder
+    ]
+    if len(changed) > 0:
+        cur = conn.cursor()
+        args_str = b",".join(
+            cur.mogrify(
+                b" (%s,%s,%s,%s) ",
+                (builder["builderid"], timestamp, builder["name"], json.dumps(builder)),
+            )
+            for builder in changed
+        )
+        # buildbot_builders only keeps the latest state of each builder
+        cur.execute(
+            b"INSERT INTO buildbot_builders (builder_id, timestamp, name, data) values "
+            + args_str
+            + b""" ON CONFLICT (builder_id) DO UPDATE SET
+            timestamp = EXCLUDED.timestamp, name = EXCLUDED.name, data = EXCLUDED.data;"""
+        )
     conn.commit()
+    logging.info("{} builders changed".format(len(changed)))
 
 
-def get_last_build(conn: psycopg2.extensions.connection) -> int:
-    """Get the latest build number for a builder.
+def get_checkpoint(conn: psycopg2.extensions.connection, table: str, id_column: str) -> int:
+    """Get the last id that was completely imported into a table.
 
-    This is used to only get new builds."""
+    Tables imported before checkpoints existed start at their maximum id."""
     cur = conn.cursor()
-    cur.execute("SELECT MAX(build_id) FROM buildbot_builds")
+    cur.execute("SELECT last_id FROM buildbot_checkpoints WHERE table_name = %s;", [table])
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+    cur.execute("SELECT MAX({}) FROM {};".format(id_column, table))
     row = cur.fetchone()
     if row is None or row[0] is None:
         return 0
     return row[0]
 
 
-def update_build_status(conn: psycopg2.extensions.connection):
-    start_id = get_last_build(conn)
-    logging.info("Updating build results, starting with {}...".format(start_id))
-    url = BUILDBOT_URL + "builds"
+def set_checkpoint(cur: psycopg2.extensions.cursor, table: str, last_id: int):
+    cur.execute(
+        """INSERT INTO buildbot_checkpoints (table_name, last_id) values (%s,%s)
+        ON CONFLICT (table_name) DO UPDATE SET last_id = EXCLUDED.last_id;""",
+        (table, last_id),
+    )
+
+
+def import_rest_data(
+        conn: psycopg2.extensions.connection,
+        table: str,
+        columns: List[str],
+        endpoint: str,
+        id_field_name: str,
+        to_row: Callable[[Dict], Tuple],
+):
+    """Incrementally copy all complete objects of a REST endpoint into a table.
+
+    The first column is the id column. Objects that are not complete yet are
+    skipped, and the checkpoint stays before the first of them so they are
+    fetched again on the next run. Inserting the same object twice is a no-op.
+    """
+    start_id = get_checkpoint(conn, table, columns[0])
+    logging.info("Getting {}, starting with {}...".format(endpoint, start_id))
     cur = conn.cursor()
-    for result_set in rest_request_iterator(url, "builds", "buildid", start_id=start_id):
-        args_str = b",".join(
-            cur.mogrify(
-                b" (%s,%s,%s,%s) ",
-                (
-                    build["buildid"],
-                    build["builderid"],
-                    build["number"],
-                    json.dumps(build, sort_keys=True),
-                ),
-            )
-            for build in result_set
-            if build["complete"]
-        )
-        cur.execute(
-            b"INSERT INTO buildbot_builds (build_id, builder_id, build_number, build_data) values "
-            + args_str
-        )
-        logging.info("last build id: {}".format(result_set[-1]["buildid"]))
+    template = " ({}) ".format(",".join(["%s"] * len(columns)))
+    sql_insert = "INSERT INTO {} ({}) values ".format(table, ", ".join(columns)).encode()
+    first_incomplete = None
+    for stop_id, result_set in rest_request_iterator(
+            BUILDBOT_URL + endpoint, endpoint, id_field_name, start_id=start_id
+    ):
+        complete = [o for o in result_set if o["complete"]]
+        if first_incomplete is None:
+            incomplete = [o[id_field_name] for o in result_set if not o["complete"]]
+            if len(incomplete) > 0:
+                first_incomplete = min(incomplete)
+        if len(complete) > 0:
+            # cur.mogrify returns a byte string, so we need to join on a byte string
+            args_str = b",".join(cur.mogrify(template, to_row(o)) for o in complete)
+            cur.execute(sql_insert + args_str + b" ON CONFLICT DO NOTHING;")
+        checkpoint = stop_id if first_incomplete is None else first_incomplete - 1
+        set_checkpoint(cur, table, checkpoint)
         conn.commit()
+        logging.info("{}: imported up to id {}".format(table, stop_id))
+
+
+def get_max_id(url: str, array_field_name: str, id_field_name: str) -> int:
+    """Get the highest id known to the buildbot master."""
+    response = session.get(
+        url, params={"order": "-" + id_field_name, "limit": 1}, timeout=60
+    )
+    response.raise_for_status()
+    results = response.json()[array_field_name]
+    if len(results) == 0:
+        return 0
+    return results[0][id_field_name]
+
+
+def _get_window(
+        url: str, array_field_name: str, id_field_name: str, start_id: int, stop_id: int
+) -> Tuple[List[Dict], float]:
+    start_time = time.monotonic()
+    response = session.get(
+        url,
+        params={
+            "{}__gt".format(id_field_name): start_id,
+            "{}__le".format(id_field_name): stop_id,
+        },
+        timeout=300,
+    )
+    if response.status_code != 200:
+        raise Exception(
+            "Got status code {} on request to {}".format(response.status_code, url)
+        )
+    return response.json()[array_field_name], time.monotonic() - start_time
 
 
 def rest_request_iterator(
@@ -203,120 +328,210 @@ def rest_request_iterator(
         id_field_name: str,
         start_id: int = 0,
         step: int = 1000,
+        workers: int = REQUEST_WORKERS,
 ):
     """Request paginated data from the buildbot master.
 
-    This returns a generator. Each call to it gives you shards of
-    <=limit results. This can be used to do a mass-SQL insert of data.
+    This returns a generator of (stop_id, results) tuples, where results are
+    all objects with start_id < id <= stop_id. This can be used to do a
+    mass-SQL insert of data.
 
     Limiting the range of the returned IDs causes Buildbot to sort the data.
-    This makes incremental imports much easier.
+    This makes incremental imports much easier. Several windows are requested
+    in parallel but yielded in order. The window size grows or shrinks
+    depending on how long the requests take. Iteration only stops at the
+    highest id on the server, so gaps in the ids are skipped.
     """
-    while True:
-        count = 0
-        stop_id = start_id + step
-        response = requests.get(
-            url
-            + "?{id_field_name}__gt={start_id}&{id_field_name}__le={stop_id}&".format(
-                **locals()
-            )
-        )
-        if response.status_code != 200:
-            raise Exception(
-                "Got status code {} on request to {}".format(response.status_code, url)
-            )
-        results = response.json()[array_field_name]
-        if len(results) == 0:
-            return
-        yield results
-        start_id = stop_id
+    max_id = get_max_id(url, array_field_name, id_field_name)
+    pending = collections.deque()
+    next_id = start_id
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while next_id < max_id or len(pending) > 0:
+            while next_id < max_id and len(pending) < workers:
+                stop_id = min(next_id + step, max_id)
+                pending.append(
+                    (stop_id, executor.submit(
+                        _get_window, url, array_field_name, id_field_name, next_id, stop_id))
+                )
+                next_id = stop_id
+            stop_id, future = pending.popleft()
+            results, latency = future.result()
+            if latency < TARGET_LATENCY / 2:
+                step = min(step * 2, MAX_STEP)
+            elif latency > TARGET_LATENCY:
+                step = max(step // 2, MIN_STEP)
+            yield stop_id, results
 
 
-def get_latest_buildset(conn: psycopg2.extensions.connection) -> int:
-    """Get the maximumg buildset id.
-
-    This is useful for incremental updates."""
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(buildset_id) from buildbot_buildsets;")
-    row = cur.fetchone()
-    if row[0] is None:
-        return 0
-    return row[0]
+def update_build_status(conn: psycopg2.extensions.connection):
+    import_rest_data(
+        conn,
+        "buildbot_builds",
+        ["build_id", "builder_id", "build_number", "build_data"],
+        "builds",
+        "buildid",
+        lambda build: (
+            build["buildid"],
+            build["builderid"],
+            build["number"],
+            json.dumps(build, sort_keys=True),
+        ),
+    )
 
 
 def update_buildsets(conn: psycopg2.extensions.connection):
-    start_id = get_latest_buildset(conn)
-    logging.info("Getting buildsets, starting with {}...".format(start_id))
-    url = BUILDBOT_URL + "buildsets"
-    cur = conn.cursor()
+    import_rest_data(
+        conn,
+        "buildbot_buildsets",
+        ["buildset_id", "data"],
+        "buildsets",
+        "bsid",
+        lambda buildset: (buildset["bsid"], json.dumps(buildset, sort_keys=True)),
+    )
 
-    for result_set in rest_request_iterator(
-            url, "buildsets", "bsid", start_id=start_id
-    ):
-        args_str = b",".join(
-            cur.mogrify(
-                b" (%s,%s) ",
-                (buildset["bsid"], json.dumps(buildset, sort_keys=True)),
-            )
-            for buildset in result_set
-            if buildset["complete"]
-        )
 
-        if len(args_str) == 0:
-            break
-        cur.execute(
-            b"INSERT INTO buildbot_buildsets (buildset_id, data) values " + args_str
-        )
-        logging.info("last id {}".format(result_set[-1]["bsid"]))
-        conn.commit()
+def update_buildrequests(conn: psycopg2.extensions.connection):
+    import_rest_data(
+        conn,
+        "buildbot_buildrequests",
+        ["buildrequest_id", "buildset_id", "data"],
+        "buildrequests",
+        "buildrequestid",
+        lambda buildrequest: (
+            buildrequest["buildrequestid"],
+            buildrequest["buildsetid"],
+            json.dumps(buildrequest),
+        ),
+    )
+
+
+def get_steps(build_id: int) -> List[Dict]:
+    response = session.get(BUILDBOT_URL + "builds/{}/steps".format(build_id), timeout=60)
+    response.raise_for_status()
+    return response.json()["steps"]
 
 
-def get_latest_buildrequest(conn: psycopg2.extensions.connection) -> int:
+def get_step_name_ids(cur: psycopg2.extensions.cursor, names: Set[str]) -> Dict[str, int]:
+    """Get the ids of step names, adding the missing ones to the lookup table."""
+    args_str = b",".join(cur.mogrify(" (%s) ", (name,)) for name in names)
+    cur.execute(
+        b"INSERT INTO buildbot_step_names (name) values "
+        + args_str
+        + b" ON CONFLICT (name) DO NOTHING;"
+    )
+    cur.execute(
+        "SELECT name, step_name_id FROM buildbot_step_names WHERE name = ANY(%s);",
+        (list(names),),
+    )
+    return dict(cur.fetchall())
+
+
+def _timestamp(value: Optional[int]) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value)
+
+
+def init_steps_checkpoint(conn: psycopg2.extensions.connection, all_builds: bool):
+    """Set where the step import starts if steps were never imported.
+
+    Steps are requested once per build, so by default only builds imported
+    after this point get their steps. With all_builds the steps of every
+    build in buildbot_builds are imported, which takes hours."""
     cur = conn.cursor()
-    cur.execute("SELECT MAX(buildrequest_id) from buildbot_buildrequests;")
-    row = cur.fetchone()
-    if row[0] is None:
-        return 0
-    return row[0]
+    cur.execute("SELECT last_id FROM buildbot_checkpoints WHERE table_name = 'buildbot_steps';")
+    if cur.fetchone() is not None:
+        return
+    start_id = 0 if all_builds else get_checkpoint(conn, "buildbot_builds", "build_id")
+    logging.info("Starting step import after build {}".format(start_id))
+    set_checkpoint(cur, "buildbot_steps", start_id)
+    conn.commit()
 
 
-def update_buildrequests(conn: psycopg2.extensions.connection):
-    start_id = get_latest_buildrequest(conn)
-    logging.info("Getting buildrequests, starting with {}...".format(start_id))
-    url = BUILDBOT_URL + "buildrequests"
+def update_steps(conn: psycopg2.extensions.connection, batch_size: int = 500):
+    """Import the steps of all builds imported since the last run.
+
+    Only builds up to the buildbot_builds checkpoint are considered, all
+    complete builds below it are already in the database."""
+    start_id = get_checkpoint(conn, "buildbot_steps", "build_id")
+    end_id = get_checkpoint(conn, "buildbot_builds", "build_id")
+    logging.info("Getting steps for builds {} to {}...".format(start_id, end_id))
     cur = conn.cursor()
-    for result_set in rest_request_iterator(
-            url, "buildrequests", "buildrequestid", start_id=start_id
-    ):
-        # cur.mogrify returns a byte string, so we need to join on a byte string
-        args_str = b",".join(
-            cur.mogrify(
-                " (%s,%s,%s) ",
-                (
-                    buildrequest["buildrequestid"],
-                    buildrequest["buildsetid"],
-                    json.dumps(buildrequest),
-                ),
+    name_ids = {}  # type: Dict[str, int]
+    with ThreadPoolExecutor(max_workers=STEP_WORKERS) as executor:
+        while True:
+            cur.execute(
+                """SELECT build_id, builder_id FROM buildbot_builds
+                WHERE build_id > %s AND build_id <= %s ORDER BY build_id LIMIT %s;""",
+                (start_id, end_id, batch_size),
             )
-            for buildrequest in result_set
-            if buildrequest["complete"]
-        )
-        if len(args_str) == 0:
-            break
-        cur.execute(
-            b"INSERT INTO buildbot_buildrequests (buildrequest_id, buildset_id, data) values "
-            + args_str
-        )
-        logging.info("{}".format(result_set[-1]["buildrequestid"]))
-        conn.commit()
+            builds = cur.fetchall()
+            if len(builds) == 0:
+                break
+            build_steps = list(executor.map(get_steps, [b[0] for b in builds]))
+            names = set(s["name"] for steps in build_steps for s in steps)
+            names.difference_update(name_ids.keys())
+            if len(names) > 0:
+                name_ids.update(get_step_name_ids(cur, names))
+            args_str = b",".join(
+                cur.mogrify(
+                    b" (%s,%s,%s,%s,%s,%s,%s,%s) ",
+                    (
+                        build_id,
+                        step["number"],
+                        builder_id,
+                        name_ids[step["name"]],
+                        step["results"],
+                        _timestamp(step["started_at"]),
+                        _timestamp(step["complete_at"]),
+                        None
+                        if step["started_at"] is None or step["complete_at"] is None
+                        else step["complete_at"] - step["started_at"],
+                    ),
+                )
+                for (build_id, builder_id), steps in zip(builds, build_steps)
+                for step in steps
+            )
+            if len(args_str) > 0:
+                cur.execute(
+                    b"""INSERT INTO buildbot_steps (build_id, step_number, builder_id, step_name_id,
+                    result, started_at, complete_at, duration) values """
+                    + args_str
+                    + b" ON CONFLICT DO NOTHING;"
+                )
+            start_id = builds[-1][0]
+            set_checkpoint(cur, "buildbot_steps", start_id)
+            conn.commit()
+            logging.info("steps imported up to build {}".format(start_id))
+
+
+def _run_with_connection(update_function: Callable[[psycopg2.extensions.connection], None]):
+    conn = connect_to_db()
+    try:
+        update_function(conn)
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Copy the buildbot state into the database')
+    parser.add_argument('--all-steps', action='store_true',
+                        help='on the first step import, fetch the steps of all builds already in the '
+                             'database instead of only the new ones; this takes hours')
+    args = parser.parse_args()
     logging.basicConfig(level='INFO', format='%(levelname)-7s %(message)s')
     conn = connect_to_db()
     create_tables(conn)
+    # before the builds are imported, so a first run only fetches steps of new builds
+    init_steps_checkpoint(conn, args.all_steps)
     update_workers(conn)
     update_builders(conn)
-    update_build_status(conn)
-    update_buildsets(conn)
-    update_buildrequests(conn)
+    # the tables are independent, import them in parallel with a connection each
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(_run_with_connection, f)
+            for f in [update_build_status, update_buildsets, update_buildrequests]
+        ]
+        for future in futures:
+            future.result()
+    update_steps(conn)
@@ -16,74 +16,133 @@
 import csv
 import datetime
 import gzip
+import json
 import os
-import mailbox
 import requests
 import re
-from typing import List, Dict, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Optional
 
 
 EMAIL_ARCHIVE_URL = 'http://lists.llvm.org/pipermail/llvm-dev/{year}-{month}.txt.gz'
 TMP_DIR = os.path.join(os.path.dirname(__file__), 'tmp')
+# months and attachments that were already processed, see LLVMBotArchiveScanner
+STATE_FILE = os.path.join(TMP_DIR, 'buildbot_emails_state.json')
+# number of parallel downloads
+WORKERS = 8
+
+
+class ArchivedEmail:
+    """Subject and body of a message from the archive, headers are dropped."""
+
+    __slots__ = ('subject', 'body')
+
+    def __init__(self, subject: str, body: str):
+        self.subject = subject
+        self.body = body
 
 
 class LLVMBotArchiveScanner:
+    """Collect the weekly "Buildbot numbers" statistics from the llvm-dev archive.
+
+    Months that are over and were scanned completely, the attachments found
+    and the parsed statistics are kept in STATE_FILE, so a run only downloads
+    and scans the current month and whatever is new. A month is only marked
+    as done once its archive was downloaded after the month was over.
+    """
 
     def __init__(self):
         self._tmpdir = TMP_DIR
+        os.makedirs(self._tmpdir, exist_ok=True)
+        self._state = {'months': [], 'attachments': {}, 'stats': {}}
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE) as state_file:
+                self._state = json.load(state_file)
+
+    def save_state(self):
+        tmp_file = STATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as state_file:
+            json.dump(self._state, state_file)
+        os.replace(tmp_file, STATE_FILE)
 
     @staticmethod
     def _generate_archive_url(month: datetime.date) -> str:
         return EMAIL_ARCHIVE_URL.format(year=month.year, month=month.strftime('%B'))
 
-    def _download_archive(self, month: datetime.date):
-        os.makedirs(self._tmpdir, exist_ok=True)
-        filename = os.path.join(self._tmpdir, 'llvmdev-{year}-{month:02d}.txt'.format(year=month.year, month=month.month))
-        url = self._generate_archive_url(month)
-        # FIXME: decompress the files
-        self.download(url, filename)
+    def _archive_filename(self, month: datetime.date) -> str:
+        return os.path.join(self._tmpdir, 'llvmdev-{year}-{month:02d}.txt.gz'.format(year=month.year, month=month.month))
 
-    def get_archives(self, start_month: datetime.date):
+    def _archive_complete(self, month: datetime.date) -> bool:
+        """Check if the local archive was downloaded after the month was over.
+
+        An archive downloaded earlier, e.g. while it was the current month,
+        misses the emails of the rest of the month."""
+        archive_name = self._archive_filename(month)
+        if not os.path.exists(archive_name):
+            return False
+        downloaded = datetime.datetime.fromtimestamp(os.path.getmtime(archive_name))
+        return downloaded >= datetime.datetime.combine(next_month(month), datetime.time())
+
+    def get_archives(self, start_month: datetime.date) -> List[datetime.date]:
+        """Download the archives of all months not processed yet, in parallel.
+
+        Archives downloaded before their month was over, like the one of the
+        current month, are downloaded again. Returns the months to scan."""
         print('Downloading data...')
+        months = []
         month = start_month
         today = datetime.date.today()
         while month < today:
-            self._download_archive(month)
-            if month.month < 12:
-                month = datetime.date(year=month.year, month=month.month+1, day=1)
-            else:
-                month = datetime.date(year=month.year+1, month=1, day=1)
-
-    def extract_emails(self) -> List[mailbox.Message]:
-        result = []
-        for archive_name in (d for d in os.listdir(self._tmpdir) if d.startswith('llvmdev-')):
-            print('Scanning {}'.format(archive_name))
-            mb = mailbox.mbox(os.path.join(self._tmpdir, archive_name), factory=mbox_reader)
-            for mail in mb.values():
-                subject = mail.get('subject')
-                if subject is None:
-                    continue
-                if 'Buildbot numbers' in mail['subject']:
-                    yield(mail)
-        yield
-
-    def get_attachments(self, email: mailbox.Message):
-        if email is None:
-            return
-        week_str = re.search(r'(\d+/\d+/\d+)', email['subject']).group(1)
+            if month.isoformat() not in self._state['months']:
+                months.append(month)
+            month = next_month(month)
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            list(executor.map(
+                lambda m: self.download(self._generate_archive_url(m), self._archive_filename(m),
+                                        refresh=not self._archive_complete(m)),
+                months))
+        return months
+
+    def extract_emails(self, months: List[datetime.date]) -> Iterator[ArchivedEmail]:
+        for month in months:
+            archive_name = self._archive_filename(month)
+            if not os.path.exists(archive_name):
+                continue
+            print('Scanning {}'.format(os.path.basename(archive_name)))
+            with open_archive(archive_name) as archive:
+                yield from scan_mbox(archive, 'Buildbot numbers')
+            if self._archive_complete(month):
+                self._state['months'].append(month.isoformat())
+
+    def get_attachments(self, email: ArchivedEmail):
+        week_str = re.search(r'(\d+/\d+/\d+)', email.subject).group(1)
         week = datetime.datetime.strptime(week_str, '%m/%d/%Y').date()
-        attachment_url = re.search(r'Name: completed_failed_avr_time.csv[^<]*URL: <([^>]+)>', email.get_payload(), re.DOTALL).group(1)
+        if week.isoformat() in self._state['attachments']:
+            return
+        attachment_url = re.search(r'Name: completed_failed_avr_time.csv[^<]*URL: <([^>]+)>', email.body, re.DOTALL).group(1)
         filename = os.path.join(self._tmpdir, 'buildbot_stats_{}.csv'.format(week.isoformat()))
         self.download(attachment_url, filename)
+        self._state['attachments'][week.isoformat()] = attachment_url
 
     @staticmethod
-    def download(url, filename):
-        if os.path.exists(filename):
+    def download(url, filename, refresh: bool = False):
+        """Download url to filename, resuming an interrupted download."""
+        if os.path.exists(filename) and not refresh:
             return
-        r = requests.get(url)
+        part_filename = filename + '.part'
+        headers = {}
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
         print('Getting {}'.format(filename))
-        with open(filename, 'wb') as f:
-            f.write(r.content)
+        with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            # the server ignored the range, start from scratch
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            with open(part_filename, mode) as f:
+                for chunk in r.raw.stream(1024 * 1024, decode_content=False):
+                    f.write(chunk)
+        os.replace(part_filename, filename)
 
     def merge_results(self):
         def _convert_int(s: str) -> int:
@@ -91,51 +150,95 @@ class LLVMBotArchiveScanner:
                 return 0
             return int(s)
 
-        bot_stats = {}  # type: Dict[str, Dict[datetime.date, float]]
-        weeks = set()  # type: Set[datetime.date]
+        # week -> bot -> percentage, the CSV of a week is only parsed once
+        weekly_stats = self._state['stats']  # type: Dict[str, Dict[str, float]]
         for csv_filename in (d for d in os.listdir(self._tmpdir) if d.startswith('buildbot_stats_')):
             week_str = re.search(r'(\d+-\d+-\d+)', csv_filename).group(1)
-            week = datetime.datetime.fromisoformat(week_str).date()
-            weeks.add(week)
+            if week_str in weekly_stats:
+                continue
+            stats = {}
             with open(os.path.join(self._tmpdir, csv_filename)) as csv_file:
                 reader = csv.DictReader(csv_file)
                 for row in reader:
                     name = row['name']
                     red_build = _convert_int(row['red_builds'])
                     all_builds = _convert_int(row['all_builds'])
-                    percentage = 100.0 * red_build / all_builds
-                    bot_stats.setdefault(name, {})
-                    bot_stats[name][week] = percentage
+                    stats[name] = 100.0 * red_build / all_builds
+            weekly_stats[week_str] = stats
 
         with open(os.path.join(self._tmpdir, 'buildbot_weekly.csv'), 'w') as csv_file:
             fieldnames = ['week']
-            filtered_bots = sorted(b for b in bot_stats.keys()) # if len(bot_stats[b]) == len(weeks)
+            filtered_bots = sorted(set(b for stats in weekly_stats.values() for b in stats.keys()))
             fieldnames.extend(filtered_bots)
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             writer.writeheader()
-            for week in sorted(weeks):
-                row = {'week': week.isoformat()}
-                for bot in filtered_bots:
-                    percentage = bot_stats[bot].get(week)
-                    if percentage is None:
-                        continue
-                    row[bot] = percentage
+            for week in sorted(weekly_stats.keys()):
+                row = {'week': week}
+                row.update(weekly_stats[week])
                 writer.writerow(row)
 
 
-def mbox_reader(stream):
-    """Read a non-ascii message from mailbox.
-
-    Based on https://stackoverflow.com/questions/37890123/how-to-trap-an-exception-that-occurs-in-code-underlying-python-for-loop
-    """
-    data = stream.read()
-    text = data.decode(encoding="utf-8")
-    return mailbox.mboxMessage(text)
+def next_month(month: datetime.date) -> datetime.date:
+    """First day of the month after `month`."""
+    if month.month < 12:
+        return datetime.date(year=month.year, month=month.month+1, day=1)
+    return datetime.date(year=month.year+1, month=1, day=1)
+
+
+def open_archive(filename: str) -> BinaryIO:
+    """Open an archive, decompressing it on the fly if it is gzipped."""
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _decode(line: bytes) -> str:
+    return line.decode('utf-8', errors='replace')
+
+
+def scan_mbox(stream: BinaryIO, subject_filter: str) -> Iterator[ArchivedEmail]:
+    """Yield the messages whose subject contains subject_filter.
+
+    Reads the mbox line by line, only the headers of every message are
+    looked at and only the bodies of matching messages are kept in memory."""
+    subject = None  # type: Optional[str]
+    in_headers = False
+    last_header = None  # type: Optional[str]
+    body = None  # type: Optional[List[str]]
+    for line in stream:
+        if line.startswith(b'From '):
+            if body is not None:
+                yield ArchivedEmail(subject, ''.join(body))
+            subject = None
+            in_headers = True
+            last_header = None
+            body = None
+            continue
+        if in_headers:
+            if line.strip() == b'':
+                in_headers = False
+                if subject is not None and subject_filter in subject:
+                    body = []
+            elif line[:1] in (b' ', b'\t'):
+                # folded header
+                if last_header == 'subject':
+                    subject += ' ' + _decode(line).strip()
+            else:
+                last_header = _decode(line.split(b':', 1)[0]).lower()
+                if last_header == 'subject':
+                    subject = _decode(line.split(b':', 1)[1]).strip()
+        elif body is not None:
+            body.append(_decode(line))
+    if body is not None:
+        yield ArchivedEmail(subject, ''.join(body))
 
 
 if __name__ == '__main__':
     scanner = LLVMBotArchiveScanner()
-    scanner.get_archives(datetime.date(year=2019, month=8, day=1))
-    for message in scanner.extract_emails():
+    months = scanner.get_archives(datetime.date(year=2019, month=8, day=1))
+    for message in scanner.extract_emails(months):
         scanner.get_attachments(message)
-    scanner.merge_results()
\ No newline at end of file
+    scanner.merge_results()
+    scanner.save_state()
@@ -0,0 +1,83 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import buildbot_status_emails  # noqa: E402
+from buildbot_status_emails import LLVMBotArchiveScanner, next_month  # noqa: E402
+
+ARCHIVE = b"""From bot at example.com  Mon Oct  4 10:00:00 2021
+Subject: Buildbot numbers for the week of 09/26/2021 - 10/02/2021
+
+body
+"""
+
+
+def _scanner(tmp_path, monkeypatch) -> LLVMBotArchiveScanner:
+    monkeypatch.setattr(buildbot_status_emails, 'TMP_DIR', str(tmp_path))
+    monkeypatch.setattr(buildbot_status_emails, 'STATE_FILE', str(tmp_path / 'state.json'))
+    return LLVMBotArchiveScanner()
+
+
+def _write_archive(scanner: LLVMBotArchiveScanner, month: datetime.date, downloaded: datetime.datetime):
+    filename = scanner._archive_filename(month)
+    with open(filename, 'wb') as f:
+        f.write(ARCHIVE)
+    os.utime(filename, (downloaded.timestamp(), downloaded.timestamp()))
+
+
+def test_month_rollover_downloads_partial_archive_again(tmp_path, monkeypatch):
+    scanner = _scanner(tmp_path, monkeypatch)
+    current_month = datetime.date.today().replace(day=1)
+    last_month = (current_month - datetime.timedelta(days=1)).replace(day=1)
+    older_month = (last_month - datetime.timedelta(days=1)).replace(day=1)
+    # downloaded in the middle of last month, while it was the current month
+    _write_archive(scanner, last_month, datetime.datetime.combine(last_month, datetime.time()).replace(day=15))
+    # downloaded after the month was over
+    _write_archive(scanner, older_month, datetime.datetime.combine(last_month, datetime.time()).replace(day=2))
+    refreshed = {}
+    monkeypatch.setattr(LLVMBotArchiveScanner, 'download',
+                        staticmethod(lambda url, filename, refresh=False: refreshed.update({filename: refresh})))
+
+    months = scanner.get_archives(older_month)
+
+    assert months == [older_month, last_month, current_month]
+    assert refreshed[scanner._archive_filename(older_month)] is False
+    assert refreshed[scanner._archive_filename(last_month)] is True
+    assert refreshed[scanner._archive_filename(current_month)] is True
+
+
+def test_partial_archive_is_not_marked_done(tmp_path, monkeypatch):
+    scanner = _scanner(tmp_path, monkeypatch)
+    current_month = datetime.date.today().replace(day=1)
+    last_month = (current_month - datetime.timedelta(days=1)).replace(day=1)
+    _write_archive(scanner, last_month, datetime.datetime.combine(last_month, datetime.time()).replace(day=15))
+
+    emails = list(scanner.extract_emails([last_month]))
+    assert len(emails) == 1
+    assert scanner._state['months'] == []
+
+    # the next run downloaded it again after the month was over
+    _write_archive(scanner, last_month, datetime.datetime.combine(current_month, datetime.time()))
+    list(scanner.extract_emails([last_month]))
+    assert scanner._state['months'] == [last_month.isoformat()]
+
+
+def test_next_month():
+    assert next_month(datetime.date(2021, 10, 1)) == datetime.date(2021, 11, 1)
+    assert next_month(datetime.date(2021, 12, 1)) == datetime.date(2022, 1, 1)
@@ -14,12 +14,20 @@
 # limitations under the License.
 
 from datetime import date
+import argparse
+import json
+import os
 import requests
 import datetime
-from google.cloud import monitoring_v3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from metrics_sink import MetricsBuffer, create_sink
 
-BASE_URL = 'http://lab.llvm.org:8011/json/builders'
-GCP_PROJECT_ID = 'llvm-premerge-checks'
+BUILDBOT_URL = 'https://lab.llvm.org/buildbot/api/v2/'
+# number of builders queried in parallel
+WORKERS = 16
+# builds seen in previous runs, so only new builds are requested
+_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'buildbots_cache.json')
 
 class BuildStats:
     """Build statistics.
@@ -60,79 +68,101 @@ class BuildStats:
         return '\n'.join(result)
 
 
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=WORKERS, max_retries=3)
+    session.mount('https://', adapter)
+    return session
+
+
+def _load_cache() -> Dict:
+    if not os.path.isfile(_CACHE_FILE):
+        return {}
+    with open(_CACHE_FILE) as cache_file:
+        return json.load(cache_file)
+
+
+def _save_cache(cache: Dict):
+    os.makedirs(os.path.dirname(_CACHE_FILE), exist_ok=True)
+    with open(_CACHE_FILE, 'w') as cache_file:
+        json.dump(cache, cache_file)
+
+
 def get_buildbot_stats(time_window : datetime.datetime) -> BuildStats:
     """Get the statistics for the all builders."""
     print('getting list of builders...')
+    session = _create_session()
+    response = session.get(BUILDBOT_URL + 'builders', params={'field': ['builderid', 'name']}, timeout=60)
+    response.raise_for_status()
+    builders = response.json()['builders']
+    cache = _load_cache()
     stats = BuildStats()
-    for builder in requests.get(BASE_URL).json().keys():
-        # TODO: maybe filter the builds to the ones we care about
-        stats += get_builder_stats(builder, time_window )
+    new_cache = {}
+    # TODO: maybe filter the builds to the ones we care about
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = executor.map(
+            lambda b: get_builder_stats(session, b, time_window, cache.get(str(b['builderid']))), builders)
+        for builder, (builder_stats, builder_cache) in zip(builders, results):
+            stats += builder_stats
+            new_cache[str(builder['builderid'])] = builder_cache
+    _save_cache(new_cache)
     return stats
 
 
-def get_builder_stats(builder: str, time_window: datetime.datetime) -> BuildStats:
-    """Get the statistics for one builder."""
-    print('Gettings builds for {}...'.format(builder))
-    # TODO: can we limit the data we're requesting?
-    url = '{}/{}/builds/_all'.format(BASE_URL, builder)
-    stats = BuildStats()
-    for build, results in requests.get(url).json().items():        
-        start_time = datetime.datetime.fromtimestamp(float(results['times'][0]))
-        if start_time < time_window:
+def get_builder_stats(session: requests.Session, builder: Dict, time_window: datetime.datetime,
+                      cache: Optional[Dict]) -> Tuple[BuildStats, Dict]:
+    """Get the statistics for one builder.
+
+    Only builds started in the time window and newer than the ones in the
+    cache are requested. Returns the statistics and the new cache entry."""
+    print('Gettings builds for {}...'.format(builder['name']))
+    window_start = int(time_window.timestamp())
+    if cache is None:
+        cache = {'last_number': 0, 'builds': {}}
+    # build number -> [start time, successful]
+    builds = {number: b for number, b in cache['builds'].items() if b[0] >= window_start}
+    url = '{}builders/{}/builds'.format(BUILDBOT_URL, builder['builderid'])
+    response = session.get(url, params={
+        'number__gt': cache['last_number'],
+        'started_at__ge': window_start,
+        'field': ['number', 'started_at', 'complete', 'results'],
+    }, timeout=60)
+    response.raise_for_status()
+    last_number = cache['last_number']
+    incomplete = []
+    for build in response.json()['builds']:
+        if not build['complete']:
+            incomplete.append(build['number'])
             continue
-        successful = results['text'] == ['build', 'successful']
+        builds[str(build['number'])] = [build['started_at'], build['results'] == 0]
+        last_number = max(last_number, build['number'])
+    # request running builds again next time
+    if len(incomplete) > 0:
+        last_number = min(incomplete) - 1
+    stats = BuildStats()
+    for _, successful in builds.values():
         stats.add(successful)
-    return stats
+    return stats, {'last_number': last_number, 'builds': builds}
 
 
-def gcp_create_metric_descriptor(project_id: str):
-    """Create metric descriptors on Stackdriver.
-    
-    Re-creating these with every call is fine."""
-    client = monitoring_v3.MetricServiceClient()
-    project_name = client.project_path(project_id)
-
-    for desc_type, desc_desc in [
-        ["buildbots_percent_failed", "Percentage of failed builds"],
-        ["buildbots_builds_successful", "Number of successful builds in the last 24h."],
-        ["buildbots_builds_failed", "Number of failed builds in the last 24h."],
-        ["buildbots_builds_total", "Total number of builds in the last 24h."],
+def write_metrics(metrics: MetricsBuffer, stats: BuildStats):
+    # the "buildbots_" prefix is doubled in the names of the existing time series
+    for desc_type, value, desc_desc in [
+        ["buildbots_percent_failed", stats.percent_failed, "Percentage of failed builds"],
+        ["buildbots_builds_successful", stats.successful, "Number of successful builds in the last 24h."],
+        ["buildbots_builds_failed", stats.failed, "Number of failed builds in the last 24h."],
+        ["buildbots_builds_total", stats.total, "Total number of builds in the last 24h."],
     ]:
+        metrics.gauge('buildbots_{}'.format(desc_type), value, desc_desc)
 
-        descriptor = monitoring_v3.types.MetricDescriptor()
-        descriptor.type = 'custom.googleapis.com/buildbots_{}'.format(desc_type)
-        descriptor.metric_kind = (
-            monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE)
-        descriptor.value_type = (
-            monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE)
-        descriptor.description = desc_desc
-        descriptor = client.create_metric_descriptor(project_name, descriptor)
-        print('Created {}.'.format(descriptor.name))
-
-
-def gcp_write_data(project_id: str, stats: BuildStats):
-    """Upload metrics to Stackdriver."""
-    client = monitoring_v3.MetricServiceClient()
-    project_name = client.project_path(project_id)
-    now = datetime.datetime.now()
-
-    for desc_type, value in [
-        ["buildbots_percent_failed", stats.percent_failed],
-        ["buildbots_builds_successful", stats.successful],
-        ["buildbots_builds_failed", stats.failed],
-        ["buildbots_builds_total", stats.total],
-    ]:
-        series = monitoring_v3.types.TimeSeries()
-        series.metric.type = 'custom.googleapis.com/buildbots_{}'.format(desc_type)
-        series.resource.type = 'global'
-        point = series.points.add()
-        point.value.double_value = value
-        point.interval.end_time.seconds = int(now.timestamp())
-        client.create_time_series(project_name, [series])
 
 if __name__ == '__main__':
-    gcp_create_metric_descriptor(GCP_PROJECT_ID)
+    parser = argparse.ArgumentParser(description='Upload buildbot statistics of the last 24h')
+    parser.add_argument('--sink', default='stackdriver', help='where to write the metrics to, see metrics_sink.py')
+    args = parser.parse_args()
+    metrics = MetricsBuffer(create_sink(args.sink))
     stats = get_buildbot_stats(
         datetime.datetime.now() - datetime.timedelta(hours=24))
-    gcp_write_data(GCP_PROJECT_ID, stats)
+    write_metrics(metrics, stats)
+    metrics.flush()
     print(stats)
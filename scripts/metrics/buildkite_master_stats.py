@@ -27,6 +27,7 @@ import argparse
 import json 
 import os
 import datetime
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
 class Build:
 
@@ -49,6 +50,10 @@ class Build:
   def has_passed(self) -> bool:
     return self.state == 'passed'
 
+  @property
+  def is_finished(self) -> bool:
+    return self._json_dict.get('finished_at') is not None
+
   @property
   def commit(self) -> str:
     return self._json_dict['commit']
@@ -65,81 +70,117 @@ class BuildKiteMasterStats:
     self._llvm_repo = llvm_repo
     with open(token_path, 'r') as token_file:
       self._token = token_file.read().strip()
-
-  def get_stats(self, organisation: str, pipeline: str):
+    self._session = requests.Session()
+    # keep the token out of URLs, they end up in logs
+    self._session.headers['Authorization'] = f'Bearer {self._token}'
+
+  def update(self, organisation: str, pipeline: str, store_path: str, state_path: str,
+             created_from: Optional[str] = None) -> int:
+    """Append the builds finished since the last update to the JSON lines store.
+
+    The first update downloads all builds, or the ones created after
+    `created_from`. Later updates only ask for builds finished after the
+    newest one in the store. The first page is requested conditionally, so
+    nothing is transferred if no build finished in the meantime.
+    Returns the number of new builds."""
+    state = {}
+    if os.path.exists(state_path):
+      with open(state_path) as state_file:
+        state = json.load(state_file)
+    params = {'per_page': 100}
+    if state.get('finished_from') is not None:
+      params['finished_from'] = state['finished_from']
+    elif created_from is not None:
+      params['created_from'] = created_from
+    headers = {}
+    if state.get('etag') is not None and state.get('params') == params:
+      headers['If-None-Match'] = state['etag']
     url = "https://api.buildkite.com/v2/organizations/{}/pipelines/{}/builds".format(organisation, pipeline)
-    return self._get_url(url)
-    
-
-  def _get_url(self, url: str):
-    """Get paginated results from server."""
-    page = 1
-    results = []
-    while True:
-      page_url = url + f"?api_key={self._token}&page={page}&per_page=100"
-      new_results = requests.get(page_url).json()
-      results.extend(new_results)
-      print(len(new_results))
-      if len(new_results) < 100:
-        break
-      page += 1 
-    return results
-
-  def save_results(self, output_path:str, data):
-    with open(output_path, 'w') as output_file:
-      json.dump(data, output_file)
-
-  def get_builds(self, json_path: str):
-    with open(json_path) as json_file:
-      builds = json.load(json_file)
+    response = self._session.get(url, params=params, headers=headers)
+    if response.status_code == 304:
+      print('No new builds.')
+      return 0
+    response.raise_for_status()
+    etag = response.headers.get('ETag')
+    finished_from = state.get('finished_from')
+    count = 0
+    with open(store_path, 'a') as store_file:
+      while True:
+        for b in response.json():
+          store_file.write(json.dumps(b) + '\n')
+          # ISO 8601 timestamps in UTC compare like strings
+          if b.get('finished_at') is not None and (finished_from is None or b['finished_at'] > finished_from):
+            finished_from = b['finished_at']
+          count += 1
+        print(f'{count} builds...')
+        next_page = response.links.get('next')
+        if next_page is None:
+          break
+        response = self._session.get(next_page['url'])
+        response.raise_for_status()
+    with open(state_path, 'w') as state_file:
+      json.dump({'finished_from': finished_from, 'etag': etag, 'params': params}, state_file)
+    return count
+
+  def get_builds(self, store_path: str) -> Dict[int, Build]:
+    """Read the store, the last record of a build number wins."""
     build_dict = {}
-    for b in builds:
-      build = Build(b)
-      build_dict[build.number] = build
+    with open(store_path) as store_file:
+      for line in store_file:
+        build = Build(json.loads(line))
+        build_dict[build.number] = build
     return build_dict
 
+
+def find_outages(builds: Iterable[Build]) -> Iterator[Tuple[Build, Optional[Build]]]:
+  """Yield (first failing build, first passing build after it) in one pass.
+
+  `builds` must be sorted by number. The second build is None if the
+  outage is still ongoing."""
+  first_failed = None
+  for build in builds:
+    if not build.is_finished:
+      continue
+    if build.has_passed:
+      if first_failed is not None:
+        yield first_failed, build
+        first_failed = None
+    elif first_failed is None:
+      first_failed = build
+  if first_failed is not None:
+    yield first_failed, None
+
+
 if __name__ == '__main__':
-  parser = argparse.ArgumentParser(description='Process some integers.')
+  parser = argparse.ArgumentParser(description='Print the outages of the main branch builds on Buildkite.')
   parser.add_argument('llvm_path')
-  parser.add_argument('token')
+  parser.add_argument('token', help='path to a file containing the Buildkite API token')
+  parser.add_argument('--created-from', default=None,
+                      help='only download builds created after this ISO 8601 date on the first run')
+  parser.add_argument('--no-update', action='store_true', help='only use the builds downloaded before')
   args = parser.parse_args()
-  CACHE_FILE = 'tmp/bklogs.json'
+  STORE_FILE = 'tmp/bklogs.jsonl'
+  STATE_FILE = 'tmp/bklogs-state.json'
   bk = BuildKiteMasterStats(args.llvm_path, args.token)
-  
-  if not os.path.exists(CACHE_FILE):
-    results = bk.get_stats('llvm-project','llvm-main-build')
-    bk.save_results(CACHE_FILE, results)
-  
-  builds = bk.get_builds(CACHE_FILE)
-  last_fail = None
-  fail_count = 0
-  start_time = None
-  for build_number in sorted(builds.keys()):
-    if build_number < 50:
-      # skip the first builds as they might not be mature enough
+  os.makedirs('tmp', exist_ok=True)
+  if not args.no_update:
+    bk.update('llvm-project', 'llvm-main-build', STORE_FILE, STATE_FILE, args.created_from)
+
+  builds = bk.get_builds(STORE_FILE)
+  # skip the first builds as they might not be mature enough
+  numbers = (n for n in sorted(builds.keys()) if n >= 50)
+  for fail_count, (start, end) in enumerate(find_outages(builds[n] for n in numbers)):
+    print(f'# Outage {fail_count}')
+    print()
+    print(f'* starts with [build {start.number}]({start.web_url})')
+    print(f'* starts with commit {start.commit}')
+    print(f'* starts on {start.created_at}')
+    if end is None:
       continue
-    build = builds[build_number]
-    if build.has_passed:
-      if last_fail is not None:
-        print(f'* ends with [build {build.number}]({build.web_url})')
-        print(f'* ends with commit {build.commit}')
-        print(f'* ends on {build.created_at}')
-        duration = build.created_at - start_time
-        print(f'* duration: {duration} [h:m:s]')
-        print('* cause: # TODO')
-        print()
-        last_fail = None
-    else:
-      if last_fail is None:
-        print(f'# Outage {fail_count}')
-        print()
-        print(f'* starts with [build {build.number}]({build.web_url})')
-        print(f'* starts with commit {build.commit}')
-        print(f'* starts on {build.created_at}')
-        fail_count += 1
-        start_time = build.created_at
-      else:
-        pass
-      last_fail = build.number
-      
-  
\ No newline at end of file
+    print(f'* ends with [build {end.number}]({end.web_url})')
+    print(f'* ends with commit {end.commit}')
+    print(f'* ends on {end.created_at}')
+    duration = end.created_at - start.created_at
+    print(f'* duration: {duration} [h:m:s]')
+    print('* cause: # TODO')
+    print()
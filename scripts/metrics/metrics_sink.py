@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Copyright 2021 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Buffer metrics in process and export them in batches to a backend.
+#
+# Usage:
+#   metrics = MetricsBuffer(create_sink(args.sink))
+#   metrics.gauge('repository_commits', 42, 'Number of commits in the last 24h.')
+#   metrics.flush()
+#
+# Sinks are selected with a string:
+#   stackdriver                Stackdriver (GCP)
+#   prometheus:<path>          Prometheus text file for the node exporter textfile collector
+#   file:<path>                JSON lines appended to a file, for tests and local runs
+
+import abc
+import datetime
+import json
+import os
+from typing import Dict, List
+
+GCP_PROJECT_ID = 'llvm-premerge-checks'
+
+GAUGE = 'gauge'
+COUNTER = 'counter'
+
+
+class Metric:
+    """Plain data object for one value of a metric."""
+
+    __slots__ = ('name', 'kind', 'value', 'description')
+
+    def __init__(self, name: str, kind: str, value: float, description: str):
+        self.name = name  # type: str
+        self.kind = kind  # type: str
+        self.value = value  # type: float
+        self.description = description  # type: str
+
+
+class MetricsBuffer:
+    """Collect gauges and counters in memory, write them with one call to flush()."""
+
+    def __init__(self, sink: 'Sink'):
+        self.sink = sink
+        self._metrics: Dict[str, Metric] = {}
+
+    def gauge(self, name: str, value: float, description: str = ''):
+        """Set a gauge to a value, replaces the value set before."""
+        self._metrics[name] = Metric(name, GAUGE, float(value), description)
+
+    def counter(self, name: str, value: float = 1, description: str = ''):
+        """Add value to a counter."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Metric(name, COUNTER, 0.0, description)
+        metric.value += float(value)
+
+    def flush(self):
+        if len(self._metrics) == 0:
+            return
+        self.sink.write(list(self._metrics.values()), datetime.datetime.now(tz=datetime.timezone.utc))
+        self._metrics = {}
+
+
+class Sink(abc.ABC):
+    """Backend that MetricsBuffer.flush() writes to."""
+
+    @abc.abstractmethod
+    def write(self, metrics: List[Metric], now: datetime.datetime):
+        """Write one batch of metrics, all taken at `now`."""
+
+
+class StackdriverSink(Sink):
+    """Write to Stackdriver as custom.googleapis.com/<name>.
+
+    Metric descriptors are only created if they do not exist yet. Counters
+    are written as gauges of the value counted in this run."""
+
+    # maximum number of time series in one create_time_series call
+    _BATCH_SIZE = 200
+
+    def __init__(self, project_id: str = GCP_PROJECT_ID):
+        # only needed for this sink, so the collectors also run without GCP
+        from google.cloud import monitoring_v3
+        self._monitoring = monitoring_v3
+        self._client = monitoring_v3.MetricServiceClient()
+        self._project_name = self._client.project_path(project_id)
+        self._known_types = None
+
+    def _ensure_descriptors(self, metrics: List[Metric]):
+        if self._known_types is None:
+            self._known_types = set(d.type for d in self._client.list_metric_descriptors(
+                self._project_name, filter_='metric.type = starts_with("custom.googleapis.com/")'))
+        for metric in metrics:
+            metric_type = 'custom.googleapis.com/{}'.format(metric.name)
+            if metric_type in self._known_types:
+                continue
+            descriptor = self._monitoring.types.MetricDescriptor()
+            descriptor.type = metric_type
+            descriptor.metric_kind = self._monitoring.enums.MetricDescriptor.MetricKind.GAUGE
+            descriptor.value_type = self._monitoring.enums.MetricDescriptor.ValueType.DOUBLE
+            descriptor.description = metric.description
+            descriptor = self._client.create_metric_descriptor(self._project_name, descriptor)
+            print('Created {}.'.format(descriptor.name))
+            self._known_types.add(metric_type)
+
+    def write(self, metrics: List[Metric], now: datetime.datetime):
+        self._ensure_descriptors(metrics)
+        series_list = []
+        for metric in metrics:
+            series = self._monitoring.types.TimeSeries()
+            series.metric.type = 'custom.googleapis.com/{}'.format(metric.name)
+            series.resource.type = 'global'
+            point = series.points.add()
+            point.value.double_value = metric.value
+            point.interval.end_time.seconds = int(now.timestamp())
+            series_list.append(series)
+        for i in range(0, len(series_list), self._BATCH_SIZE):
+            self._client.create_time_series(self._project_name, series_list[i:i + self._BATCH_SIZE])
+
+
+class PrometheusTextSink(Sink):
+    """Write a Prometheus text file, e.g. for the node exporter textfile collector.
+
+    The file is replaced atomically and only contains the last flush. Counters
+    only hold what was counted since the previous flush, so they are written
+    as gauges: as Prometheus counters every flush would look like a reset."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, metrics: List[Metric], now: datetime.datetime):
+        lines = []
+        for metric in metrics:
+            if metric.description:
+                lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} gauge'.format(metric.name))
+            lines.append('{} {}'.format(metric.name, metric.value))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+class FileSink(Sink):
+    """Append one JSON object per metric to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, metrics: List[Metric], now: datetime.datetime):
+        with open(self.path, 'a') as out_file:
+            for metric in metrics:
+                out_file.write(json.dumps({
+                    'timestamp': now.isoformat(),
+                    'name': metric.name,
+                    'kind': metric.kind,
+                    'value': metric.value,
+                }) + '\n')
+
+
+def create_sink(spec: str) -> Sink:
+    """Create a sink from a string like "stackdriver" or "prometheus:/path/to/file.prom"."""
+    kind, _, path = spec.partition(':')
+    if kind == 'stackdriver':
+        return StackdriverSink()
+    if kind == 'prometheus' and path:
+        return PrometheusTextSink(path)
+    if kind == 'file' and path:
+        return FileSink(path)
+    raise ValueError('unknown metrics sink "{}"'.format(spec))
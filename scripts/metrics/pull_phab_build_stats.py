@@ -15,16 +15,18 @@
 
 # Get data on Revisions and builds from Phabricator
 
-import phabricator
 import json
 import os
+import sys
 import datetime
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
 import csv
-import time
-import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import backoff
 import git
 import argparse
+import requests
 
 # PHIDs of build plans used for pre-merge testing
 # FIXME: how do you get these?
@@ -36,56 +38,124 @@ _PRE_MERGE_PHIDs = ['PHID-HMCP-bfkbtacsszhg3feydpo6',  # beta testers
 # query all data after this date
 START_DATE = datetime.date(year=2019, month=10, day=1)
 
+T = TypeVar('T')
+
+# number of PHIDs passed as constraint in a single Conduit query
+_CHUNK_SIZE = 100
+
+
+class ConduitClient:
+    """Minimal Conduit client, one pooled HTTP session shared by all threads."""
+
+    def __init__(self, host: str, token: str, pool_size: int):
+        self._host = host if host.endswith('/') else host + '/'
+        self._token = token
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    def call(self, method: str, **kwargs) -> Dict:
+        kwargs['__conduit__'] = {'token': self._token}
+        response = self._session.post(self._host + method,
+                                      data={'params': json.dumps(kwargs), 'output': 'json'},
+                                      timeout=120)
+        response.raise_for_status()
+        result = response.json()
+        if result['error_code']:
+            raise RuntimeError('{}: {} {}'.format(method, result['error_code'], result['error_info']))
+        return result['result']
+
+    def search(self, method: str, **kwargs) -> Iterator[Dict]:
+        """Iterate over all pages of a cursor based query."""
+        after = None
+        while True:
+            result = self.call(method, after=after, **kwargs)
+            yield from result['data']
+            after = result['cursor']['after']
+            if after is None:
+                break
+
+
+class EntityStore:
+    """Append-only JSON Lines file of Conduit objects, the last record of a PHID wins."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, records: Iterable[Dict]) -> int:
+        lines = [json.dumps(r) + '\n' for r in records]
+        with self._lock, open(self.path, 'a') as store_file:
+            store_file.writelines(lines)
+        return len(lines)
+
+    def load(self, factory: Callable[[Dict], T]) -> Dict[str, T]:
+        """Convert records one line at a time, so only one raw dict is alive at a time."""
+        result = {}
+        if not os.path.isfile(self.path):
+            return result
+        with open(self.path) as store_file:
+            for line in store_file:
+                record = factory(json.loads(line))
+                result[record.phid] = record
+        return result
+
+
 class PhabResponse:
+    """Compact record of a Conduit object, only the fields used here are kept.
 
-    def __init__(self, revision_dict: Dict):
-        self.revision_dict = revision_dict
+    The raw dicts are dropped right after parsing, a revision dict alone is a
+    couple of KB while the record is a handful of slots. Repeated strings
+    (statuses, PHIDs of plans, repositories) are interned.
+    """
 
-    @property
-    def id(self) -> str:
-        return self.revision_dict['id']
+    __slots__ = ('id', 'phid')
 
-    @property
-    def phid(self) -> str:
-        return self.revision_dict['phid']
+    def __init__(self, revision_dict: Dict):
+        self.id = revision_dict['id']  # type: int
+        self.phid = sys.intern(revision_dict['phid'])  # type: str
 
     def __str__(self):
-        return str(self.revision_dict)
+        return '{}({})'.format(type(self).__name__, self.phid)
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return None if value is None else sys.intern(value)
 
 
 class Revision(PhabResponse):
 
+    __slots__ = ('status', 'created_date', 'date_modified', 'repository_phid', 'diff_phid', 'buildables', 'diffs',
+                 'builds', 'build_status_list', 'was_premerge_tested', 'has_failed_builds',
+                 'builds_finally_succeeded', 'published_failing', 'all_builds_passed', 'all_builds_failed')
+
     def __init__(self, revision_dict):
         super().__init__(revision_dict)
+        fields = revision_dict['fields']
+        self.status = sys.intern(fields['status']['value'])  # type: str
+        self.created_date = fields['dateCreated']  # type: int
+        self.date_modified = fields['dateModified']  # type: int
+        self.repository_phid = _intern(fields['repositoryPHID'])  # type: Optional[str]
+        self.diff_phid = _intern(fields.get('diffPHID'))  # type: Optional[str]
         self.buildables = []  # type: List['Buildable']
         self.diffs = []  # type: List['Diff']
-
-    @property
-    def status(self) -> str:
-        return self.revision_dict['fields']['status']['value']
-
-    @property
-    def builds(self) -> List['Build']:
-        builds = []
-        for b in self.buildables:
-            builds.extend(b.builds)
-        return builds
-
-    @property
-    def created_date(self):
-        return self.revision_dict['fields']['dateCreated']
-
-    @property
-    def was_premerge_tested(self) -> bool:
-        return any((b.was_premerge_tested for b in self.builds))
-
-    @property
-    def repository_phid(self) -> str:
-        return self.revision_dict['fields']['repositoryPHID']
-
-    @property
-    def diff_phid(self) -> str:
-        return self.revision_dict['fields']['diffPHID']
+        self.summarize()
+
+    def summarize(self):
+        """(Re)compute the build flags once all buildables and builds are linked."""
+        self.builds = [b for buildable in self.buildables for b in buildable.builds]  # type: List['Build']
+        self.build_status_list = [b.passed for b in self.builds if b.was_premerge_tested]  # type: List[bool]
+        self.was_premerge_tested = len(self.build_status_list) > 0
+        self.has_failed_builds = False in self.build_status_list
+        last_passed = self.was_premerge_tested and self.build_status_list[-1]
+        # one of the builds failed and the last build passed
+        self.builds_finally_succeeded = self.has_failed_builds and last_passed
+        # published and the last build failed
+        self.published_failing = self.was_premerge_tested and self.published and not last_passed
+        self.all_builds_passed = self.was_premerge_tested and all(self.build_status_list)
+        self.all_builds_failed = self.was_premerge_tested and not any(self.build_status_list)
 
     @property
     def all_diffs_have_refs(self) -> bool:
@@ -104,143 +174,97 @@ class Revision(PhabResponse):
     def published(self) -> bool:
         return self.status == 'published'
 
-    @property
-    def build_status_list(self) -> List[bool]:
-        return [b.passed for b in self.builds if b.was_premerge_tested]
-
-    @property
-    def builds_finally_succeeded(self) -> bool:
-        """Return true iff one of the builds failed and the last build passed."""
-        return self.has_failed_builds and self.build_status_list[-1]
-
-    @property
-    def has_failed_builds(self) -> bool:
-        """Return true iff one of the builds failed."""
-        return False in self.build_status_list
-
-    @property
-    def published_failing(self) -> bool:
-        """Return true iff published and the last build failed."""
-        return self.was_premerge_tested and self.published \
-               and not self.build_status_list[-1]
-
-    @property
-    def all_builds_passed(self) -> bool:
-        return self.was_premerge_tested and all(self.build_status_list)
-
-    @property
-    def all_builds_failed(self) -> bool:
-        return self.was_premerge_tested and all(not b for b in self.build_status_list)
-
     @property
     def dateModified(self) -> datetime.datetime:
-        return datetime.datetime.fromtimestamp(self.revision_dict['fields']['dateModified'])
-       
+        return datetime.datetime.fromtimestamp(self.date_modified)
+
 
 class Buildable(PhabResponse):
 
+    __slots__ = ('diff_phid', 'revison_phid', 'builds', 'revision')
+
     def __init__(self, revision_dict):
         super().__init__(revision_dict)
+        self.diff_phid = sys.intern(revision_dict['buildablePHID'])  # type: str
+        self.revison_phid = sys.intern(revision_dict['containerPHID'])  # type: str
         self.builds = []  # type: List[Build]
         self.revision = None  # type: Optional[Revision]
 
-    @property
-    def diff_phid(self) -> str:
-        return self.revision_dict['buildablePHID']
-
-    @property
-    def revison_phid(self) -> str:
-        return self.revision_dict['containerPHID']
-
 
 class Build(PhabResponse):
 
+    __slots__ = ('buildable_phid', 'buildplan_phid', 'status', 'date_modified', 'buildable')
+
     def __init__(self, revision_dict):
         super().__init__(revision_dict)
+        fields = revision_dict['fields']
+        self.buildable_phid = sys.intern(fields['buildablePHID'])  # type: str
+        self.buildplan_phid = sys.intern(fields['buildPlanPHID'])  # type: str
+        self.status = sys.intern(fields['buildStatus']['value'])  # type: str
+        self.date_modified = fields['dateModified']  # type: int
         self.buildable = None  # type: Optional[Buildable]
 
-    @property
-    def buildable_phid(self) -> str:
-        return self.revision_dict['fields']['buildablePHID']
-
-    @property
-    def buildplan_phid(self) -> str:
-        return self.revision_dict['fields']['buildPlanPHID']
-
     @property
     def was_premerge_tested(self) -> bool:
-        result = self.buildplan_phid in _PRE_MERGE_PHIDs
-        return result
+        return self.buildplan_phid in _PRE_MERGE_PHIDs
 
     @property
     def passed(self) -> bool:
         """Returns true, if the build "passed" """
-        return self.was_premerge_tested and self.revision_dict['fields']['buildStatus']['value'] == 'passed'
+        return self.was_premerge_tested and self.status == 'passed'
 
     @property
-    def dateModified(self) ->datetime.datetime:
-        return datetime.datetime.fromtimestamp(self.revision_dict['fields']['dateModified'])
+    def dateModified(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.date_modified)
+
 
 class Diff(PhabResponse):
 
+    __slots__ = ('revison_phid', 'has_refs', 'base_revision', 'base_branch', 'date_created', 'revision')
+
     def __init__(self, revision_dict):
         super().__init__(revision_dict)
+        fields = revision_dict['fields']
+        self.revison_phid = sys.intern(fields['revisionPHID'])  # type: str
+        refs = fields['refs']
+        self.has_refs = len(refs) > 0  # type: bool
+        self.base_revision = None  # type: Optional[str]
+        self.base_branch = None  # type: Optional[str]
+        for ref in refs:
+            if ref['type'] == 'base' and self.base_revision is None:
+                self.base_revision = _intern(ref['identifier'])
+            elif ref['type'] == 'branch' and self.base_branch is None:
+                self.base_branch = _intern(ref['name'])
+        self.date_created = fields['dateCreated']  # type: int
         self.revision = None  # type: Optional[Revision]
 
-    @property
-    def revison_phid(self) -> str:
-        return self.revision_dict['fields']['revisionPHID']
-
-    @property
-    def _refs(self) -> List:
-        return self.revision_dict['fields']['refs']
-
-    @property
-    def has_refs(self) -> bool:
-        return len(self._refs) > 0
-
-    @property
-    def base_revision(self) -> str:
-        for ref in self._refs:
-            if ref['type'] == 'base':
-                return ref['identifier']
-        return None
-
-    @property
-    def base_branch(self) -> str:
-        for ref in self._refs:
-            if ref['type'] == 'branch':
-                return ref['name']
-        return None
-
     @property
     def dateCreated(self) -> datetime.datetime:
-        return datetime.datetime.fromtimestamp(self.revision_dict['fields']['dateCreated'])
+        return datetime.datetime.fromtimestamp(self.date_created)
+
 
 class PhabBuildPuller:
     # files/folder for sotring temporary results
     _TMP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'tmp'))
-    _REVISION_FILE = os.path.join(_TMP_DIR, 'phab-revisions.json')
-    _BUILDABLE_FILE = os.path.join(_TMP_DIR, 'phab-buildables.json')
-    _BUILD_FILE = os.path.join(_TMP_DIR, 'phab-build.json')
-    _DIFF_FILE = os.path.join(_TMP_DIR, 'phab-diffs.json')
+    _REVISION_FILE = os.path.join(_TMP_DIR, 'phab-revisions.jsonl')
+    _BUILDABLE_FILE = os.path.join(_TMP_DIR, 'phab-buildables.jsonl')
+    _BUILD_FILE = os.path.join(_TMP_DIR, 'phab-builds.jsonl')
+    _DIFF_FILE = os.path.join(_TMP_DIR, 'phab-diffs.jsonl')
+    _STATE_FILE = os.path.join(_TMP_DIR, 'phab-state.json')
     _PHAB_WEEKLY_METRICS_FILE = os.path.join(_TMP_DIR, 'phabricator_{}.csv')
 
-    def __init__(self, repo_path: str):
+    def __init__(self, repo_path: str, workers: int = 8):
         self.conduit_token = None
         self.host = None
-        self.phab = self._create_phab()
+        self._load_arcrc()
+        self._workers = workers
+        self.conduit = ConduitClient(self.host, self.conduit_token, workers)
         self._repo_path = repo_path  # type: str
         self.revisions = {}  # type: Dict[str, Revision]
         self.buildables = {}  # type: Dict[str, Buildable]
         self.builds = {}  # type: Dict[str, Build]
         self.diffs = {}  # type: Dict[str, Diff]
 
-    def _create_phab(self) -> phabricator.Phabricator:
-        phab = phabricator.Phabricator(token=self.conduit_token, host=self.host)
-        phab.update_interfaces()
-        return phab
-
     def _load_arcrc(self):
         """Load arc configuration from file if not set."""
         if self.conduit_token is not None or self.host is not None:
@@ -252,20 +276,14 @@ class PhabBuildPuller:
         self.host = next(iter(arcrc['hosts']))
         self.conduit_token = arcrc['hosts'][self.host]['token']
 
-    def run(self):
+    def run(self, update: bool = True):
         if not os.path.exists(self._TMP_DIR):
             os.mkdir(self._TMP_DIR)
-        if not os.path.isfile(self._REVISION_FILE):
-            self.get_revisions()
+        if update:
+            self.harvest()
         self.parse_revisions()
-        if not os.path.isfile(self._BUILDABLE_FILE):
-            self.get_buildables()
         self.parse_buildables()
-        if not os.path.isfile(self._BUILD_FILE):
-            self.get_builds()
         self.parse_builds()
-        if not os.path.isfile(self._DIFF_FILE):
-            self.get_diffs()
         self.parse_diffs()
         self.link_objects()
         self.compute_metrics('day', lambda r: r.day)
@@ -274,126 +292,104 @@ class PhabBuildPuller:
         self.revision_statistics()
         self.match_base_revisions_with_repo(self._repo_path)
 
-    def get_revisions(self):
-        print('Downloading revisions starting...')
-        from_date = int(START_DATE.strftime('%s'))
-        data = []
+    def _load_state(self) -> Dict:
+        if not os.path.isfile(self._STATE_FILE):
+            return {}
+        with open(self._STATE_FILE) as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state: Dict):
+        tmp_file = self._STATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_file, self._STATE_FILE)
+
+    def harvest(self):
+        """Download everything that changed since the last run.
+
+        Only differential.revision.search can filter on the modification date,
+        so the high-water mark is kept for revisions. Buildables, builds and
+        diffs are re-fetched for the revisions that changed; new diffs and build
+        results are recorded as revision transactions and bump dateModified.
+        The high-water mark is only stored once all entities were downloaded.
+        """
+        state = self._load_state()
+        changed = self.get_revisions(state.get('revisions'))
+        if len(changed) == 0:
+            print('No revisions changed since the last run.')
+            return
+        revision_phids = [r['phid'] for r in changed]
+        # diffs and buildables -> builds are independent, the requests of both
+        # chains share one pool of workers
+        with ThreadPoolExecutor(max_workers=self._workers) as executor, \
+                ThreadPoolExecutor(max_workers=1) as diff_chain:
+            diffs = diff_chain.submit(self._fetch_chunked, executor, 'diffs', EntityStore(self._DIFF_FILE),
+                                      'differential.diff.search', 'revisionPHIDs', revision_phids)
+            buildables = self._fetch_chunked(executor, 'buildables', EntityStore(self._BUILDABLE_FILE),
+                                             'harbormaster.querybuildables', 'containerPHIDs', revision_phids)
+            self._fetch_chunked(executor, 'builds', EntityStore(self._BUILD_FILE),
+                                'harbormaster.build.search', 'buildables', [b['phid'] for b in buildables])
+            diffs.result()
+        state['revisions'] = max(r['fields']['dateModified'] for r in changed)
+        self._save_state(state)
+
+    def get_revisions(self, modified_start: Optional[int]) -> List[Dict]:
+        print('Downloading revisions modified since {}...'.format(modified_start))
         constraints = {
-            'createdStart': from_date
+            'createdStart': int(START_DATE.strftime('%s'))
         }
-        # FIXME: lots of code duplication around pagination and error handling.
-        # find a way to separate this into a function.
-        after = None
-        while True:
-            revisions = self.phab.differential.revision.search(
-                constraints=constraints, after=after)
-            data.extend(revisions.response['data'])
-            print('{} revisions...'.format(len(data)))
-            after = revisions.response['cursor']['after']
-            if after is None:
-                break
-        print('Number of revisions:', len(data))
-        with open(self._REVISION_FILE, 'w') as json_file:
-            json.dump(data, json_file)
-
-    def get_buildables(self):
-        print('Downloading buildables...')
+        if modified_start is not None:
+            constraints['modifiedStart'] = modified_start
         data = []
-        after = None
-        while True:
-            revisions = self.phab.harbormaster.querybuildables(
-                containerPHIDs=[r.phid for r in self.revisions.values()], after=after)
-            data.extend(revisions.response['data'])
-            print('{} buildables...'.format(len(data)))
-            after = revisions.response['cursor']['after']
-            if after is None:
-                break
-        print('Number of buildables:', len(data))
-        with open(self._BUILDABLE_FILE, 'w') as json_file:
-            json.dump(data, json_file)
-
-    def get_builds(self):
-        print('Downloading builds...')
-        data = []
-        constraints = {
-            'buildables': [r.phid for r in self.buildables.values()]
-        }
-        after = None
-        while True:
-            # retry on timeouts
-            fail_count = 0
-            while True:
-                try: 
-                    revisions = self.phab.harbormaster.build.search(
-                        constraints=constraints, after=after)
-                except socket.timeout:
-                    fail_count +=1
-                    if fail_count > 5:
-                        raise
-                    time.sleep(10)
-                    continue
-                break
-            data.extend(revisions.response['data'])
-            print('{} builds...'.format(len(data)))
-            after = revisions.response['cursor']['after']
-            if after is None:
-                break
-        print('Number of buildables:', len(data))
-        with open(self._BUILD_FILE, 'w') as json_file:
-            json.dump(data, json_file)
+        store = EntityStore(self._REVISION_FILE)
+        batch = []
+        for revision in self.conduit.search('differential.revision.search', constraints=constraints):
+            batch.append(revision)
+            if len(batch) == _CHUNK_SIZE:
+                data.extend(batch)
+                store.append(batch)
+                batch = []
+                print('{} revisions...'.format(len(data)))
+        data.extend(batch)
+        store.append(batch)
+        print('Number of changed revisions:', len(data))
+        return data
+
+    def _fetch_chunked(self, executor: ThreadPoolExecutor, name: str, store: EntityStore, method: str,
+                       constraint: str, phids: List[str]) -> List[Dict]:
+        """Query `method` for chunks of `phids` in parallel and append the results to `store`."""
+        print('Downloading {} for {} objects...'.format(name, len(phids)))
+
+        def fetch(chunk: List[str]) -> List[Dict]:
+            if method == 'harbormaster.querybuildables':
+                pages = self.conduit.search(method, **{constraint: chunk})
+            else:
+                pages = self.conduit.search(method, constraints={constraint: chunk})
+            data = list(pages)
+            store.append(data)
+            return data
 
-    def get_diffs(self):
-        print('Downloading diffs...')
+        chunks = [phids[i:i + _CHUNK_SIZE] for i in range(0, len(phids), _CHUNK_SIZE)]
         data = []
-        constraints = {
-            'revisionPHIDs': [r.phid for r in self.revisions.values()]
-        }
-        after = None
-        while True:
-            # retry on timeouts
-            fail_count = 0
-            while True:
-                try: 
-                    diffs = self.phab.differential.diff.search(
-                        constraints=constraints, after=after)
-                except socket.timeout:
-                    fail_count +=1
-                    if fail_count > 5:
-                        raise
-                    time.sleep(10)
-                    continue
-                break
-            data.extend(diffs.response['data'])
-            print('{} diffs...'.format(len(data)))
-            after = diffs.response['cursor']['after']
-            if after is None:
-                break
-        print('Number of diffs:', len(data))
-        with open(self._DIFF_FILE, 'w') as json_file:
-            json.dump(data, json_file)
+        for result in executor.map(fetch, chunks):
+            data.extend(result)
+        print('Number of {}: {}'.format(name, len(data)))
+        return data
 
     def parse_revisions(self):
-        with open(self._REVISION_FILE) as revision_file:
-            revision_dict = json.load(revision_file)
-        self.revisions = {r.phid: r for r in (Revision(x) for x in revision_dict)}
+        self.revisions = EntityStore(self._REVISION_FILE).load(Revision)
         print('Parsed {} revisions.'.format(len(self.revisions)))
 
     def parse_buildables(self):
-        with open(self._BUILDABLE_FILE) as buildables_file:
-            buildable_dict = json.load(buildables_file)
-        self.buildables = {b.phid: b for b in (Buildable(x) for x in buildable_dict)}
+        self.buildables = EntityStore(self._BUILDABLE_FILE).load(Buildable)
         print('Parsed {} buildables.'.format(len(self.buildables)))
 
     def parse_builds(self):
-        with open(self._BUILD_FILE) as build_file:
-            build_dict = json.load(build_file)
-        self.builds = {b.phid: b for b in (Build(x) for x in build_dict)}
+        self.builds = EntityStore(self._BUILD_FILE).load(Build)
         print('Parsed {} builds.'.format(len(self.builds)))
 
     def parse_diffs(self):
-        with open(self._DIFF_FILE) as diff_file:
-            diff_dict = json.load(diff_file)
-        self.diffs = {d.phid: d for d in (Diff(x) for x in diff_dict)}
+        self.diffs = EntityStore(self._DIFF_FILE).load(Diff)
         print('Parsed {} diffs.'.format(len(self.diffs)))
 
     def link_objects(self):
@@ -412,11 +408,24 @@ class PhabBuildPuller:
             revision.diffs.append(diff)
             diff.revision = revision
 
+        for revision in self.revisions.values():
+            revision.summarize()
+
     def compute_metrics(self, name: str, group_function):
         print('Creating metrics for {}...'.format(name))
-        group_dict = {}
-        for revision in self.revisions.values():
-            group_dict.setdefault(group_function(revision), []).append(revision)
+        counters = ['revisions', 'tested', 'no_builds', 'no_repo', 'had_failed', 'failed_then_passed',
+                    'published_failing', 'all_passed']
+        group_dict = {}  # type: Dict[str, List[int]]
+        for r in self.revisions.values():
+            counts = group_dict.setdefault(group_function(r), [0] * len(counters))
+            counts[0] += 1
+            counts[1] += r.was_premerge_tested
+            counts[2] += len(r.builds) == 0
+            counts[3] += r.repository_phid is None
+            counts[4] += r.has_failed_builds
+            counts[5] += r.builds_finally_succeeded
+            counts[6] += r.published_failing
+            counts[7] += r.all_builds_passed
 
         csv_file = open(self._PHAB_WEEKLY_METRICS_FILE.format(name), 'w')
         fieldnames = [name, '# revisions', '# tested revisions', '% tested revisions', '# untested revisions',
@@ -428,17 +437,10 @@ class PhabBuildPuller:
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames, dialect=csv.excel)
         writer.writeheader()
         for group in sorted(group_dict.keys()):
-            revisions = group_dict[group]  # type: List[Revision]
-            num_revisions = len(revisions)
-            num_premt_revisions = len([r for r in revisions if r.was_premerge_tested])
+            (num_revisions, num_premt_revisions, num_no_build_triggered, num_no_repo, num_had_failed_builds,
+             num_failed_first_then_passed, num_published_failing, num_all_passed) = group_dict[group]
             precentage_premt_revisions = 100.0 * num_premt_revisions / num_revisions
-            num_no_build_triggered = len([r for r in revisions if len(r.builds) == 0])
             percent_no_build_triggered = 100.0 * num_no_build_triggered / num_revisions
-            num_no_repo = len([r for r in revisions if r.repository_phid is None])
-            num_had_failed_builds =len([r for r in revisions if r.has_failed_builds])
-            num_failed_first_then_passed = len([r for r in revisions if r.builds_finally_succeeded])
-            num_published_failing = len([r for r in revisions if r.published_failing])
-            num_all_passed = len([r for r in revisions if r.all_builds_passed])
             writer.writerow({
                 name: group,
                 '# revisions': num_revisions,
@@ -457,6 +459,7 @@ class PhabBuildPuller:
                 '# all passed': num_all_passed,
                 '% all passed': 100*num_all_passed / num_revisions,
             })
+        csv_file.close()
 
     def count_base_revisions(self):
         base_revisions = {}
@@ -536,6 +539,8 @@ class PhabBuildPuller:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('repo_path')
+    parser.add_argument('--workers', type=int, default=8, help='number of parallel Conduit requests')
+    parser.add_argument('--no-update', action='store_true', help='only use the data downloaded before')
     args = parser.parse_args()
-    puller = PhabBuildPuller(args.repo_path)
-    puller.run()
+    puller = PhabBuildPuller(args.repo_path, args.workers)
+    puller.run(update=not args.no_update)
@@ -13,17 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
 import datetime
 from time import timezone
 import git
 from typing import Dict, Optional
-from google.cloud import monitoring_v3
+from metrics_sink import MetricsBuffer, create_sink
 import re
 
 from datetime import tzinfo
 
-GCP_PROJECT_ID = 'llvm-premerge-checks'
-
 
 class RepoStats:
 
@@ -82,11 +81,7 @@ def get_reverts_per_day(repo_path: str, max_age: datetime.datetime) -> RepoStats
     return stats
 
 
-def gcp_write_data(project_id: str, stats: RepoStats, now:datetime.datetime):
-    """Upload metrics to Stackdriver."""
-    client = monitoring_v3.MetricServiceClient()
-    project_name = client.project_path(project_id)
-
+def write_metrics(metrics: MetricsBuffer, stats: RepoStats):
     for desc_type, value in [
         ["reverts", stats.reverts],
         ["commits", stats.commits],
@@ -96,21 +91,18 @@ def gcp_write_data(project_id: str, stats: RepoStats, now:datetime.datetime):
     ]:
         if value is None:
             continue
-
-        series = monitoring_v3.types.TimeSeries()
-        series.metric.type = 'custom.googleapis.com/repository_{}'.format(desc_type)
-        series.resource.type = 'global'
-        point = series.points.add()
-        point.value.double_value = value
-        point.interval.end_time.seconds = int(now.timestamp())
-        client.create_time_series(project_name, [series])
+        metrics.gauge('repository_{}'.format(desc_type), value)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upload statistics of the llvm-project repository of the last 24h')
+    parser.add_argument('--sink', default='stackdriver', help='where to write the metrics to, see metrics_sink.py')
+    args = parser.parse_args()
+    metrics = MetricsBuffer(create_sink(args.sink))
     now = datetime.datetime.now(tz=datetime.timezone.utc)
     max_age = now - datetime.timedelta(days=1)
     # TODO: make path configurable
     stats = get_reverts_per_day('~/git/llvm-project', max_age)
     print(stats)
-    # TODO: add `dryrun` parameter
-    gcp_write_data(GCP_PROJECT_ID, stats, now)
\ No newline at end of file
+    write_metrics(metrics, stats)
+    metrics.flush()
@@ -15,6 +15,7 @@
 
 # generate statistics on the llvm github repository
 
+import bisect
 import csv
 import datetime
 import git
@@ -52,6 +53,8 @@ class MyCommit:
         self.phab_revision = self._get_revision(commit)  # type: Optional[str]
         self.reverts = None  # type: Optional[MyCommit]
         self.reverted_by = None  # type: Optional[MyCommit]
+        # how the revert was linked: "hash", "summary" or None
+        self.revert_match = None  # type: Optional[str]
         self._diff_index = None  # type: Optional[git.DiffIndex]
 
     @staticmethod
@@ -86,6 +89,23 @@ class MyCommit:
     def is_revert(self) -> bool:
         return self.reverts is not None
 
+    @property
+    def time_to_revert(self) -> Optional[datetime.timedelta]:
+        if self.reverted_by is None:
+            return None
+        return self.reverted_by.date - self.date
+
+    @property
+    def revert_chain(self) -> List["MyCommit"]:
+        """Original commit followed by its revert, the revert of the revert, ..."""
+        root = self
+        while root.reverts is not None:
+            root = root.reverts
+        chain = [root]
+        while chain[-1].reverted_by is not None:
+            chain.append(chain[-1].reverted_by)
+        return chain
+
     @property
     def week(self) -> str:
         return "{}-w{:02d}".format(self.date.year, self.date.isocalendar()[1])
@@ -126,6 +146,30 @@ class MyCommit:
             return "unknown"
         return m.group(1)
 
+    @property
+    def reverted_hash_prefix(self) -> Optional[str]:
+        """(Abbreviated) hash from the "This reverts commit" trailer, if any."""
+        m = REVERT_HASH_REGEX.search(self.commit.message)
+        if m is None:
+            return None
+        return m.group(1).lower()
+
+
+class HashIndex:
+    """Sorted list of commit hashes supporting abbreviated prefix lookups."""
+
+    def __init__(self, hashes):
+        self._hashes = sorted(hashes)  # type: List[str]
+
+    def lookup(self, prefix: str) -> Optional[str]:
+        """Return the full hash starting with prefix, None if unknown or ambiguous."""
+        i = bisect.bisect_left(self._hashes, prefix)
+        if i == len(self._hashes) or not self._hashes[i].startswith(prefix):
+            return None
+        if i + 1 < len(self._hashes) and self._hashes[i + 1].startswith(prefix):
+            return None
+        return self._hashes[i]
+
 
 class RepoStats:
     def __init__(self, git_dir: str):
@@ -151,19 +195,79 @@ class RepoStats:
         print("Read {} commits".format(len(self.commit_by_hash)))
 
     def find_reverts(self):
-        reverts = 0
-        for commit in self.commit_by_hash.values():
+        """Link reverts to the commits they revert.
+
+        Reverts are resolved by the hash in the "This reverts commit" trailer,
+        matching on the reverted summary is only used as a fallback. Commits
+        are visited oldest first, so the fallback picks the latest commit with
+        that summary that landed before the revert.
+        """
+        index = HashIndex(self.commit_by_hash.keys())
+        latest_by_summary = dict()  # type: Dict[str, MyCommit]
+        matches = {"hash": 0, "summary": 0}
+        not_found = 0
+        # commit_by_hash is filled newest first
+        for commit in reversed(list(self.commit_by_hash.values())):
+            reverted = None  # type: Optional[MyCommit]
+            prefix = commit.reverted_hash_prefix
+            if prefix is not None:
+                chash = index.lookup(prefix)
+                if chash is not None and chash != commit.chash:
+                    reverted = self.commit_by_hash[chash]
+                    commit.revert_match = "hash"
             summary = commit.reverts_summary()
-            if summary is None:
+            if reverted is None and summary is not None:
+                reverted = latest_by_summary.get(summary)
+                if reverted is not None:
+                    commit.revert_match = "summary"
+            latest_by_summary[commit.summary] = commit
+            if reverted is None:
+                if prefix is not None or summary is not None:
+                    not_found += 1
                 continue
-            if summary not in self.commit_by_summary:
-                print("summary not found: {}".format(summary))
+            commit.reverts = reverted
+            # keep the first revert if a commit was reverted more than once
+            if reverted.reverted_by is None:
+                reverted.reverted_by = commit
+            matches[commit.revert_match] += 1
+        print(
+            "Found {} reverts ({} by hash, {} by summary), {} not found".format(
+                matches["hash"] + matches["summary"],
+                matches["hash"],
+                matches["summary"],
+                not_found,
+            )
+        )
+
+    def dump_revert_stats(self):
+        """Write one row per revert with its chain depth and time to revert."""
+        fieldnames = [
+            "timestamp",
+            "hash",
+            "reverts_hash",
+            "matched_by",
+            "hours_to_revert",
+            "chain_length",
+        ]
+        csvfile = open("tmp/llvm-project-reverts.csv", "w")
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect=csv.excel)
+        writer.writeheader()
+        for commit in self.commit_by_hash.values():
+            if not commit.is_revert:
                 continue
-            reverting_commit = self.commit_by_summary[summary][-1]
-            commit.reverted_by = reverting_commit
-            reverting_commit.reverts = commit
-            reverts += 1
-        print("Found {} reverts".format(reverts))
+            writer.writerow(
+                {
+                    "timestamp": commit.date.isoformat(),
+                    "hash": commit.chash,
+                    "reverts_hash": commit.reverts.chash,
+                    "matched_by": commit.revert_match,
+                    "hours_to_revert": "{:0.2f}".format(
+                        commit.reverts.time_to_revert.total_seconds() / 3600
+                    ),
+                    "chain_length": len(commit.revert_chain),
+                }
+            )
+        csvfile.close()
 
     # https://stackoverflow.com/questions/2600775/how-to-get-week-number-in-python
     def dump_daily_stats(self):
@@ -452,6 +556,7 @@ if __name__ == "__main__":
     # TODO: make the path configurable, and `git clone/pull`
     rs.parse_repo(max_age)
     rs.find_reverts()
+    rs.dump_revert_stats()
     rs.dump_daily_stats()
     rs.dump_overall_stats()
     rs.dump_author_stats()
@@ -1,61 +1,111 @@
 #!/usr/bin/env python3
+import argparse
 import traceback
 import psycopg2
-from phabricator import Phabricator
 import os
-from typing import Optional
+from typing import Dict, List, Optional
 import datetime
 import requests
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics_sink import MetricsBuffer, create_sink
 
 PHABRICATOR_URL = "https://reviews.llvm.org/api/"
 BUILDBOT_URL = "https://lab.llvm.org/buildbot/api/v2"
+BUILDKITE_URL = "https://api.buildkite.com/v2/"
+GITHUB_URL = "https://github.com/llvm/llvm-project"
 
+# (connect, read) timeout of a probe in seconds
+PROBE_TIMEOUT = (5, 15)
+# results of at most this many times `flush_every` rounds are kept while the
+# database is unreachable, older rounds are dropped
+MAX_PENDING_FLUSHES = 10
 
-def phab_up() -> Optional[Phabricator]:
-    """Try to connect to phabricator to see if the server is up.
-
-    Returns None if server is down.
-    """
-    logging.info("Checking Phabricator status...")
-    try:
-        phab = Phabricator(token=os.getenv('CONDUIT_TOKEN'), host=PHABRICATOR_URL)
-        phab.update_interfaces()
-        logging.info("Phabricator is up.")
-        return phab
-    except Exception as ex:
-        logging.error(ex)
-        logging.error(traceback.format_exc())
-        logging.warning("Phabricator is down.")
-    return None
-
-
-def buildbot_up() -> bool:
-    """Check if buildbot server is up"""
-    logging.info("Checking Buildbot status...")
-    try:
-        response = requests.get(BUILDBOT_URL)
-        logging.info(f'{response.status_code} {BUILDBOT_URL}')
-        logging.info(response.content)
-        return response.status_code == 200
-    except Exception as ex:
-        logging.error(ex)
-        logging.error(traceback.format_exc())
-    logging.warning("Buildbot is down.")
-    return False
-
-
-def log_server_status(phab: bool, buildbot: bool, conn: psycopg2.extensions.connection):
-    """log the phabricator status to the database."""
-    logging.info("Writing Phabricator status to database...")
+
+class Probe:
+    """Lightweight request to check if a server is up and how fast it answers.
+
+    Any response below 500 counts as up, e.g. Buildkite answers 401 without a
+    token, which is enough to know the API is serving requests. The
+    server_status table keeps the stricter meaning of a 200 response."""
+
+    def __init__(self, name: str, method: str, url: str, data: Optional[Dict] = None):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.data = data
+
+    def run(self, session: requests.Session) -> Dict:
+        start_time = time.monotonic()
+        status_code = None
+        try:
+            response = session.request(self.method, self.url, data=self.data, timeout=PROBE_TIMEOUT)
+            status_code = response.status_code
+        except Exception as ex:
+            logging.warning(f'{self.name}: {ex}')
+        latency = time.monotonic() - start_time
+        up = status_code is not None and status_code < 500
+        logging.info(f'{self.name}: {status_code} in {latency:0.3f}s')
+        return {
+            'probe': self.name,
+            'status_code': status_code,
+            'latency': latency,
+            'up': up,
+        }
+
+
+PROBES = [
+    # conduit.ping does not need a token and does no work on the server
+    Probe('phabricator', 'POST', PHABRICATOR_URL + 'conduit.ping', {'params': '{}', 'output': 'json'}),
+    Probe('buildbot', 'GET', BUILDBOT_URL),
+    Probe('buildkite', 'GET', BUILDKITE_URL),
+    Probe('github', 'HEAD', GITHUB_URL),
+]
+
+
+def run_probes(session: requests.Session, executor: ThreadPoolExecutor) -> List[Dict]:
+    """Run all probes in parallel, so a hanging server does not delay the others."""
+    timestamp = datetime.datetime.now()
+    results = list(executor.map(lambda p: p.run(session), PROBES))
+    for result in results:
+        result['timestamp'] = timestamp
+    return results
+
+
+def log_server_status(results: List[Dict], conn: psycopg2.extensions.connection):
+    """Write the results of one or more rounds of probes to the database."""
+    logging.info(f'Writing {len(results)} probe results to database...')
     cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO server_status (timestamp, phabricator, buildbot) VALUES (%s,%s,%s);",
-        (datetime.datetime.now(), phab, buildbot),
+    args_str = b",".join(
+        cur.mogrify(
+            b" (%s,%s,%s,%s,%s) ",
+            (r['timestamp'], r['probe'], r['status_code'], 1000 * r['latency'], r['up']),
+        )
+        for r in results
+    )
+    cur.execute(b"INSERT INTO server_probes (timestamp, probe, status_code, latency_ms, up) VALUES " + args_str)
+    # keep the up/down table for server_statistics.pgsql, "up" there means
+    # the server answered with 200
+    rounds = {}
+    for r in results:
+        rounds.setdefault(r['timestamp'], {})[r['probe']] = r['status_code'] == 200
+    args_str = b",".join(
+        cur.mogrify(b" (%s,%s,%s) ", (timestamp, status.get('phabricator'), status.get('buildbot')))
+        for timestamp, status in rounds.items()
     )
+    cur.execute(b"INSERT INTO server_status (timestamp, phabricator, buildbot) VALUES " + args_str)
     conn.commit()
 
 
+def write_metrics(metrics: MetricsBuffer, results: List[Dict]):
+    for r in results:
+        metrics.gauge(f'server_{r["probe"]}_up', r['up'], f'{r["probe"]} is reachable.')
+        metrics.gauge(f'server_{r["probe"]}_latency_seconds', r['latency'],
+                      f'Response time of the {r["probe"]} probe.')
+    metrics.flush()
+
+
 def connect_to_db() -> psycopg2.extensions.connection:
     """Connect to the database, create tables as needed."""
     conn = psycopg2.connect(
@@ -64,13 +114,71 @@ def connect_to_db() -> psycopg2.extensions.connection:
     cur.execute(
         "CREATE TABLE IF NOT EXISTS server_status (timestamp timestamp, phabricator boolean, buildbot boolean);"
     )
+    # status_code is NULL if the request failed, e.g. on a timeout
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS server_probes (
+            timestamp timestamp NOT NULL,
+            probe text NOT NULL,
+            status_code smallint,
+            latency_ms real NOT NULL,
+            up boolean NOT NULL
+            );"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS server_probes_timestamp ON server_probes (probe, timestamp);")
     conn.commit()
     return conn
 
 
+def monitor(interval: int, flush_every: int, daemon: bool, metrics: Optional[MetricsBuffer]):
+    """Probe the servers once, or every `interval` seconds with `daemon`.
+
+    In daemon mode results are written to the database in batches of
+    `flush_every` rounds and database errors are retried. A single run raises
+    them, so the calling job fails."""
+    session = requests.Session()
+    conn = None
+    pending = []
+    with ThreadPoolExecutor(max_workers=len(PROBES)) as executor:
+        while True:
+            start_time = time.monotonic()
+            results = run_probes(session, executor)
+            pending.extend(results)
+            if metrics is not None:
+                write_metrics(metrics, results)
+            if not daemon or len(pending) >= flush_every * len(PROBES):
+                try:
+                    if conn is None or conn.closed:
+                        conn = connect_to_db()
+                    log_server_status(pending, conn)
+                    pending = []
+                except Exception as ex:
+                    if not daemon:
+                        # fail the job, the results of a single run are lost
+                        raise
+                    # keep the results and try again after the next round
+                    logging.error(ex)
+                    logging.error(traceback.format_exc())
+                    conn = None
+                    max_pending = MAX_PENDING_FLUSHES * flush_every * len(PROBES)
+                    if len(pending) > max_pending:
+                        logging.warning(f'dropping {len(pending) - max_pending} oldest probe results')
+                        pending = pending[-max_pending:]
+            if not daemon:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - start_time)))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check if the servers are up and log it to the database')
+    parser.add_argument('--sink', default=None,
+                        help='also write the status as metrics, see metrics_sink.py')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and probe every --interval seconds instead of once')
+    parser.add_argument('--interval', type=int, default=60,
+                        help='seconds between two rounds of probes with --daemon')
+    parser.add_argument('--flush-every', type=int, default=5,
+                        help='number of rounds written to the database at once with --daemon')
+    args = parser.parse_args()
     logging.basicConfig(level='INFO', format='%(levelname)-7s %(message)s')
-    conn = connect_to_db()
-    phab = phab_up()
-    buildbot = buildbot_up()
-    log_server_status(phab is not None, buildbot, conn)
+    metrics = MetricsBuffer(create_sink(args.sink)) if args.sink is not None else None
+    monitor(args.interval, args.flush_every, args.daemon, metrics)
@@ -23,7 +23,7 @@ import sys
 from typing import List, Optional, Tuple, Dict
 
 import backoff
-from buildkite_utils import annotate, feedback_url, upload_file
+from buildkite_utils import annotate, feedback_url, upload_file, set_metadata, BuildkiteApi
 import git
 from phabricator import Phabricator
 
@@ -31,6 +31,11 @@ from phabricator import Phabricator
 LLVM_GITHUB_URL = 'ssh://git@github.com/llvm/llvm-project'
 FORK_REMOTE_URL = 'ssh://git@github.com/llvm-premerge-tests/llvm-project'
 
+"""Pipeline with the scheduled builds of main that set "ph_anchor_commit", see pipeline_main.py."""
+ANCHOR_PIPELINE = 'llvm-main'
+"""Number of recent green builds of main to consider as anchors."""
+ANCHOR_COUNT = 5
+
 
 class ApplyPatch:
     """Apply a diff from Phabricator on local working copy.
@@ -44,13 +49,21 @@ class ApplyPatch:
     - If D is not closed, it will download the patch for D and try to apply it locally.
     Once this class has applied all dependencies, it will apply the original diff.
 
+    With base_strategy "anchor" the patches are applied on the newest commit of
+    a recent green build of main that contains the picked base commit, so that
+    the builds of most patches share a few base commits and hit the compiler
+    caches on agents. If the patches do not apply there, the picked base is used.
+
     This script must be called from the root folder of a local checkout of
     https://github.com/llvm/llvm-project or given a path to clone into.
     """
 
     def __init__(self, path: str, diff_id: int, token: str, url: str, git_hash: str,
-                 phid: str, push_branch: bool = False):
+                 phid: str, push_branch: bool = False, base_strategy: str = 'newest',
+                 anchor_pipeline: str = ANCHOR_PIPELINE):
         self.push_branch = push_branch  # type: bool
+        self.base_strategy = base_strategy  # type: str
+        self.anchor_pipeline = anchor_pipeline  # type: str
         self.conduit_token = token  # type: Optional[str]
         self.host = url  # type: Optional[str]
         self.diff_id = diff_id  # type: int
@@ -122,14 +135,22 @@ class ApplyPatch:
                 logging.info(f'Base revision "{self.base_revision}" is set by command argument. Will use '
                              f'instead of resolved "{base_commit}"')
                 base_commit = self.find_commit(self.base_revision)
-            if base_commit is None:
-                base_commit = self.repo.heads['main'].commit
-                annotate(f"Cannot find a base git revision. Will use current HEAD.",
-                         style='warning', context='patch_diff')
-            self.create_branch(base_commit)
-            for (r, d) in plan:
-                if not self.apply_diff(d, r):
+            anchor = None
+            if self.base_strategy == 'anchor' and self.base_revision == 'auto':
+                anchor = self.find_anchor(base_commit)
+            if anchor is not None and not self.apply_plan(anchor, plan, report=False):
+                logging.info(f'patches do not apply on anchor {anchor.hexsha}, using {base_commit}')
+                anchor = None
+            if anchor is None:
+                if base_commit is None:
+                    base_commit = self.repo.heads['main'].commit
+                    annotate(f"Cannot find a base git revision. Will use current HEAD.",
+                             style='warning', context='patch_diff')
+                if not self.apply_plan(base_commit, plan):
                     return 1
+            annotate(f"Branch {self.branch_name} base revision is `{self.branch_base_hexsha}`"
+                     f"{' (anchor)' if anchor is not None else ''}.", style='info', context='patch_diff')
+            set_metadata('ph_base_commit', self.branch_base_hexsha)
             if self.push_branch:
                 self.repo.git.push('--force', 'origin', self.branch_name)
                 annotate(f"Created branch [{self.branch_name}]"
@@ -150,6 +171,36 @@ class ApplyPatch:
             logging.error(f'exception: {e}')
             return 1
 
+    def apply_plan(self, base_commit: git.Commit, plan: List[Tuple[Dict, Dict]], report: bool = True) -> bool:
+        """Create the branch at base_commit and apply all (revision, diff) of the plan."""
+        self.create_branch(base_commit)
+        for (r, d) in plan:
+            if not self.apply_diff(d, r, report):
+                return False
+        return True
+
+    def find_anchor(self, base_commit: Optional[git.Commit]) -> Optional[git.Commit]:
+        """Newest commit of a recent green build of main that contains base_commit."""
+        try:
+            bk = BuildkiteApi(os.getenv('BUILDKITE_API_TOKEN'), os.getenv('BUILDKITE_ORGANIZATION_SLUG'))
+            builds = bk.list_passed_builds(self.anchor_pipeline, 'main', ANCHOR_COUNT)
+        except Exception as e:
+            logging.warning(f'cannot get anchor commits: {e}')
+            return None
+        for b in builds:
+            sha = (b.get('meta_data') or {}).get('ph_anchor_commit')
+            if not sha:
+                continue
+            c = self.find_commit(sha)
+            if c is None:
+                logging.info(f'anchor {sha} does not exist')
+                continue
+            if base_commit is None or self.repo.is_ancestor(base_commit, c):
+                logging.info(f'using anchor {c.hexsha} of {b.get("web_url")}')
+                return c
+            logging.info(f'anchor {sha} does not contain {base_commit.hexsha}')
+        return None
+
     @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
     def reset_repository(self):
         """Update local git repo and origin.
@@ -190,15 +241,16 @@ class ApplyPatch:
     @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
     def create_branch(self, base_commit: git.Commit):
         if self.branch_name in self.repo.heads:
-            self.repo.delete_head('--force', self.branch_name)
+            if not self.repo.head.is_detached and self.repo.active_branch.name == self.branch_name:
+                # branch from a previous attempt, see apply_plan
+                self.repo.git.checkout('--force', '--detach')
+            self.repo.delete_head(self.branch_name, force=True)
         logging.info(f'creating branch {self.branch_name} at {base_commit.hexsha}')
         new_branch = self.repo.create_head(self.branch_name, base_commit.hexsha)
         self.repo.head.reference = new_branch
         self.repo.head.reset(index=True, working_tree=True)
         self.branch_base_hexsha = self.repo.head.commit.hexsha
         logging.info('Base branch revision is {}'.format(self.repo.head.commit.hexsha))
-        annotate(f"Branch {self.branch_name} base revision is `{self.branch_base_hexsha}`.",
-                 style='info', context='patch_diff')
 
     @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
     def commit(self, revision: Dict, diff: Dict):
@@ -253,8 +305,10 @@ class ApplyPatch:
             result.extend(sub)
         return result
 
-    def apply_diff(self, diff: Dict, revision: Dict) -> bool:
-        """Download and apply a diff to the local working copy."""
+    def apply_diff(self, diff: Dict, revision: Dict, report: bool = True) -> bool:
+        """Download and apply a diff to the local working copy.
+
+        If report is False, a failure is only logged."""
         logging.info(f"Applying {diff['id']} for revision {revision['id']}...")
         patch = self.get_raw_diff(str(diff['id']))
         self.apply_diff_counter += 1
@@ -269,6 +323,8 @@ class ApplyPatch:
         if proc.returncode != 0:
             logging.info(proc.stdout)
             logging.error(proc.stderr)
+            if not report:
+                return False
             message = f":bk-status-failed: Failed to apply [{patch_file}](artifact://{patch_file}).\n\n"
             if self.revision_id != revision['id']:
                 message += f"**Attention! D{revision['id']} is one of the dependencies of the target " \
@@ -319,8 +375,14 @@ if __name__ == "__main__":
     parser.add_argument('--push-branch', action='store_true', dest='push_branch',
                         help='choose if branch shall be pushed to origin')
     parser.add_argument('--phid', type=str, default=None, help='Phabricator ID of the review this commit pertains to')
+    parser.add_argument('--base-strategy', type=str, default='newest', choices=['newest', 'anchor'],
+                        help='"newest": newest base commit of the diffs, "anchor": rebase on the commit of a recent '
+                             'green build of main if the patches apply there')
+    parser.add_argument('--anchor-pipeline', type=str, default=ANCHOR_PIPELINE,
+                        help='Buildkite pipeline with the builds of main for --base-strategy=anchor')
     parser.add_argument('--log-level', type=str, default='INFO')
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
-    patcher = ApplyPatch(args.path, args.diff_id, args.token, args.url, args.commit, args.phid, args.push_branch)
+    patcher = ApplyPatch(args.path, args.diff_id, args.token, args.url, args.commit, args.phid, args.push_branch,
+                         args.base_strategy, args.anchor_pipeline)
     sys.exit(patcher.run())
@@ -0,0 +1,189 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmarks for the Python code that runs on every build, with
+# generated inputs and no access to Phabricator or Buildkite.
+#
+# By default the inputs are 1/10 of the full size, so the suite stays fast:
+#   PERF_SCALE=1 python -m pytest -s scripts/perf_test.py
+# runs 10k-file diffs, 500k test cases and 50k lines of clang-tidy output.
+# Every benchmark fails if the best of its rounds is slower than its limit,
+# the limits are several times the usual timings to not be flaky.
+# Set PERF_RESULTS=<file> to append the timings as JSON lines.
+# See pipeline_simulator.py for the timings of the phases of the pipeline generators.
+
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+import pytest
+
+# the scripts import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import clang_tidy_report  # noqa: E402
+import ignore_diff  # noqa: E402
+import pipeline_simulator  # noqa: E402
+import steps  # noqa: E402
+import xunit_utils  # noqa: E402
+from choose_projects import ChooseProjects  # noqa: E402
+from phabtalk.phabtalk import Report  # noqa: E402
+
+SCALE = float(os.getenv('PERF_SCALE', '0.1'))
+ROUNDS = int(os.getenv('PERF_ROUNDS', '3'))
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROJECTS = ['llvm', 'clang', 'clang-tools-extra', 'lld', 'lldb', 'mlir', 'libcxx', 'compiler-rt']
+
+
+def bench(name: str, fn: Callable, size: int, limit_per_1k: float) -> float:
+    """Run fn ROUNDS times, fail if the best run took longer than limit_per_1k per 1000 items."""
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    limit = limit_per_1k * size / 1000
+    print(f'\n{name}: {size} items, best of {ROUNDS}: {best:.3f}s (limit {limit:.3f}s)')
+    results = os.getenv('PERF_RESULTS')
+    if results:
+        with open(results, 'a') as f:
+            f.write(json.dumps({'name': name, 'size': size, 'seconds': best, 'limit': limit}) + '\n')
+    assert best <= limit, f'{name} took {best:.3f}s for {size} items, limit is {limit:.3f}s'
+    return best
+
+
+def generate_diff(files: int, lines_per_hunk: int = 3, prefix: bool = True) -> str:
+    """Diff of `files` files in all projects, like `git diff` or `git diff --no-prefix`."""
+    a, b = ('a/', 'b/') if prefix else ('', '')
+    parts = []
+    for i in range(files):
+        project = PROJECTS[i % len(PROJECTS)]
+        # every 4th file is a test, these are ignored by clang-tidy
+        kind = 'test' if i % 4 == 0 else 'lib'
+        path = f'{project}/{kind}/dir{i % 97}/file{i}.cpp'
+        parts.append(f'diff --git {a}{path} {b}{path}\n'
+                     f'index 1111111..2222222 100644\n'
+                     f'--- {a}{path}\n'
+                     f'+++ {b}{path}\n'
+                     f'@@ -10,{lines_per_hunk} +10,{lines_per_hunk} @@\n')
+        for j in range(lines_per_hunk):
+            parts.append(f'-  int old{j} = {j};\n+  int new{j} = {j};\n')
+    return ''.join(parts)
+
+
+def generate_xunit(cases: int, failure_every: int = 1000) -> bytes:
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n<testsuite name="LLVM" tests="{}">\n'.format(cases)]
+    for i in range(cases):
+        parts.append(f'<testcase classname="LLVM.Transforms.Pass{i % 300}" name="test{i}.ll" time="0.01"')
+        if i % failure_every == 0:
+            parts.append('><failure><![CDATA[FileCheck error: CHECK: expected string not found]]></failure>'
+                         '</testcase>\n')
+        else:
+            parts.append('/>\n')
+    parts.append('</testsuite>\n</testsuites>\n')
+    return ''.join(parts).encode()
+
+
+def generate_clang_tidy_output(lines: int) -> str:
+    parts = []
+    for i in range(lines):
+        project = PROJECTS[i % len(PROJECTS)]
+        kind = i % 3
+        if kind == 0:
+            parts.append(f'{project}/lib/file{i % 1000}.cpp:{i % 5000 + 1}:{i % 80 + 1}: warning: '
+                         f'variable "x{i}" is not initialized [cppcoreguidelines-init-variables]\n')
+        elif kind == 1:
+            parts.append(f'  int x{i};\n')
+        else:
+            parts.append('      ^\n')
+    return ''.join(parts)
+
+
+@pytest.fixture(scope='module')
+def llvm_dir(tmp_path_factory):
+    """Empty directories for all projects, enough for ChooseProjects."""
+    path = tmp_path_factory.mktemp('llvm-project')
+    for project in ChooseProjects(None).all_projects:
+        os.makedirs(path / project)
+    return str(path)
+
+
+def test_choose_projects(llvm_dir):
+    size = int(10000 * SCALE)
+    patch = generate_diff(size)
+    cp = ChooseProjects(llvm_dir)
+    projects = cp.choose_projects(patch, 'linux')
+    assert 'clang' in projects
+    bench('choose_projects', lambda: cp.choose_projects(patch, 'linux'), size, 0.5)
+
+
+def test_remove_ignored():
+    size = int(10000 * SCALE)
+    # clang_tidy_report passes `git diff --no-prefix`
+    diff_lines = generate_diff(size, prefix=False).splitlines(keepends=True)
+    with open(os.path.join(SCRIPTS_DIR, 'clang-tidy.ignore')) as f:
+        patterns = f.readlines()
+    result = ignore_diff.remove_ignored(diff_lines, patterns)
+    assert 0 < len(result) < len(diff_lines)
+    bench('ignore_diff.remove_ignored', lambda: ignore_diff.remove_ignored(diff_lines, patterns), size, 1.0)
+
+
+def test_clang_tidy_parse_output():
+    size = int(50000 * SCALE)
+    out = generate_clang_tidy_output(size)
+    with open(os.path.join(SCRIPTS_DIR, 'clang-tidy.ignore')) as f:
+        ignore = clang_tidy_report.pathspec.PathSpec.from_lines(
+            clang_tidy_report.pathspec.patterns.GitWildMatchPattern, f.readlines())
+    errors, warnings, comments = clang_tidy_report.parse_output(out, ignore, Report())
+    assert warnings == (size + 2) // 3
+    bench('clang_tidy_report.parse_output', lambda: clang_tidy_report.parse_output(out, ignore, Report()), size,
+          0.2)
+
+
+def test_xunit_parse_failures():
+    size = int(500000 * SCALE)
+    xml = generate_xunit(size)
+    failures = xunit_utils.parse_failures(xml, 'linux')
+    assert len(failures) == (size + 999) // 1000
+    bench('xunit_utils.parse_failures', lambda: xunit_utils.parse_failures(xml, 'linux'), size, 0.05)
+
+
+def test_pipeline_steps():
+    size = int(2000 * SCALE)
+    env = {f'ph_var{i}': str(i) for i in range(30)}
+
+    def generate():
+        pipeline = []
+        for i in range(size // 2):
+            pipeline.extend(steps.generic_linux(';'.join(PROJECTS), check_diff=True))
+            pipeline.extend(steps.generic_windows(';'.join(PROJECTS)))
+        return steps.dump_pipeline(pipeline, env)
+
+    assert generate().count('label:') == size // 2 * 2
+    bench('pipeline step generation', generate, size, 10.0)
+
+
+def test_pipeline_simulator():
+    size = int(2000 * SCALE)
+    simulator = pipeline_simulator.Simulator(size, generated_steps=50)
+    try:
+        for generator in pipeline_simulator.GENERATORS:
+            assert simulator.run(generator)['steps'] > 0
+        bench('pipeline_premerge.py (simulated)', lambda: simulator.run('premerge'), size, 5.0)
+    finally:
+        simulator.close()
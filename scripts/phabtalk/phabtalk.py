@@ -16,14 +16,39 @@
 Interactions with Phabricator.
 """
 
+import functools
+import hashlib
+import json
 import logging
-from typing import Optional, List, Dict
+import os
+import tempfile
+import time
+from typing import Optional, List, Dict, TYPE_CHECKING
 import uuid
 import argparse
 
-import backoff
-from phabricator import Phabricator
-from benedict import benedict
+if TYPE_CHECKING:
+    from phabricator import Phabricator
+
+# Conduit methods of the server (conduit.query) are cached for a day, they
+# only change when Phabricator is upgraded.
+INTERFACES_CACHE_TTL = 24 * 60 * 60
+
+
+def retry(max_tries: int):
+    """backoff.on_exception with exponential waits, backoff is only imported on the first call."""
+    def decorator(func):
+        retrying = None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal retrying
+            if retrying is None:
+                import backoff
+                retrying = backoff.on_exception(backoff.expo, Exception, max_tries=max_tries, logger='', factor=3)(func)
+            return retrying(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class PhabTalk:
@@ -34,22 +59,54 @@ class PhabTalk:
 
     def __init__(self, token: Optional[str], host: Optional[str] = 'https://reviews.llvm.org/api/',
                  dry_run_updates: bool = False):
-        self._phab = None  # type: Optional[Phabricator]
+        self._token = token
+        self._host = host
+        self._client = None  # type: Optional['Phabricator']
         self.dry_run_updates = dry_run_updates
-        self._phab = Phabricator(token=token, host=host)
-        self.update_interfaces()
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @property
+    def _phab(self) -> 'Phabricator':
+        """Conduit client, created on first use so that dry runs and --help don't touch the network."""
+        if self._client is None:
+            # slow to import, only needed to talk to the server
+            from phabricator import Phabricator
+            self._client = Phabricator(token=self._token, host=self._host)
+            self.update_interfaces()
+        return self._client
+
+    def _interfaces_cache_path(self) -> str:
+        host_hash = hashlib.sha1(str(self._host).encode()).hexdigest()[:12]
+        return os.path.join(tempfile.gettempdir(), f'phabtalk-interfaces-{host_hash}.json')
+
+    @retry(max_tries=5)
     def update_interfaces(self):
-        self._phab.update_interfaces()
-
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+        """Load the Conduit methods of the server, from the local cache if it is recent enough."""
+        from phabricator import parse_interfaces
+        path = self._interfaces_cache_path()
+        try:
+            if time.time() - os.path.getmtime(path) < INTERFACES_CACHE_TTL:
+                with open(path) as f:
+                    self._phab._interface = parse_interfaces(json.load(f))
+                return
+        except (OSError, ValueError) as e:
+            logging.debug(f'no cached interfaces in {path}: {e}')
+        interfaces = self._phab.conduit.query().response
+        self._phab._interface = parse_interfaces(interfaces)
+        tmp_path = f'{path}.{os.getpid()}'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(interfaces, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f'cannot cache interfaces in {path}: {e}')
+
+    @retry(max_tries=5)
     def get_revision_id(self, diff: str) -> Optional[str]:
         """Get the revision ID for a diff from Phabricator."""
         result = self._phab.differential.querydiffs(ids=[diff])
         return 'D' + result[diff]['revisionID']
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def get_diff(self, diff_id: int):
         """Get a diff from Phabricator based on its diff id."""
         return self._phab.differential.getdiff(diff_id=diff_id)
@@ -62,7 +119,7 @@ class PhabTalk:
         if revision_id is not None:
             self._comment_on_revision(revision_id, text)
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def _comment_on_revision(self, revision: str, text: str):
         """Add comment on a differential based on the revision id."""
 
@@ -82,7 +139,7 @@ class PhabTalk:
                                               transactions=transactions)
         logging.info('Uploaded comment to Revision D{}:{}'.format(revision, text))
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def update_build_status(self, phid: str, working: bool, success: bool, lint: {}, unit: []):
         """Submit collected report to Phabricator.
         """
@@ -128,7 +185,7 @@ class PhabTalk:
         logging.info('Uploaded build status {}, {} test results and {} lint results'.format(
             result_type, len(unit), len(lint_messages)))
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def create_artifact(self, phid, artifact_key, artifact_type, artifact_data):
         if self.dry_run_updates:
             logging.info('harbormaster.createartifact =================')
@@ -151,9 +208,10 @@ class PhabTalk:
             return
         self.create_artifact(phid, str(uuid.uuid4()), 'uri', {'uri': url, 'ui.external': True, 'name': name})
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def user_projects(self, user_phid: str) -> List[str]:
         """Returns slugs of all projects user has a membership."""
+        from benedict import benedict
         projects = benedict(self._phab.project.search(constraints={'members': [user_phid]}))
         slugs = []
         for p in projects.get('data', []):
@@ -162,12 +220,12 @@ class PhabTalk:
                 slugs.append(p['fields']['slug'])
         return slugs
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def get_revision(self, revision_id: int):
         """Get a revision from Phabricator based on its revision id."""
         return self._phab.differential.query(ids=[revision_id])[0]
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5, logger='', factor=3)
+    @retry(max_tries=5)
     def get_diff(self, diff_id: int):
         """Get a diff from Phabricator based on its diff id."""
         return self._phab.differential.getdiff(diff_id=diff_id)
@@ -13,15 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
 import os
 import sys
 
-import yaml
 import logging
 from buildkite_utils import set_metadata, BuildkiteApi
 from phabtalk.phabtalk import PhabTalk
 
-if __name__ == '__main__':
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Print the pipeline that applies the diff to a branch and triggers the build. '
+                    'Configured with ph_* environment variables.')
+    parser.parse_args(argv)
     diff_id = os.getenv("ph_buildable_diff")
     revision_id = os.getenv("ph_buildable_revision", '')
     log_level = os.getenv('ph_log_level', 'INFO')
@@ -36,7 +41,7 @@ if __name__ == '__main__':
     logging.debug(f'authorPHID {user_id}')
     if user_id is None:
         logging.error('cannot find author of the revision')
-        sys.exit(1)
+        return 1
     projects = phabtalk.user_projects(user_id)
     logging.info(f'user projects: {", ".join(projects)}')
     # Cancel any existing builds.
@@ -98,4 +103,10 @@ if __name__ == '__main__':
                 'env': env,
             },
         })
+    import yaml
     print(yaml.dump({'steps': steps}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,13 +15,13 @@
 
 # Script runs in checked out llvm-project directory.
 
+from buildkite_utils import set_metadata
 from choose_projects import ChooseProjects
-from steps import generic_linux, generic_windows, from_shell_output, extend_steps_env, bazel
+from steps import generic_linux, generic_windows, from_shell_outputs, bazel, dump_pipeline
 from typing import Dict
 import git
 import git_utils
 import os
-import yaml
 
 steps_generators = [
     '${BUILDKITE_BUILD_CHECKOUT_PATH}/.ci/generate-buildkite-pipeline-scheduled',
@@ -57,11 +57,13 @@ if __name__ == '__main__':
             env['BUILDKITE_COMMIT'] = repo.head.commit.hexsha
         env['BUILDKITE_BRANCH'] = os.getenv('BUILDKITE_BRANCH')
         env['BUILDKITE_MESSAGE'] = os.getenv('BUILDKITE_MESSAGE')
-        for gen in steps_generators:
-            steps.extend(from_shell_output(gen, env=env))
+        steps.extend(from_shell_outputs(steps_generators, env=env))
+
+    # Patches can be rebased on the commits of green builds of main, see patch_diff.py --base-strategy.
+    if os.getenv('BUILDKITE_BRANCH') == 'main':
+        set_metadata('ph_anchor_commit', repo.head.commit.hexsha)
 
     notify = []
     for e in notify_emails:
         notify.append({'email': e})
-    extend_steps_env(steps, env)
-    print(yaml.dump({'steps': steps, 'notify': notify}))
+    print(dump_pipeline(steps, env, notify=notify))
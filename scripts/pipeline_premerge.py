@@ -17,13 +17,14 @@
 
 import logging
 import os
+import sys
 from typing import Dict
 
-from buildkite_utils import annotate, feedback_url, set_metadata
+import build_dedup
+from buildkite_utils import annotate, feedback_url, set_metadata, BuildkiteApi
 from choose_projects import ChooseProjects
 import git
-from steps import generic_linux, generic_windows, from_shell_output, checkout_scripts, bazel, extend_steps_env
-import yaml
+from steps import generic_linux, generic_windows, from_shell_outputs, checkout_scripts, bazel, dump_pipeline
 
 steps_generators = [
     '${BUILDKITE_BUILD_CHECKOUT_PATH}/.ci/generate-buildkite-pipeline-premerge',
@@ -68,12 +69,41 @@ if __name__ == '__main__':
     # if len(windows_projects) > 0:
     #     steps.extend(generic_windows(';'.join(windows_projects)))
 
+    # Reuse the results of an earlier build of the same change, see build_dedup.py.
+    key = build_dedup.build_key(repo.head.commit.parents[0].hexsha, patch, linux_projects + windows_projects, env)
+    logging.info(f'build key: {key}')
+    reused = None
+    if phid is not None and os.getenv('ph_skip_dedup') is None:
+        try:
+            bk = BuildkiteApi(os.getenv('BUILDKITE_API_TOKEN'), os.getenv('BUILDKITE_ORGANIZATION_SLUG'))
+            reused = build_dedup.find_build(bk, os.getenv('BUILDKITE_PIPELINE_SLUG'), key, diff_id,
+                                            os.getenv('BUILDKITE_BUILD_NUMBER'))
+        except Exception as e:
+            logging.error(e)
+    if reused is not None:
+        # Builds that reuse results don't get the key, so there is always a real build to attach to.
+        logging.info(f"reusing build {reused.get('web_url')} ({reused.get('state')})")
+        set_metadata('ph_reused_build', str(reused.get('number')))
+        annotate(f"Same change as in [build {reused.get('number')}]({reused.get('web_url')}), "
+                 f"reporting its results. Set `ph_skip_dedup` to build again.", style='info')
+        steps.append({
+            'label': ':phabricator: report results of the same change',
+            'commands': [
+                *checkout_scripts('linux', scripts_refspec),
+                f"$${{SRC}}/scripts/summary.py --build {reused.get('number')}",
+            ],
+            'agents': {'queue': 'service'},
+            'timeout_in_minutes': 300,
+        })
+        print(dump_pipeline(steps, env))
+        sys.exit(0)
+    set_metadata(build_dedup.METADATA_KEY, key)
+
     # Add custom checks.
     if os.getenv('ph_skip_generated') is None:
         if os.getenv('BUILDKITE_COMMIT', 'HEAD') == "HEAD":
             env['BUILDKITE_COMMIT'] = repo.head.commit.hexsha
-        for gen in steps_generators:
-            steps.extend(from_shell_output(gen, env=env))
+        steps.extend(from_shell_outputs(steps_generators, env=env))
     modified_files = cp.get_changed_files(patch)
     steps.extend(bazel(modified_files))
 
@@ -97,5 +127,4 @@ if __name__ == '__main__':
         }
         steps.append(report_step)
 
-    extend_steps_env(steps, env)
-    print(yaml.dump({'steps': steps}))
+    print(dump_pipeline(steps, env))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the pipeline generators offline and measure how long they take.
+
+pipeline_create_branch.py, pipeline_premerge.py and pipeline_main.py are run
+in this process against a synthetic llvm-project repository:
+
+- Conduit and Buildkite API calls are answered from recorded responses in
+  pipeline_simulator_fixtures.json;
+- `buildkite-agent` is replaced by a script that only logs its arguments;
+- fetching and pushing the LLVM fork is skipped.
+
+The time spent in every generator is split into phases: git diff,
+ChooseProjects, from_shell_output (running .ci/generate-buildkite-pipeline-*)
+and yaml dump, everything else is "other":
+
+  pipeline_simulator.py --files 2000 --generated-steps 100
+  pipeline_simulator.py --generator premerge --json timings.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import re
+import runpy
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import git
+import yaml
+
+import git_utils
+import steps
+from buildkite_utils import BuildkiteApi
+from choose_projects import ChooseProjects
+from phabtalk.phabtalk import PhabTalk
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_FILE = os.path.join(SCRIPTS_DIR, 'pipeline_simulator_fixtures.json')
+
+# generator -> (script, extra environment)
+GENERATORS = {
+    'create-branch': ('pipeline_create_branch.py', {'BUILDKITE_BRANCH': 'main'}),
+    'premerge': ('pipeline_premerge.py', {'BUILDKITE_BRANCH': 'phab-diff-500002'}),
+    'main': ('pipeline_main.py', {'BUILDKITE_BRANCH': 'main'}),
+}
+PHASES = ['git diff', 'ChooseProjects', 'from_shell_output', 'yaml dump']
+
+GENERATOR_SCRIPT = """#!/usr/bin/env bash
+# Synthetic version of the step generator in llvm-project.
+set -eu
+changed=$(git diff --name-only HEAD~1 | wc -l)
+echo "steps:"
+for i in $(seq 1 {steps}); do
+  echo "- label: 'generated step $i'"
+  echo "  key: generated-$i"
+  echo "  commands: ['echo $changed files changed']"
+  echo "  agents: {{queue: linux}}"
+  echo "  timeout_in_minutes: 120"
+done
+"""
+
+FAKE_AGENT = """#!/bin/sh
+echo "$*" >> "$SIMULATOR_AGENT_LOG"
+"""
+
+
+class PhaseTimer:
+    """Accumulates the time spent in wrapped functions per phase.
+
+    Nested calls of the same phase are only counted once."""
+
+    def __init__(self):
+        self.seconds = {p: 0.0 for p in PHASES}
+        self.calls = {p: 0 for p in PHASES}
+        self._active = set()
+
+    def wrap(self, phase: str, fn: Callable, when: Callable = lambda *args, **kwargs: True) -> Callable:
+        def wrapper(*args, **kwargs):
+            if phase in self._active or not when(*args, **kwargs):
+                return fn(*args, **kwargs)
+            self._active.add(phase)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.perf_counter() - start
+                self.calls[phase] += 1
+                self._active.remove(phase)
+        return wrapper
+
+
+class ReplayConduit:
+    """Stands in for the Phabricator client, e.g. `differential.query(ids=[1])`
+    returns fixtures["differential.query"]."""
+
+    def __init__(self, fixtures: Dict, calls: List[str], path: str = ''):
+        self._fixtures = fixtures
+        self._calls = calls
+        self._path = path
+
+    def __getattr__(self, name: str) -> 'ReplayConduit':
+        return ReplayConduit(self._fixtures, self._calls, f'{self._path}.{name}' if self._path else name)
+
+    def __call__(self, **kwargs):
+        self._calls.append(self._path)
+        if self._path not in self._fixtures:
+            raise KeyError(f'no recorded response for Conduit method {self._path}')
+        return self._fixtures[self._path]
+
+
+class ReplayResponse:
+    def __init__(self, data):
+        self._data = data
+        self.status_code = 200
+        self.content = json.dumps(data).encode()
+
+    def json(self):
+        return self._data
+
+
+def create_repo(path: str, files: int, generated_steps: int) -> git.Repo:
+    """llvm-project like repository with a base commit and a patch changing `files` files."""
+    repo = git.Repo.init(path)
+    with repo.config_writer() as config:
+        config.set_value('user', 'name', 'simulator')
+        config.set_value('user', 'email', 'simulator@example.com')
+    projects = sorted(ChooseProjects(None).all_projects)
+    ci_dir = os.path.join(path, '.ci')
+    os.makedirs(ci_dir)
+    for name in ('generate-buildkite-pipeline-premerge', 'generate-buildkite-pipeline-scheduled'):
+        script = os.path.join(ci_dir, name)
+        with open(script, 'w') as f:
+            f.write(GENERATOR_SCRIPT.format(steps=generated_steps))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+
+    def write_files(version: int):
+        for i in range(files):
+            file = os.path.join(path, projects[i % len(projects)], 'lib', f'dir{i % 97}', f'file{i}.cpp')
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'w') as f:
+                f.write(''.join(f'int value{j} = {j + version};\n' for j in range(20)))
+
+    write_files(0)
+    repo.git.add('-A')
+    repo.index.commit('base')
+    repo.git.branch('-M', 'main')
+    write_files(1)
+    repo.git.add('-A')
+    repo.index.commit('patch')
+    return repo
+
+
+def run_generator(name: str, repo_dir: str, fixtures: Dict, work_dir: str) -> Dict:
+    """Run a generator once, return the timings per phase and the number of steps."""
+    script, extra_env = GENERATORS[name]
+    timer = PhaseTimer()
+    conduit_calls = []
+    buildkite_calls = []
+
+    def replay_get(_self, url: str):
+        buildkite_calls.append(url)
+        for pattern, data in fixtures['buildkite'].items():
+            if re.search(pattern, url):
+                return ReplayResponse(data)
+        raise KeyError(f'no recorded response for {url}')
+
+    agent_log = os.path.join(work_dir, 'agent.log')
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('ph_', 'BUILDKITE'))}
+    env.update({
+        'PATH': f'{os.path.join(work_dir, "bin")}{os.pathsep}{os.environ.get("PATH", "")}',
+        'SIMULATOR_AGENT_LOG': agent_log,
+        'CONDUIT_TOKEN': 'simulated',
+        'BUILDKITE_API_TOKEN': 'simulated',
+        'BUILDKITE_ORGANIZATION_SLUG': 'llvm-project',
+        'BUILDKITE_PIPELINE_SLUG': 'diff-checks',
+        'BUILDKITE_BUILD_NUMBER': '42',
+        'BUILDKITE_BUILD_PATH': work_dir,
+        'BUILDKITE_BUILD_CHECKOUT_PATH': repo_dir,
+        'BUILDKITE_COMMIT': 'HEAD',
+        'BUILDKITE_MESSAGE': 'simulated build',
+        'ph_buildable_diff': '500002',
+        'ph_buildable_revision': '123456',
+        'ph_build_id': '1000',
+        'ph_target_phid': 'PHID-HMBT-simulated',
+        'ph_log_level': logging.getLevelName(logging.getLogger().level),
+        **extra_env,
+    })
+
+    patches = [
+        (git.cmd.Git, '_call_process', timer.wrap('git diff', git.cmd.Git._call_process,
+                                                  lambda _self, method, *args, **kwargs: method == 'diff')),
+        (ChooseProjects, 'choose_projects', timer.wrap('ChooseProjects', ChooseProjects.choose_projects)),
+        (ChooseProjects, 'get_all_enabled_projects',
+         timer.wrap('ChooseProjects', ChooseProjects.get_all_enabled_projects)),
+        (steps, 'from_shell_output', timer.wrap('from_shell_output', steps.from_shell_output)),
+        (steps, 'from_shell_outputs', timer.wrap('from_shell_output', steps.from_shell_outputs)),
+        (yaml, 'dump', timer.wrap('yaml dump', yaml.dump)),
+        (PhabTalk, '_phab', property(lambda _self: ReplayConduit(fixtures['conduit'], conduit_calls))),
+        (BuildkiteApi, 'get', replay_get),
+        (BuildkiteApi, 'cancel_build', lambda _self, build: buildkite_calls.append(f'cancel {build["number"]}')),
+        (git_utils, 'initLlvmFork', lambda path: git.Repo(repo_dir)),
+        (git_utils, 'syncRemotes', lambda repo, from_remote, to_remote: None),
+    ]
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_argv = sys.argv
+    originals = [(obj, attr, obj.__dict__[attr]) for obj, attr, _ in patches]
+    out = io.StringIO()
+    try:
+        for obj, attr, value in patches:
+            setattr(obj, attr, value)
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(repo_dir)
+        sys.argv = [script]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            try:
+                runpy.run_path(os.path.join(SCRIPTS_DIR, script), run_name='__main__')
+            except SystemExit as e:
+                if e.code:
+                    raise Exception(f'{script} exited with {e.code}')
+        total = time.perf_counter() - start
+    finally:
+        for obj, attr, value in originals:
+            setattr(obj, attr, value)
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+    pipeline = yaml.safe_load(out.getvalue())
+    agent_calls = 0
+    if os.path.exists(agent_log):
+        with open(agent_log) as f:
+            agent_calls = len(f.readlines())
+        os.remove(agent_log)
+    return {
+        'generator': name,
+        'total': total,
+        **timer.seconds,
+        'other': total - sum(timer.seconds.values()),
+        'steps': len(pipeline.get('steps', [])),
+        'conduit_calls': len(conduit_calls),
+        'buildkite_calls': len(buildkite_calls),
+        'agent_calls': agent_calls,
+    }
+
+
+class Simulator:
+    """Synthetic repository and fake buildkite-agent in a temporary directory."""
+
+    def __init__(self, files: int, generated_steps: int, fixtures_file: str = FIXTURES_FILE):
+        with open(fixtures_file) as f:
+            self.fixtures = json.load(f)
+        self.work_dir = tempfile.mkdtemp(prefix='pipeline-simulator-')
+        self.repo_dir = os.path.join(self.work_dir, 'llvm-project')
+        create_repo(self.repo_dir, files, generated_steps)
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        os.makedirs(bin_dir)
+        agent = os.path.join(bin_dir, 'buildkite-agent')
+        with open(agent, 'w') as f:
+            f.write(FAKE_AGENT)
+        os.chmod(agent, os.stat(agent).st_mode | stat.S_IEXEC)
+
+    def run(self, generator: str, repeat: int = 1) -> Dict:
+        """Best of `repeat` runs by total time."""
+        results = [run_generator(generator, self.repo_dir, self.fixtures, self.work_dir) for _ in range(repeat)]
+        return min(results, key=lambda r: r['total'])
+
+    def close(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def print_results(results: List[Dict]):
+    columns = ['total', *PHASES, 'other']
+    print(f'{"generator":15}' + ''.join(f'{c:>19}' for c in columns) + f'{"steps":>7}')
+    for r in results:
+        print(f'{r["generator"]:15}' + ''.join(f'{r[c]:18.3f}s' for c in columns) + f'{r["steps"]:7}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline generators offline and time their phases.')
+    parser.add_argument('--generator', type=str, action='append', choices=list(GENERATORS),
+                        help='generator to run, can be repeated (default: all)')
+    parser.add_argument('--files', type=int, default=200, help='number of files changed by the patch')
+    parser.add_argument('--generated-steps', type=int, default=50,
+                        help='number of steps printed by .ci/generate-buildkite-pipeline-*')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of that many runs')
+    parser.add_argument('--fixtures', type=str, default=FIXTURES_FILE, help='recorded Conduit and Buildkite responses')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this file')
+    parser.add_argument('--log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
+    simulator = Simulator(args.files, args.generated_steps, args.fixtures)
+    try:
+        results = [simulator.run(g, args.repeat) for g in (args.generator or list(GENERATORS))]
+    finally:
+        simulator.close()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single entry point for the short-lived pipeline scripts.
+
+  premerge.py <command> [arguments of the command]
+
+Only the module of the command is imported, so e.g. `premerge.py set-build-status`
+does not pay for the imports of the other commands.
+"""
+
+# Keep the imports of this file to the standard library, see premerge_test.py.
+import importlib
+import os
+import sys
+
+# command -> (module, help), the module must have a main(argv) function.
+COMMANDS = {
+    'set-build-status': ('set_build_status', 'report the status of the build to Phabricator'),
+    'add-artifact': ('add_phabricator_artifact', 'add a link to the Harbormaster build'),
+    'create-branch': ('pipeline_create_branch', 'print the pipeline that creates the branch for a diff'),
+}
+
+
+def usage() -> str:
+    lines = [__doc__.strip(), '', 'commands:']
+    for name, (_, help_text) in COMMANDS.items():
+        lines.append(f'  {name:20} {help_text}')
+    return '\n'.join(lines)
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0 or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    if argv[0] not in COMMANDS:
+        print(f'unknown command "{argv[0]}"\n\n{usage()}', file=sys.stderr)
+        return 2
+    module_name, _ = COMMANDS[argv[0]]
+    sys.argv[0] = f'{sys.argv[0]} {argv[0]}'  # for the usage message of the command
+    module = importlib.import_module(module_name)
+    return module.main(argv[1:]) or 0
+
+
+if __name__ == '__main__':
+    # the scripts import each other as top-level modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -23,44 +23,56 @@ import re
 import shutil
 import sys
 import time
-from typing import Callable, List, Type
+from typing import Callable, List, Optional, Type
 import clang_format_report
 import clang_tidy_report
 import run_cmake
 from buildkite_utils import upload_file, annotate, strip_emojis
-from exec_utils import watch_shell, if_not_matches, tee
+from build_log import BuildLog, format_errors, load_index
+from exec_utils import watch_shell, if_not_matches, tee, OutputSink
 from phabtalk.phabtalk import Report, PhabTalk, Step
 
 from choose_projects import ChooseProjects
 
 
+def run_ninja(command: str, log_name: Optional[str] = None) -> int:
+    """Run ninja in build_dir.
+
+    The output goes to the console and, if log_name is set, to the compressed
+    artifacts/<log_name> with an index of the errors in <log_name>.errors.json."""
+    if log_name is None:
+        return watch_shell(OutputSink(sys.stdout.fileno()), OutputSink(sys.stderr.fileno()), command, cwd=build_dir)
+    with BuildLog(os.path.join(artifacts_dir, log_name)) as log:
+        rc = watch_shell(
+            OutputSink(sys.stdout.fileno(), log),
+            OutputSink(sys.stderr.fileno(), log),
+            command, cwd=build_dir)
+    if rc != 0:
+        with open(log.index_path, 'rb') as f:
+            errors = format_errors(load_index(f.read()), limit=5)
+        if errors:
+            annotate(f'{command} failed:\n```\n{errors}\n```', style='error')
+    return rc
+
+
 def ninja_all_report(step: Step, _: Report):
     step.reproduce_commands.append('ninja all')
-    rc = watch_shell(
-        sys.stdout.buffer.write,
-        sys.stderr.buffer.write,
-        'ninja all', cwd=build_dir)
+    rc = run_ninja('ninja all', 'ninja-all.log.gz')
     logging.debug(f'ninja all: returned {rc}')
     step.set_status_from_exit_code(rc)
 
 
 def ninja_check_all_report(step: Step, _: Report):
-    print('Full log will be available in Artifacts "ninja-check-all.log"', flush=True)
+    print('Full log will be available in Artifacts "ninja-check-all.log.gz"', flush=True)
     step.reproduce_commands.append('ninja check-all')
-    rc = watch_shell(
-        sys.stdout.buffer.write,
-        sys.stderr.buffer.write,
-        'ninja check-all', cwd=build_dir)
+    rc = run_ninja('ninja check-all', 'ninja-check-all.log.gz')
     logging.debug(f'ninja check-all: returned {rc}')
     step.set_status_from_exit_code(rc)
 
 def ninja_check_projects_report(step: Step, _: Report, checks: str):
-    print('Full log will be available in Artifacts "ninja-check.log"', flush=True)
+    print('Full log will be available in Artifacts "ninja-check.log.gz"', flush=True)
     step.reproduce_commands.append(f'ninja {checks}')
-    rc = watch_shell(
-        sys.stdout.buffer.write,
-        sys.stderr.buffer.write,
-        f'ninja {checks}', cwd=build_dir)
+    rc = run_ninja(f'ninja {checks}', 'ninja-check.log.gz')
     logging.debug(f'ninja {checks}: returned {rc}')
     step.set_status_from_exit_code(rc)
 
@@ -0,0 +1,60 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Slow to import, only load them when a command talks to a server.
+HEAVY_MODULES = ['phabricator', 'benedict', 'requests', 'git', 'pkg_resources', 'yaml', 'backoff']
+
+
+def imported_modules(code: str):
+    """Run code in a fresh interpreter, return the modules imported by it with -X importtime."""
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SCRIPTS_DIR, capture_output=True,
+                       text=True, check=True)
+    modules = set()
+    for line in r.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            modules.add(name.split('.')[0])
+    return modules
+
+
+@pytest.mark.parametrize('module', ['premerge', 'set_build_status', 'add_phabricator_artifact',
+                                    'pipeline_create_branch', 'phabtalk.phabtalk'])
+def test_import_is_light(module):
+    modules = imported_modules(f'import {module}')
+    assert module.split('.')[0] in modules
+    heavy = [m for m in HEAVY_MODULES if m in modules]
+    assert heavy == [], f'importing {module} loads {heavy}'
+
+
+def test_premerge_help():
+    modules = imported_modules('import sys, premerge; sys.argv = ["premerge.py", "--help"]; premerge.main()')
+    assert 'yaml' not in modules
+    assert 'phabtalk' not in modules
+
+
+def test_dry_run_does_not_connect():
+    sys.path.insert(0, SCRIPTS_DIR)
+    from phabtalk.phabtalk import PhabTalk
+    phabtalk = PhabTalk(None, dry_run_updates=True)
+    phabtalk.update_build_status('PHID-HMBT-1', False, True, {}, [])
+    assert phabtalk._client is None
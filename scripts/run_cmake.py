@@ -206,9 +206,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run CMake for LLVM.')
     parser.add_argument('projects', type=str, nargs='?', default='default')
     parser.add_argument('repo_path', type=str, nargs='?', default=os.getcwd())
+    parser.add_argument('--config', type=str, default=None,
+                        help='configuration file, defaults to run_cmake_config.yaml')
     parser.add_argument('--dryrun', action='store_true')
     parser.add_argument('--log-level', type=str, default='WARNING')
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
-    result, _, _, _ = run(args.projects, args.repo_path, dry_run=args.dryrun)
+    result, _, _, _ = run(args.projects, args.repo_path, args.config, dry_run=args.dryrun)
     sys.exit(result)
@@ -20,18 +20,19 @@ import os
 from phabtalk.phabtalk import PhabTalk
 from buildkite_utils import format_url
 
-if __name__ == '__main__':
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--log-level', type=str, default='WARNING')
     parser.add_argument('--success', action='store_true')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
 
     phabtalk = PhabTalk(os.getenv('CONDUIT_TOKEN'), dry_run_updates=(os.getenv('ph_dry_run_report') is not None))
     ph_target_phid = os.getenv('ph_target_phid')
     if ph_target_phid is None:
         logging.warning('ph_target_phid is not specified. Will not update the build status in Phabricator')
-        exit(0)
+        return
     build_url = f'https://reviews.llvm.org/harbormaster/build/{os.getenv("ph_build_id")}'
     print(f'Reporting results to Phabricator build {format_url(build_url)}', flush=True)
     ph_buildable_diff = os.getenv('ph_buildable_diff')
@@ -40,3 +41,7 @@ if __name__ == '__main__':
               f'&template=bug_report.md&title=buildkite build {os.getenv("BUILDKITE_PIPELINE_SLUG")} ' \
               f'{os.getenv("BUILDKITE_BUILD_NUMBER")}'
     print(f'{format_url(bug_url, "report issue")}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
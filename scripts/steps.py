@@ -17,11 +17,65 @@ import io
 import json
 import logging
 import os
-from typing import List, Set, Dict
+from typing import List, Set, Dict, Optional
 
-from exec_utils import watch_shell
+import build_cost
+from exec_utils import watch_shells
 import yaml
 
+# libyaml based loader is several times faster, if PyYAML was built with it.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Seconds a step generator may run, a hung generator must not block the pipeline.
+GENERATOR_TIMEOUT = float(os.getenv('ph_generator_timeout', '300'))
+
+# Keys that define the type of a Buildkite step.
+STEP_TYPES = ['command', 'commands', 'trigger', 'wait', 'block', 'input', 'group']
+
+# Retry steps which agent was lost or shut down.
+AGENT_RETRY = {'automatic': [
+    {'exit_status': -1, 'limit': 2},  # Agent lost
+    {'exit_status': 255, 'limit': 2},  # Forced agent shutdown
+]}
+
+
+class PipelineDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """libyaml based dumper if available, writes shared objects in full instead of as YAML aliases."""
+
+    def ignore_aliases(self, data):
+        return True
+
+
+def dump_pipeline(steps: List, env: Optional[Dict] = None, **fields) -> str:
+    """YAML of the pipeline to upload, fields are added to the top level (e.g. "notify").
+
+    env is set once for all steps of the pipeline. Builds started by trigger steps
+    don't inherit it, they get it in "build.env". Env of a step takes precedence."""
+    pipeline = dict(fields)
+    if env:
+        pipeline['env'] = env
+        for s in steps:
+            if isinstance(s, dict) and 'trigger' in s:
+                build = s.setdefault('build', {})
+                build['env'] = extend_dict(build.get('env'), env)
+    pipeline['steps'] = steps
+    return yaml.dump(pipeline, Dumper=PipelineDumper)
+
+
+def command_step(label: str, key: str, commands: List[str], agents: Dict, timeout_in_minutes: int,
+                 **fields) -> Dict:
+    """Build step with the settings shared by our steps, empty commands are dropped."""
+    step = {
+        'label': label,
+        'key': key,
+        'commands': [c for c in commands if c],
+        'agents': agents,
+        'timeout_in_minutes': timeout_in_minutes,
+        'retry': AGENT_RETRY,
+    }
+    step.update(fields)
+    return step
+
 
 def generic_linux(projects: str, check_diff: bool) -> List:
     if os.getenv('ph_skip_linux') is not None:
@@ -29,7 +83,8 @@ def generic_linux(projects: str, check_diff: bool) -> List:
     scripts_refspec = os.getenv("ph_scripts_refspec", "main")
     no_cache = os.getenv('ph_no_cache') is not None
     log_level = os.getenv('ph_log_level', 'WARNING')
-    linux_agents = {'queue': 'linux'}
+    placement = build_cost.default().place(projects, 'linux', sized_queues=os.getenv('ph_sized_queues') is not None)
+    linux_agents = placement.agents
     t = os.getenv('ph_linux_agents')
     if t is not None:
         linux_agents = json.loads(t)
@@ -61,19 +116,8 @@ def generic_linux(projects: str, check_diff: bool) -> List:
         'exit $$EXIT_STATUS',
     ])
 
-    linux_buld_step = {
-        'label': ':linux: x64 debian',
-        'key': 'linux',
-        'commands': commands,
-        'artifact_paths': ['artifacts/**/*', '*_result.json', 'build/test-results.xml'],
-        'agents': linux_agents,
-        'timeout_in_minutes': 120,
-        'retry': {'automatic': [
-            {'exit_status': -1, 'limit': 2},  # Agent lost
-            {'exit_status': 255, 'limit': 2},  # Forced agent shutdown
-        ]},
-    }
-    return [linux_buld_step]
+    return [command_step(':linux: x64 debian', 'linux', commands, linux_agents, placement.timeout_in_minutes,
+                         artifact_paths=['artifacts/**/*', '*_result.json', 'build/test-results.xml'])]
 
 
 def bazel(modified_files: Set[str], force: bool = False) -> List:
@@ -95,21 +139,11 @@ def bazel(modified_files: Set[str], force: bool = False) -> List:
     if t is not None:
         agents = json.loads(t)
 
-    return [{
-        'label': ':bazel: bazel',
-        'key': 'bazel',
-        'commands': [
-            'set -eu',
-            'cd utils/bazel',
-            'bazel query //... + @llvm-project//... | xargs bazel test --config=ci',
-        ],
-        'agents': agents,
-        'timeout_in_minutes': 120,
-        'retry': {'automatic': [
-            {'exit_status': -1, 'limit': 2},  # Agent lost
-            {'exit_status': 255, 'limit': 2},  # Forced agent shutdown
-        ]},
-    }]
+    return [command_step(':bazel: bazel', 'bazel', [
+        'set -eu',
+        'cd utils/bazel',
+        'bazel query //... + @llvm-project//... | xargs bazel test --config=ci',
+    ], agents, 120)]
 
 
 def generic_windows(projects: str) -> List:
@@ -121,97 +155,169 @@ def generic_windows(projects: str) -> List:
     clear_sccache = 'powershell -command "sccache --stop-server; echo $$env:SCCACHE_DIR; ' \
                     'Remove-Item -Recurse -Force -ErrorAction Ignore $$env:SCCACHE_DIR; ' \
                     'sccache --start-server"'
-    win_agents = {'queue': 'windows'}
+    placement = build_cost.default().place(projects, 'windows', sized_queues=os.getenv('ph_sized_queues') is not None)
+    win_agents = placement.agents
     t = os.getenv('ph_windows_agents')
     if t is not None:
         win_agents = json.loads(t)
-    windows_buld_step = {
-        'label': ':windows: x64 windows',
-        'key': 'windows',
-        'commands': [
-            clear_sccache if no_cache else '',
-            'sccache --zero-stats',
-            'C:\\BuildTools\\Common7\\Tools\\VsDevCmd.bat -arch=amd64 -host_arch=amd64',
-            *checkout_scripts('windows', scripts_refspec),
-            'pip install -q -r ./mlir/python/requirements.txt',
-            'powershell -command "'
-            f'%SRC%/scripts/premerge_checks.py --projects=\'{projects}\' --log-level={log_level}; '
-            '$$exit=$$?;'
-            'sccache --show-stats;'
-            'if ($$exit) {'
-            '  echo success;'
-            '  exit 0; } '
-            'else {'
-            '  echo failure;'
-            '  exit 1;'
-            '}"',
-        ],
-        'artifact_paths': ['artifacts/**/*', '*_result.json', 'build/test-results.xml'],
-        'agents': win_agents,
-        'timeout_in_minutes': 150,
-        'retry': {'automatic': [
-            {'exit_status': -1, 'limit': 2},  # Agent lost
-            {'exit_status': 255, 'limit': 2},  # Forced agent shutdown
-        ]},
-    }
-    return [windows_buld_step]
+    commands = [
+        clear_sccache if no_cache else '',
+        'sccache --zero-stats',
+        'C:\\BuildTools\\Common7\\Tools\\VsDevCmd.bat -arch=amd64 -host_arch=amd64',
+        *checkout_scripts('windows', scripts_refspec),
+        'pip install -q -r ./mlir/python/requirements.txt',
+        'powershell -command "'
+        f'%SRC%/scripts/premerge_checks.py --projects=\'{projects}\' --log-level={log_level}; '
+        '$$exit=$$?;'
+        'sccache --show-stats;'
+        'if ($$exit) {'
+        '  echo success;'
+        '  exit 0; } '
+        'else {'
+        '  echo failure;'
+        '  exit 1;'
+        '}"',
+    ]
+    return [command_step(':windows: x64 windows', 'windows', commands, win_agents, placement.timeout_in_minutes,
+                         artifact_paths=['artifacts/**/*', '*_result.json', 'build/test-results.xml'])]
 
 
-def from_shell_output(command, **kwargs) -> []:
+def from_shell_output(command, timeout: Optional[float] = GENERATOR_TIMEOUT, **kwargs) -> []:
     """
     Executes shell command and parses stdout as multidoc yaml file, see
     https://buildkite.com/docs/agent/v3/cli-pipeline#pipeline-format.
     :param command: command, may include env variables
+    :param timeout: the command is killed after that many seconds
     :return: all 'steps' that defined in the result ("env" section is ignored).
              Non-zero exit code and malformed YAML produces empty result.
     """
-    path = os.path.expandvars(command)
-    logging.debug(f'invoking "{path}"')
-    out = io.BytesIO()
-    err = io.BytesIO()
-    rc = watch_shell(out.write, err.write, path, **kwargs)
-    logging.debug(f'exit code: {rc}, stdout: "{out.getvalue().decode()}", stderr: "{err.getvalue().decode()}"')
+    return from_shell_outputs([command], timeout, **kwargs)
+
+
+def from_shell_outputs(commands: List[str], timeout: Optional[float] = GENERATOR_TIMEOUT, **kwargs) -> []:
+    """
+    Same as from_shell_output for several commands, that run concurrently.
+    :return: steps of all commands, in the order of the commands.
+    """
+    paths = [os.path.expandvars(c) for c in commands]
+    outputs = [(io.BytesIO(), io.BytesIO()) for _ in paths]
+    for path in paths:
+        logging.debug(f'invoking "{path}"')
+    codes = watch_shells([(out.write, err.write, path) for path, (out, err) in zip(paths, outputs)], timeout,
+                         **kwargs)
+    steps = []
+    for path, rc, (out, err) in zip(paths, codes, outputs):
+        if rc != 0:
+            logging.error(f'{path} returned non-zero code {rc}, stdout: "{out.getvalue().decode(errors="replace")}", '
+                          f'stderr: "{err.getvalue().decode(errors="replace")}"')
+            continue
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'"{path}" stdout: "{out.getvalue().decode(errors="replace")}", '
+                          f'stderr: "{err.getvalue().decode(errors="replace")}"')
+        steps.extend(parse_steps(path, out.getvalue()))
+    return steps
+
+
+def validate_step(step) -> Optional[str]:
+    """Returns why the step is not a valid Buildkite step, None if it is."""
+    if step in ('wait', 'block'):
+        return None
+    if not isinstance(step, dict):
+        return f'step must be a mapping, got {type(step).__name__}'
+    types = set('command' if t == 'commands' else t for t in STEP_TYPES if t in step)
+    if len(types) == 0 and 'plugins' in step:
+        types.add('command')  # plugins only
+    if len(types) != 1:
+        return f'step must have exactly one of {", ".join(STEP_TYPES)}, got {sorted(types)}'
+    if 'group' in step:
+        if not isinstance(step.get('steps'), list):
+            return 'group must have a list of steps'
+        for s in step['steps']:
+            error = validate_step(s)
+            if error is not None:
+                return f'in group {step["group"]}: {error}'
+    if not isinstance(step.get('env', {}), dict):
+        return '"env" must be a mapping'
+    if not isinstance(step.get('agents', {}), dict):
+        return '"agents" must be a mapping'
+    return None
+
+
+def parse_steps(name: str, output: bytes) -> List:
+    """Valid steps from the YAML documents in output, invalid ones are logged and skipped.
+
+    Documents are validated as they are parsed, the steps of the documents before
+    malformed YAML are kept."""
     steps = []
-    if rc != 0:
-        logging.error(
-            f'{path} returned non-zero code {rc}, stdout: "{out.getvalue().decode()}", stderr: "{err.getvalue().decode()}"')
-        return steps
     try:
-        for part in yaml.safe_load_all(out.getvalue()):
-            part.setdefault('steps', [])
-            steps.extend(part['steps'])
+        for part in yaml.load_all(output, Loader=SafeLoader):
+            if part is None:
+                continue
+            if not isinstance(part, dict):
+                logging.error(f'"{name}" produced a document that is not a mapping, ignoring it')
+                continue
+            for step in part.get('steps') or []:
+                error = validate_step(step)
+                if error is not None:
+                    logging.error(f'"{name}" produced an invalid step, ignoring it: {error}\n{step}')
+                    continue
+                steps.append(step)
     except yaml.YAMLError as e:
-        logging.error(f'''"{path}" produced malformed YAML, exception:
+        logging.error(f'''"{name}" produced malformed YAML, exception:
 {e}
 
-stdout: >>>{out.getvalue().decode()}>>>''')
+stdout: >>>{output.decode(errors="replace")}>>>''')
     return steps
 
 
+SCRIPTS_REPO = 'https://github.com/google/llvm-premerge-checks.git'
+
+
 def checkout_scripts(target_os: str, scripts_refspec: str) -> []:
+    """Commands to make the premerge scripts of scripts_refspec available in $SRC.
+
+    The agent keeps a checkout per commit and a virtualenv per hash of
+    requirements.txt, so a job usually only fetches the refspec and checks that
+    both exist."""
     if target_os == 'windows':
+        # one reused checkout, requirements are only installed if they differ from the last install
         return [
             'set SRC=%BUILDKITE_BUILD_PATH%/llvm-premerge-checks',
-            'rm -rf %SRC%',
-            'git clone --depth 1 https://github.com/google/llvm-premerge-checks.git %SRC%',
+            f'if not exist %SRC%\\.git git clone --depth 1 {SCRIPTS_REPO} %SRC%',
             'cd %SRC%',
-            f'git fetch origin "{scripts_refspec}":x',
-            'git checkout x',
+            f'git fetch --depth 1 origin "{scripts_refspec}"',
+            'git checkout -q -f FETCH_HEAD',
+            'git clean -q -f -d -x',
             'echo llvm-premerge-checks commit:',
             'git rev-parse HEAD',
-            'pip install -q -r %SRC%/scripts/requirements.txt',
+            'fc /b %SRC%\\scripts\\requirements.txt %BUILDKITE_BUILD_PATH%\\premerge-requirements.txt >nul 2>&1 || '
+            '(pip install -q -r %SRC%/scripts/requirements.txt && '
+            'copy /y %SRC%\\scripts\\requirements.txt %BUILDKITE_BUILD_PATH%\\premerge-requirements.txt)',
             'cd %BUILDKITE_BUILD_CHECKOUT_PATH%',
         ]
     return [
-        'export SRC=$${BUILDKITE_BUILD_PATH}/llvm-premerge-checks',
-        'rm -rf $${SRC}',
-        'git clone --depth 1 https://github.com/google/llvm-premerge-checks.git "$${SRC}"',
-        'cd $${SRC}',
-        f'git fetch origin "{scripts_refspec}":x',
-        'git checkout x',
-        'echo "llvm-premerge-checks commit"',
-        'git rev-parse HEAD',
-        'pip install -q -r $${SRC}/scripts/requirements.txt',
+        'export SCRIPTS_CACHE=$${BUILDKITE_BUILD_PATH}/llvm-premerge-checks-cache',
+        '[ -d "$${SCRIPTS_CACHE}/repo.git" ] || git init -q --bare "$${SCRIPTS_CACHE}/repo.git"',
+        f'git -C "$${{SCRIPTS_CACHE}}/repo.git" fetch -q --depth 1 {SCRIPTS_REPO} "{scripts_refspec}"',
+        'SCRIPTS_SHA=$$(git -C "$${SCRIPTS_CACHE}/repo.git" rev-parse FETCH_HEAD)',
+        'export SRC=$${SCRIPTS_CACHE}/src/$${SCRIPTS_SHA}',
+        # .ready is written last, a checkout without it was interrupted
+        'if [ "$$(cat "$${SRC}/.ready" 2>/dev/null)" != "$${SCRIPTS_SHA}" ]; then '
+        'rm -rf "$${SRC}" && mkdir -p "$${SRC}" && '
+        'git -C "$${SCRIPTS_CACHE}/repo.git" archive "$${SCRIPTS_SHA}" | tar -x -C "$${SRC}" && '
+        'echo "$${SCRIPTS_SHA}" > "$${SRC}/.ready"; fi',
+        'echo "llvm-premerge-checks commit $${SCRIPTS_SHA}"',
+        'export VENV=$${SCRIPTS_CACHE}/venv/$$(sha256sum "$${SRC}/scripts/requirements.txt" | cut -c1-16)',
+        'if [ ! -f "$${VENV}/.ready" ]; then '
+        'rm -rf "$${VENV}"; python3 -m venv --system-site-packages "$${VENV}" && '
+        '"$${VENV}/bin/pip" install -q -r "$${SRC}/scripts/requirements.txt" && touch "$${VENV}/.ready" '
+        '|| rm -rf "$${VENV}"; fi',
+        # without a virtualenv install the requirements as before
+        '[ -f "$${VENV}/.ready" ] && export PATH="$${VENV}/bin:$${PATH}" || '
+        'pip install -q -r "$${SRC}/scripts/requirements.txt"',
+        # drop checkouts and environments that were not used for a week
+        'touch "$${SRC}"; [ -d "$${VENV}" ] && touch "$${VENV}"',
+        'find "$${SCRIPTS_CACHE}/src" "$${SCRIPTS_CACHE}/venv" -mindepth 1 -maxdepth 1 -mtime +7 -exec rm -rf {} +',
         'cd "$$BUILDKITE_BUILD_CHECKOUT_PATH"',
     ]
 
@@ -225,10 +331,3 @@ def extend_dict(target: Dict, extra: Dict) -> Dict:
         target[k] = extra[k]
     return target
 
-
-def extend_steps_env(steps: List[Dict], env: Dict):
-    for s in steps:
-        if 'commands' in s:
-            s['env'] = extend_dict(s.get('env'), env)
-        if 'build' in s:
-            s['build']['env'] = extend_dict(s['build'].get('env'), env)
@@ -0,0 +1,62 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the the Apache License v2.0 with LLVM Exceptions (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://llvm.org/LICENSE.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import steps  # noqa: E402
+
+
+def test_from_shell_outputs_order_and_concurrency():
+    start = time.perf_counter()
+    result = steps.from_shell_outputs([
+        'sleep 1; echo "steps: [{label: a, command: x}]"',
+        'echo "steps: [{label: b, commands: [y]}, wait]"; echo ---; echo "steps: [{label: c, trigger: t}]"',
+        'sleep 1; echo "steps: [{label: d, command: x}]"',
+    ])
+    assert [s if s == 'wait' else s['label'] for s in result] == ['a', 'b', 'wait', 'c', 'd']
+    assert time.perf_counter() - start < 1.9
+
+
+def test_from_shell_output_timeout():
+    start = time.perf_counter()
+    assert steps.from_shell_output('echo "steps: [{command: x}]"; sleep 30', timeout=0.5) == []
+    assert time.perf_counter() - start < 5
+
+
+def test_invalid_steps_are_skipped():
+    out = b'''steps:
+- label: no type
+- label: two types
+  command: x
+  trigger: t
+- 42
+- label: ok
+  command: x
+- group: g
+  steps:
+  - label: nested ok
+    command: y
+---
+steps:
+- label: after
+  plugins: [{docker#v5: {image: x}}]
+---
+steps: [{label: bad yaml
+'''
+    result = steps.parse_steps('test', out)
+    assert [s.get('label', s.get('group')) for s in result] == ['ok', 'g', 'after']
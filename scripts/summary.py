@@ -16,10 +16,12 @@
 import argparse
 import logging
 import os
+import time
 from typing import Any, Tuple
 
 from phabtalk.phabtalk import PhabTalk
 from buildkite_utils import format_url, BuildkiteApi, strip_emojis
+import build_log
 import xunit_utils
 from command_utils import get_env_or_die
 from benedict import benedict
@@ -70,7 +72,7 @@ def process_build(bk: BuildkiteApi, build: benedict) -> Tuple[list[jobResult], b
             name=name,
             sub=[],
             success=job_state=='passed',
-            tests=fetch_job_unit_tests(job),
+            tests=fetch_job_unit_tests(job) or fetch_job_log_errors(job),
             url=job.get('web_url',''))
         if job.get('type') == 'trigger':
             triggered_url = job.get('triggered_build.url')
@@ -105,6 +107,33 @@ def fetch_job_unit_tests(job: benedict) -> list[Any]:
     logging.info('file test-results.xml not found')
     return []
 
+# Returns build errors from the log index of a failed script job, see build_log.py.
+def fetch_job_log_errors(job: benedict) -> list[Any]:
+    if job.get('state') != 'failed' or job.get('type') != 'script':
+        return []
+    artifacts_url = job.get('artifacts_url')
+    if artifacts_url is None:
+        return []
+    errors = []
+    for a in bk.get(artifacts_url).json():
+        a = benedict(a)
+        if not a.get('filename').endswith('.errors.json') or not a.get('download_url'):
+            continue
+        index = build_log.load_index(bk.get(a.get('download_url')).content)
+        details = build_log.format_errors(index)
+        if not details:
+            continue
+        ctx = strip_emojis(job.get('name', build.get('pipeline.name')))
+        errors.append({
+            'engine': ctx,
+            'name': a.get('filename'),
+            'namespace': 'build',
+            'result': 'fail',
+            'duration': 0.0,
+            'details': details,
+        })
+    return errors
+
 def print_jobs(jobs: list[jobResult], pad: str):
     for j in jobs:
         print(f"{pad} {j.name} {j.success}")
@@ -118,10 +147,22 @@ def flatten_tests(jobs: list[jobResult], prefix: str) -> list[Any]:
         t.extend(flatten_tests(j.sub, f"{prefix}{j.name} - "))
     return t
 
+# Waits until the build is finished, e.g. a build which results are reused (see build_dedup.py).
+def wait_for_build(bk: BuildkiteApi, pipeline: str, number: str, poll_seconds: int = 60) -> benedict:
+    while True:
+        build = bk.get_build(pipeline, number)
+        if build.get('finished_at'):
+            return build
+        logging.info(f"build {build.get('web_url')} is {build.get('state')}, waiting")
+        time.sleep(poll_seconds)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log-level', type=str, default='INFO')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--build', type=str, default=None,
+                        help='report the results of this build of the pipeline instead of the current one, '
+                             'waits for it to finish')
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level, format='%(levelname)-7s %(message)s')
     bk_api_token = get_env_or_die('BUILDKITE_API_TOKEN')
@@ -142,7 +183,13 @@ if __name__ == '__main__':
     try:
         bk = BuildkiteApi(bk_api_token, bk_organization_slug)
         # Build type is https://buildkite.com/docs/apis/rest-api/builds#get-a-build.
-        build = bk.get_build(bk_pipeline_slug, bk_build_number)
+        if args.build is None:
+            build = bk.get_build(bk_pipeline_slug, bk_build_number)
+        else:
+            build = wait_for_build(bk, bk_pipeline_slug, args.build)
+            phabtalk.maybe_add_url_artifact(ph_target_phid, build.get('web_url'), 'reused build')
+            if build.get('state') not in ('passed', 'failed'):
+                raise Exception(f"reused build {build.get('web_url')} is {build.get('state')}, restart this build")
         jobs, success = process_build(bk, build)
         failed_tests = flatten_tests(jobs, '')
         if args.debug: